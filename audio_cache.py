@@ -0,0 +1,94 @@
+"""
+audio_cache.py
+语音文件缓存：按（规范化文本、音色、语速、音调）寻址，超过容量时淘汰最久未使用的文件
+"""
+
+import os
+import re
+import shutil
+import hashlib
+from typing import Optional
+
+# 是否启用语音缓存、缓存目录和容量上限（MB）
+AUDIO_CACHE_ENABLED = os.getenv("AUDIO_CACHE", "1") == "1"
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", ".audio_cache")
+AUDIO_CACHE_MAX_MB = float(os.getenv("AUDIO_CACHE_MAX_MB", "500"))
+
+def normalize_text(text: str) -> str:
+    """合并空白字符，排版差异不影响缓存命中"""
+    return re.sub(r"\s+", " ", text).strip()
+
+def make_audio_key(text: str, voice: str, rate: str, pitch: str) -> str:
+    """计算语音缓存键"""
+    payload = "\x00".join([normalize_text(text), voice, rate, pitch])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class AudioCache:
+    """语音文件缓存，文件修改时间即最近使用时间"""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def get(self, key: str) -> Optional[str]:
+        """返回已缓存的语音文件路径，没有时返回 None"""
+        path = self.path(key)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.hits += 1
+            os.utime(path)
+            return path
+        self.misses += 1
+        return None
+
+    def put_file(self, key: str, source: str, move: bool = False) -> Optional[str]:
+        """把已生成的语音文件放入缓存，返回缓存中的路径"""
+        if not os.path.exists(source) or os.path.getsize(source) == 0:
+            return None
+        path = self.path(key)
+        if move:
+            os.replace(source, path)
+        else:
+            tmp_path = path + ".tmp"
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[str] = None):
+        """总大小超过上限时，从最久未使用的文件开始删除"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".mp3"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            total += stat.st_size
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def stats(self) -> dict:
+        """返回命中统计"""
+        return {"hits": self.hits, "misses": self.misses}
+
+_audio_cache = None
+
+def get_audio_cache() -> Optional[AudioCache]:
+    """返回全局语音缓存实例，AUDIO_CACHE=0 时返回 None"""
+    global _audio_cache
+    if _audio_cache is None and AUDIO_CACHE_ENABLED:
+        _audio_cache = AudioCache(AUDIO_CACHE_DIR, int(AUDIO_CACHE_MAX_MB * 1024 * 1024))
+    return _audio_cache
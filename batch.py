@@ -0,0 +1,209 @@
+"""
+batch.py
+批量生成：非交互地为多个孩子档案生成故事
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from llm_client import TokenBucket, call_with_limiter
+from metrics import cached_token_ratio, get_metrics
+from prompt_builder import get_age_bucket
+from story_generator import (
+    build_prompt, build_story_prompt, generate_story_summaries, generate_story, STORY_FAILURE_MESSAGE
+)
+from serial_story import generate_serial_story_chapter
+from response_cache import get_response_cache
+from user_profile import get_elapsed_months
+
+# 默认并发数、请求速率（每秒）、突发容量和重试次数
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+DEFAULT_RETRIES = 3
+# 重试退避的基础时长和上限（秒）
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+class JobFailed(Exception):
+    """单个任务生成失败"""
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """带随机抖动的指数退避时长"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def job_months(job: dict) -> int:
+    """从任务中读取孩子月龄，支持直接给出月龄或 child_info.json 格式的档案"""
+    if "months" in job:
+        return int(job["months"])
+    profile = job.get("profile") or {}
+    if "base_months" not in profile or "start_date" not in profile:
+        raise ValueError("任务缺少孩子月龄信息（months 或 profile）")
+    return profile["base_months"] + get_elapsed_months(profile["start_date"])
+
+def prefix_key(job: dict) -> tuple:
+    """任务提示词的共同前缀：年龄段和场景决定基础提示词的前半部分，续写连续剧时还包括故事梗概"""
+    serial = job.get("serial") if int(job.get("story_type", 1)) == 2 else None
+    return get_age_bucket(job_months(job)), job.get("setting"), (serial or {}).get("story_summary")
+
+def group_by_prefix(jobs: Iterable[dict]) -> List[List[dict]]:
+    """按共同前缀分组，组的顺序和组内顺序都保持任务文件中的先后"""
+    groups: Dict[tuple, List[dict]] = {}
+    for job in jobs:
+        try:
+            key = prefix_key(job)
+        except (KeyError, ValueError, TypeError):
+            # 格式错误的任务单独成组，执行时再报告错误
+            key = ("invalid", id(job))
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+def load_jobs(path: str) -> List[dict]:
+    """读取 JSONL 格式的任务列表"""
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            job.setdefault("id", str(line_num))
+            jobs.append(job)
+    return jobs
+
+class BatchEngine:
+    """异步批量生成引擎：限制并发、限流，并对失败任务重试"""
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE,
+                 burst: int = DEFAULT_BURST, retries: int = DEFAULT_RETRIES):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.limiter = TokenBucket(rate, burst)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def _call(self, func, *args):
+        """在线程池中执行一次阻塞的生成调用；调用中的每个 HTTP 请求（一次概要生成可能有多次）都要取得令牌"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call_with_limiter, self.limiter, func, *args)
+
+    async def _run_once(self, job: dict) -> dict:
+        months = job_months(job)
+        base_prompt = build_prompt(months, job["character"], job["elements"], job["setting"])
+        story_type = int(job.get("story_type", 1))
+
+        # 续写已有连续剧，不需要重新生成概要
+        serial = job.get("serial")
+        if story_type == 2 and serial:
+            chapter_num = serial["current_chapter"] + 1
+            chapter = await self._call(
+                generate_serial_story_chapter, base_prompt, chapter_num, serial["chapters"],
+                serial.get("story_summary"), serial.get("chapter_summaries"), serial.get("arc_summaries")
+            )
+            if not chapter:
+                raise JobFailed(f"第{chapter_num}章生成失败")
+            return {"summary": serial.get("story_summary"), "chapter_num": chapter_num, "chapter": chapter}
+
+        summaries = await self._call(generate_story_summaries, base_prompt)
+        if not summaries:
+            raise JobFailed("故事概要生成失败")
+        index = int(job.get("summary_index", 1))
+        summary = summaries[min(max(index, 1), len(summaries)) - 1]
+
+        if story_type == 1:
+            final_prompt = build_story_prompt(base_prompt, summary)
+            story = await self._call(generate_story, final_prompt)
+            if not story or story == STORY_FAILURE_MESSAGE:
+                raise JobFailed("故事生成失败")
+            return {"summary": summary, "story": story}
+
+        chapter = await self._call(generate_serial_story_chapter, base_prompt, 1, [], summary)
+        if not chapter:
+            raise JobFailed("第1章生成失败")
+        return {"summary": summary, "chapter_num": 1, "chapter": chapter}
+
+    async def run_job(self, job: dict) -> dict:
+        """执行单个任务，失败时按抖动退避重试"""
+        start = time.monotonic()
+        result = {"id": job.get("id"), "story_type": int(job.get("story_type", 1))}
+        last_error = None
+        for attempt in range(self.retries + 1):
+            result["attempts"] = attempt + 1
+            try:
+                result.update(await self._run_once(job))
+                result["status"] = "ok"
+                break
+            except (KeyError, ValueError) as e:
+                # 任务本身有误，重试也无济于事
+                last_error = f"任务格式错误：{str(e)}"
+                break
+            except Exception as e:
+                last_error = str(e)
+                if attempt < self.retries:
+                    await asyncio.sleep(backoff_delay(attempt))
+        if result.get("status") != "ok":
+            result.update({"status": "failed", "error": last_error})
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        return result
+
+    async def run(self, jobs: Iterable[dict], output_path: str, group_prefix: bool = True) -> dict:
+        """并发执行所有任务，每完成一个就写入输出文件。
+        group_prefix 时按共同前缀分组：每组先执行一个任务，服务端缓存了共同前缀后其余任务再并发执行"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        write_lock = asyncio.Lock()
+        stats = {"ok": 0, "failed": 0}
+
+        with open(output_path, "a", encoding="utf-8") as out:
+            async def worker(job):
+                async with semaphore:
+                    result = await self.run_job(job)
+                async with write_lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    stats[result["status"]] += 1
+                print(f"[{result['status']}] 任务 {result['id']}（{result['elapsed']}秒，尝试{result['attempts']}次）")
+
+            async def run_group(group):
+                await worker(group[0])
+                await asyncio.gather(*(worker(job) for job in group[1:]))
+
+            groups = group_by_prefix(jobs) if group_prefix else [[job] for job in jobs]
+            await asyncio.gather(*(run_group(group) for group in groups))
+
+        self._executor.shutdown(wait=False)
+        return stats
+
+def run_batch(jobs_path: str, output_path: str, concurrency: int = DEFAULT_CONCURRENCY,
+              rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST, retries: int = DEFAULT_RETRIES,
+              group_prefix: bool = True) -> dict:
+    """从 JSONL 读取任务并批量生成，返回成功和失败数量"""
+    jobs = load_jobs(jobs_path)
+    print(f"共读取{len(jobs)}个任务，并发数{concurrency}，限速每秒{rate}个请求")
+    engine = BatchEngine(concurrency, rate, burst, retries)
+    stats = asyncio.run(engine.run(jobs, output_path, group_prefix))
+    print(f"批量生成完成：成功{stats['ok']}个，失败{stats['failed']}个")
+    print(f"提示词 token 命中服务端缓存的比例：{cached_token_ratio(get_metrics().snapshot()):.1%}")
+    cache = get_response_cache()
+    if cache:
+        print(f"缓存统计：{cache.stats()}")
+    return stats
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="批量生成睡前故事")
+    parser.add_argument("jobs", help="任务文件（JSONL，每行一个任务）")
+    parser.add_argument("output", help="结果文件（JSONL，按完成顺序追加写入）")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="最大并发任务数")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="每秒最多发起的请求数")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help="令牌桶容量")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="每个任务的最大重试次数")
+    parser.add_argument("--no-prefix-groups", action="store_true", help="不按共同前缀分组，按任务文件顺序执行")
+    args = parser.parse_args(argv)
+    run_batch(args.jobs, args.output, args.concurrency, args.rate, args.burst, args.retries,
+              not args.no_prefix_groups)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+bench.py
+端到端基准：用本地模拟的AI服务和语音后端测量概要延迟、首段语音延迟、连续剧每章 token 用量和批量吞吐量，
+结果写入 JSON 文件便于跟踪性能回退
+"""
+
+import io
+import os
+import json
+import time
+import tempfile
+import argparse
+import contextlib
+from datetime import datetime
+from typing import Dict, List, Optional
+from unittest import mock
+
+import tts
+from batch import run_batch
+from fake_llm import start_fake_server
+from fake_tts import FakeTTSBackend
+from llm_client import reset_clients
+from service import StoryService
+from story_generator import build_prompt, build_story_prompt, generate_story_summaries
+from story_pipeline import generate_story_with_audio
+
+# 基准使用的固定故事参数
+BENCH_MONTHS = 60
+BENCH_SETTING = "森林"
+BENCH_CHARACTER = "小兔子贝贝"
+BENCH_ELEMENTS = "友谊"
+BENCH_OUTPUT_FILE = "bench_results.json"
+
+def percentiles(samples: List[float]) -> dict:
+    """计算 p50/p95/p99（最近秩法），单位与输入相同"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = max(int(-(-p * len(ordered) // 100)) - 1, 0)
+        return round(ordered[index], 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 2),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(ordered[-1], 2)
+    }
+
+@contextlib.contextmanager
+def bench_environment(llm_latency: float = 0.0, llm_failure_rate: float = 0.0, seed: int = 0):
+    """启动模拟AI服务，在临时目录中运行，关闭所有缓存和数据库存储，退出时恢复"""
+    server, url = start_fake_server(latency=llm_latency, failure_rate=llm_failure_rate, seed=seed)
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "bench-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "bench-deployment"
+    }
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("tts.get_audio_cache", return_value=None), \
+            mock.patch("serial_story.get_story_store", return_value=None), \
+            mock.patch("serial_story.SERIAL_STORY_FILE", os.path.join(tmp_dir, "serial_story.json")):
+        reset_clients()
+        os.chdir(tmp_dir)
+        try:
+            yield server
+        finally:
+            os.chdir(original_dir)
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+
+def bench_summaries(runs: int) -> dict:
+    """从发出请求到拿到三个概要的耗时（毫秒）"""
+    prompt = build_prompt(BENCH_MONTHS, BENCH_CHARACTER, BENCH_ELEMENTS, BENCH_SETTING)
+    # 预热一次：导入 openai、建立连接，不计入结果
+    generate_story_summaries(prompt, use_cache=False)
+    samples = []
+    failures = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        summaries = generate_story_summaries(prompt, use_cache=False)
+        if summaries:
+            samples.append((time.perf_counter() - start) * 1000)
+        else:
+            failures += 1
+    return dict(percentiles(samples), failures=failures)
+
+def bench_first_audio(runs: int, backend: FakeTTSBackend) -> dict:
+    """边生成边合成时，从开始生成到第一句语音写入的耗时，以及整篇完成的耗时（毫秒）"""
+    base_prompt = build_prompt(BENCH_MONTHS, BENCH_CHARACTER, BENCH_ELEMENTS, BENCH_SETTING)
+    prompt = build_story_prompt(base_prompt, "小兔子贝贝和朋友们在森林里找到回家的路。")
+    first_audio = []
+    totals = []
+    original_backend = tts.get_tts_backend()
+    tts.set_tts_backend(backend)
+    try:
+        for i in range(runs):
+            backend.reset()
+            start = time.perf_counter()
+            generate_story_with_audio(prompt, f"bench{i}")
+            totals.append((time.perf_counter() - start) * 1000)
+            if backend.calls:
+                # 句子按顺序写入，最早开始合成的成功句子就是第一句写入的语音
+                first_end = min(backend.calls)[1]
+                first_audio.append((first_end - start) * 1000)
+    finally:
+        tts.set_tts_backend(original_backend)
+    return {
+        "time_to_first_audio_ms": percentiles(first_audio),
+        "total_ms": percentiles(totals),
+        "tts_failures": backend.failures
+    }
+
+def bench_serial_tokens(server, chapters: int = 28) -> dict:
+    """生成一整部连续剧，统计每章（含章节摘要）的AI调用次数和 token 用量"""
+    service = StoryService()
+    per_chapter = []
+    for chapter_num in range(1, chapters + 1):
+        start_index = len(server.usage_log)
+        start = time.perf_counter()
+        if chapter_num == 1:
+            service.start_serial(
+                BENCH_SETTING, BENCH_CHARACTER, BENCH_ELEMENTS,
+                "小兔子贝贝和朋友们在森林里找到回家的路。", BENCH_MONTHS
+            )
+        else:
+            service.next_chapter(BENCH_SETTING, BENCH_MONTHS)
+        elapsed = (time.perf_counter() - start) * 1000
+        usage = server.usage_log[start_index:]
+        per_chapter.append({
+            "chapter": chapter_num,
+            "calls": len(usage),
+            "prompt_tokens": sum(u["prompt_tokens"] for u in usage),
+            "completion_tokens": sum(u["completion_tokens"] for u in usage),
+            "max_prompt_tokens": max((u["prompt_tokens"] for u in usage), default=0),
+            "cached_tokens": sum(u["prompt_tokens_details"]["cached_tokens"] for u in usage),
+            "latency_ms": round(elapsed, 2)
+        })
+    prompt_tokens = [c["prompt_tokens"] for c in per_chapter]
+    return {
+        "chapters": per_chapter,
+        "total_prompt_tokens": sum(prompt_tokens),
+        "total_completion_tokens": sum(c["completion_tokens"] for c in per_chapter),
+        "max_chapter_prompt_tokens": max(prompt_tokens),
+        "last_chapter_prompt_tokens": prompt_tokens[-1],
+        # 提示词中命中服务端前缀缓存的比例（模拟服务按最长相同前缀计算）
+        "cached_ratio": round(sum(c["cached_tokens"] for c in per_chapter) / sum(prompt_tokens), 4)
+    }
+
+def bench_batch(concurrency_levels: List[int], jobs_count: int) -> List[dict]:
+    """不同并发数下批量生成单元剧的吞吐量（任务/秒）"""
+    jobs_path = "bench_jobs.jsonl"
+    with open(jobs_path, "w", encoding="utf-8") as f:
+        for i in range(jobs_count):
+            job = {"id": str(i + 1), "months": BENCH_MONTHS, "setting": BENCH_SETTING,
+                   "character": BENCH_CHARACTER, "elements": BENCH_ELEMENTS}
+            f.write(json.dumps(job, ensure_ascii=False) + "\n")
+    results = []
+    for concurrency in concurrency_levels:
+        output_path = f"bench_batch_{concurrency}.jsonl"
+        start = time.perf_counter()
+        stats = run_batch(jobs_path, output_path, concurrency=concurrency, rate=1000, burst=max(concurrency, 1))
+        elapsed = time.perf_counter() - start
+        results.append({
+            "concurrency": concurrency,
+            "jobs": jobs_count,
+            "ok": stats["ok"],
+            "failed": stats["failed"],
+            "seconds": round(elapsed, 3),
+            "jobs_per_second": round(stats["ok"] / elapsed, 2) if elapsed else None
+        })
+    return results
+
+def run_benchmarks(runs: int = 20, llm_latency: float = 0.05, llm_failure_rate: float = 0.0,
+                   tts_latency: float = 0.02, tts_failure_rate: float = 0.0, chapters: int = 28,
+                   concurrency_levels: Optional[List[int]] = None, batch_jobs: int = 16, seed: int = 0) -> dict:
+    """运行全部基准，返回可以直接写入 JSON 的结果"""
+    concurrency_levels = concurrency_levels or [1, 4, 8]
+    results: Dict[str, object] = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "runs": runs, "llm_latency": llm_latency, "llm_failure_rate": llm_failure_rate,
+            "tts_latency": tts_latency, "tts_failure_rate": tts_failure_rate, "chapters": chapters,
+            "concurrency_levels": concurrency_levels, "batch_jobs": batch_jobs, "seed": seed
+        }
+    }
+    # 生成过程中的进度输出不影响结果，全部丢弃
+    with bench_environment(llm_latency, llm_failure_rate, seed) as server, \
+            contextlib.redirect_stdout(io.StringIO()):
+        results["time_to_first_summary_ms"] = bench_summaries(runs)
+        backend = FakeTTSBackend(latency=tts_latency, failure_rate=tts_failure_rate, seed=seed)
+        results["audio"] = bench_first_audio(runs, backend)
+        results["serial"] = bench_serial_tokens(server, chapters)
+        results["batch"] = bench_batch(concurrency_levels, batch_jobs)
+        results["llm_requests"] = len(server.usage_log)
+    return results
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="端到端基准（使用本地模拟的AI服务和语音后端）")
+    parser.add_argument("--runs", type=int, default=20, help="延迟类基准的测量次数")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="模拟AI服务每个请求的延迟（秒）")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="模拟AI服务的失败率（0-1）")
+    parser.add_argument("--tts-latency", type=float, default=0.02, help="模拟语音合成每句的延迟（秒）")
+    parser.add_argument("--tts-failure-rate", type=float, default=0.0, help="模拟语音合成的失败率（0-1）")
+    parser.add_argument("--chapters", type=int, default=28, help="连续剧基准生成的章节数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="批量基准的并发数")
+    parser.add_argument("--batch-jobs", type=int, default=16, help="批量基准的任务数")
+    parser.add_argument("--seed", type=int, default=0, help="失败随机数种子")
+    parser.add_argument("--output", default=BENCH_OUTPUT_FILE, help="结果文件路径（JSON）")
+    args = parser.parse_args(argv)
+
+    output_path = os.path.abspath(args.output)
+    results = run_benchmarks(
+        args.runs, args.llm_latency, args.llm_failure_rate, args.tts_latency, args.tts_failure_rate,
+        args.chapters, args.concurrency, args.batch_jobs, args.seed
+    )
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    summary = results["time_to_first_summary_ms"]
+    first_audio = results["audio"]["time_to_first_audio_ms"]
+    serial = results["serial"]
+    print(f"首个概要：p50 {summary.get('p50')}ms，p95 {summary.get('p95')}ms，p99 {summary.get('p99')}ms")
+    print(f"首句语音：p50 {first_audio.get('p50')}ms，p95 {first_audio.get('p95')}ms，p99 {first_audio.get('p99')}ms")
+    print(f"连续剧{len(serial['chapters'])}章：输入 token 共{serial['total_prompt_tokens']}，"
+          f"单章最多{serial['max_chapter_prompt_tokens']}，最后一章{serial['last_chapter_prompt_tokens']}")
+    for item in results["batch"]:
+        print(f"批量并发{item['concurrency']}：{item['jobs_per_second']} 个/秒（成功{item['ok']}，失败{item['failed']}）")
+    print(f"结果已写入：{output_path}")
+
+if __name__ == "__main__":
+    main()
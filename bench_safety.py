@@ -0,0 +1,107 @@
+"""
+bench_safety.py
+内容审查吞吐量基准：在大量故事上测量自动机的构建耗时和扫描速度，并与逐词查找对比；
+词表越大，逐词查找越慢，自动机的扫描耗时基本不变
+"""
+
+import json
+import time
+import random
+import argparse
+from typing import List, Optional
+
+from fake_llm import FAKE_STORY_PARAGRAPH, FAKE_TRANSITION
+from safety_filter import DEFAULT_LEXICON, AhoCorasick
+
+# 生成语料时每个故事的段落数和混入词表词语的故事比例
+CORPUS_PARAGRAPHS = 8
+UNSAFE_RATIO = 0.05
+# 扩充词表时使用的常用汉字
+FILLER_CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严龙飞"
+
+def build_corpus(stories: int, seed: int = 0) -> List[str]:
+    """用模拟服务的故事段落拼出语料，其中一小部分故事混入词表中的词语"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(stories):
+        paragraphs = [FAKE_STORY_PARAGRAPH if rng.random() < 0.7 else FAKE_TRANSITION
+                      for _ in range(CORPUS_PARAGRAPHS)]
+        if rng.random() < UNSAFE_RATIO:
+            i = rng.randrange(len(paragraphs))
+            paragraphs[i] = paragraphs[i][:10] + rng.choice(DEFAULT_LEXICON) + paragraphs[i][10:]
+        corpus.append("\n\n".join(paragraphs))
+    return corpus
+
+def load_corpus(path: str) -> List[str]:
+    """读取真实的故事：批量生成的结果文件（每行一个 JSON，取 story 字段）或纯文本文件（故事之间空两行）"""
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".jsonl"):
+        return [json.loads(line).get("story", "") for line in content.splitlines() if line.strip()]
+    return [story for story in content.split("\n\n\n") if story.strip()]
+
+def expand_lexicon(size: int, seed: int = 0) -> List[str]:
+    """在内置词表之外补充随机的双字、三字词，模拟更大的词表"""
+    rng = random.Random(seed)
+    lexicon = list(DEFAULT_LEXICON)
+    while len(lexicon) < size:
+        lexicon.append("".join(rng.choice(FILLER_CHARS) for _ in range(rng.choice((2, 3)))))
+    return lexicon
+
+def naive_search(lexicon: List[str], text: str) -> List[str]:
+    """逐词查找：耗时与词表大小成正比"""
+    return [term for term in lexicon if term in text]
+
+def run_benchmark(corpus: List[str], lexicon_sizes: List[int], seed: int = 0) -> dict:
+    """对每个词表大小测量构建耗时和两种查找方式的吞吐量"""
+    chars = sum(len(story) for story in corpus)
+    results = []
+    for size in lexicon_sizes:
+        lexicon = expand_lexicon(size, seed)
+        start = time.perf_counter()
+        automaton = AhoCorasick(lexicon)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        flagged = sum(1 for story in corpus if automaton.search(story, first_only=True))
+        scan_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        naive_flagged = sum(1 for story in corpus if naive_search(lexicon, story))
+        naive_s = time.perf_counter() - start
+
+        results.append({
+            "lexicon_size": len(lexicon),
+            "states": len(automaton.goto),
+            "build_ms": round(build_ms, 2),
+            "scan_ms": round(scan_s * 1000, 1),
+            "chars_per_second": round(chars / scan_s) if scan_s else None,
+            "naive_ms": round(naive_s * 1000, 1),
+            "flagged": flagged,
+            "naive_flagged": naive_flagged
+        })
+    return {"stories": len(corpus), "chars": chars, "results": results}
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="内容审查吞吐量基准")
+    parser.add_argument("--stories", type=int, default=5000, help="生成的语料故事数")
+    parser.add_argument("--corpus", help="使用真实故事：batch.py 的结果文件（.jsonl）或空两行分隔的文本文件")
+    parser.add_argument("--lexicon-sizes", type=int, nargs="+", default=[len(DEFAULT_LEXICON), 500, 5000],
+                        help="测试的词表大小")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出结果")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus) if args.corpus else build_corpus(args.stories, args.seed)
+    result = run_benchmark(corpus, args.lexicon_sizes, args.seed)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(f"语料：{result['stories']}个故事，共{result['chars']}字")
+        for item in result["results"]:
+            print(f"词表{item['lexicon_size']}词（{item['states']}个状态，构建{item['build_ms']}ms）："
+                  f"自动机 {item['scan_ms']}ms（每秒{item['chars_per_second']}字），逐词查找 {item['naive_ms']}ms，"
+                  f"命中{item['flagged']}个故事")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+bench_startup.py
+启动耗时基准：用 python -X importtime 测量导入 main 的耗时，超出预算或提前导入重量级依赖时返回非零退出码
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import List, Optional
+
+# 导入 main 的耗时预算（毫秒）
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "300"))
+# 只有生成故事或合成语音时才应该导入的依赖
+HEAVY_MODULES = ["openai", "edge_tts", "aiohttp"]
+
+# 格式：import time: 自身耗时 | 累计耗时 | 缩进 + 模块名（微秒）
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( +)(\S+)\s*$")
+
+def measure_import(module: str = "main") -> dict:
+    """在新进程中导入模块一次，返回耗时（毫秒）、最慢的直接依赖和已导入的重量级依赖"""
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败：{result.stderr.strip().splitlines()[-1]}")
+
+    total_us = 0
+    children = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        # 子模块先于父模块输出：遇到其他顶层模块时清空，留下的缩进3个空格的就是被测模块的直接依赖
+        if len(indent) == 3:
+            children.append((int(cumulative), name))
+        elif len(indent) == 1:
+            if name == module:
+                total_us = int(cumulative)
+                break
+            children = []
+    children.sort(reverse=True)
+    return {
+        "total_ms": total_us / 1000,
+        "slowest": [{"module": name, "ms": us / 1000} for us, name in children[:5]],
+        "heavy_modules": [m for m in result.stdout.strip().split(",") if m]
+    }
+
+def run_benchmark(module: str = "main", runs: int = 5, budget_ms: float = STARTUP_BUDGET_MS) -> dict:
+    """多次测量取中位数，并与预算比较"""
+    samples = [measure_import(module) for _ in range(runs)]
+    totals = [sample["total_ms"] for sample in samples]
+    median = statistics.median(totals)
+    heavy = sorted({m for sample in samples for m in sample["heavy_modules"]})
+    return {
+        "module": module,
+        "runs": runs,
+        "median_ms": round(median, 1),
+        "min_ms": round(min(totals), 1),
+        "max_ms": round(max(totals), 1),
+        "budget_ms": budget_ms,
+        "slowest": samples[-1]["slowest"],
+        "heavy_modules": heavy,
+        "passed": median <= budget_ms and not heavy
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="启动耗时基准")
+    parser.add_argument("--module", default="main", help="要测量的模块")
+    parser.add_argument("--runs", type=int, default=5, help="测量次数")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_MS, help="耗时预算（毫秒）")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出结果")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.module, args.runs, args.budget)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(f"导入 {result['module']}：中位数 {result['median_ms']}ms（最快 {result['min_ms']}ms，"
+              f"最慢 {result['max_ms']}ms，预算 {result['budget_ms']}ms）")
+        for item in result["slowest"]:
+            print(f"  {item['module']}: {item['ms']:.1f}ms")
+        if result["heavy_modules"]:
+            print(f"启动时导入了重量级依赖：{', '.join(result['heavy_modules'])}")
+        print("通过" if result["passed"] else "未通过")
+    sys.exit(0 if result["passed"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+chapter_journal.py
+连续剧章节的预写日志：生成好的章节先追加写入日志再合并进连续剧记录，
+进程崩溃或网络中断后按（连续剧、章节号）恢复，不必重新付费生成
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，只能在进程内加锁
+    fcntl = None
+
+# 日志文件放在连续剧记录旁边；合并时日志文件会被替换，所以跨进程的锁加在单独的锁文件上
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+
+_lock = threading.Lock()
+
+def serial_key(serial_story: dict, household: str, child: str) -> str:
+    """连续剧的幂等标识：同一个孩子、场景、主角和故事梗概对应同一部连续剧"""
+    parts = [household, child, serial_story.get("setting"), serial_story.get("character"),
+             serial_story.get("story_summary")]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+def prompt_hash(prompt: str) -> str:
+    """提示词摘要：孩子的年龄段等条件变化后，日志中的章节不再适用"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+class ChapterJournal:
+    """追加写入的 JSONL 日志：chapter 记录一章的生成结果，commit 表示该章已经合并进连续剧"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        """同一进程内的线程和后台预生成进程都要互斥，否则合并期间别的进程追加的记录会丢失"""
+        with _lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + LOCK_SUFFIX, "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, record: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            # 落盘后才算写入成功
+            os.fsync(f.fileno())
+
+    def _replay(self) -> Dict[Tuple[str, int], dict]:
+        """重放日志，返回尚未合并的章节"""
+        pending = {}
+        if not os.path.exists(self.path):
+            return pending
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时写了一半的最后一行，忽略
+                    continue
+                if record.get("op") == "chapter":
+                    pending[(record["key"], record["chapter"])] = record
+                elif record.get("op") == "commit":
+                    for key in [k for k in pending if k[0] == record["key"] and k[1] <= record["chapter"]]:
+                        del pending[key]
+        return pending
+
+    def record(self, key: str, chapter_num: int, text: str, prompt_digest: str = None):
+        """记录生成好的章节"""
+        with self._locked():
+            self._append({
+                "op": "chapter", "key": key, "chapter": chapter_num, "prompt": prompt_digest,
+                "text": text, "ts": round(time.time(), 3)
+            })
+
+    def recover(self, key: str, chapter_num: int, prompt_digest: str = None) -> Optional[str]:
+        """返回日志中尚未合并的同一章；提示词不一致时视为没有"""
+        with self._locked():
+            record = self._replay().get((key, chapter_num))
+        if record and (prompt_digest is None or record.get("prompt") == prompt_digest):
+            return record["text"]
+        return None
+
+    def commit(self, key: str, up_to_chapter: int):
+        """连续剧保存成功后调用：第 up_to_chapter 章及之前的章节已合并；没有待合并的章节时清空日志"""
+        with self._locked():
+            pending = self._replay()
+            if not any(k[0] == key and k[1] <= up_to_chapter for k in pending):
+                return
+            self._append({"op": "commit", "key": key, "chapter": up_to_chapter, "ts": round(time.time(), 3)})
+            remaining = [r for k, r in pending.items() if not (k[0] == key and k[1] <= up_to_chapter)]
+            self._compact(remaining)
+
+    def pending(self) -> List[dict]:
+        """列出尚未合并的章节"""
+        with self._locked():
+            return list(self._replay().values())
+
+    def _compact(self, remaining: List[dict]):
+        """只保留尚未合并的章节，先写临时文件再替换，避免压缩过程中崩溃丢失记录"""
+        if not remaining:
+            os.remove(self.path)
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in remaining:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
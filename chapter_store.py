@@ -0,0 +1,113 @@
+"""
+chapter_store.py
+连续剧 JSON 文件的章节偏移索引：元数据不含章节正文即可读取，章节按偏移从 mmap 中按需解码
+"""
+
+import os
+import json
+import mmap
+from typing import List, Optional
+
+# 索引文件后缀和章节预览长度
+CHAPTER_INDEX_SUFFIX = ".idx"
+PREVIEW_CHARS = 100
+# 写入时代替章节数组的占位符
+_CHAPTERS_MARKER = "\x00chapters\x00"
+
+def make_preview(chapter: str) -> str:
+    """章节预览：超过 PREVIEW_CHARS 字时截断"""
+    return chapter[:PREVIEW_CHARS] + "..." if len(chapter) > PREVIEW_CHARS else chapter
+
+def write_serial_file(path: str, story: dict):
+    """按 json.dump(indent=2) 的格式写入连续剧，同时生成章节偏移索引"""
+    chapters = story.get("chapters", [])
+    text = json.dumps(dict(story, chapters=_CHAPTERS_MARKER), ensure_ascii=False, indent=2)
+    head, tail = text.split(json.dumps(_CHAPTERS_MARKER), 1)
+
+    data = bytearray(head.encode("utf-8"))
+    span_start = len(data)
+    offsets = []
+    if chapters:
+        data += b"[\n    "
+        for i, chapter in enumerate(chapters):
+            if i:
+                data += b",\n    "
+            encoded = json.dumps(chapter, ensure_ascii=False).encode("utf-8")
+            offsets.append([len(data), len(encoded)])
+            data += encoded
+        data += b"\n  ]"
+    else:
+        data += b"[]"
+    span_end = len(data)
+    data += tail.encode("utf-8")
+
+    # 先写数据再写索引，索引通过文件大小和修改时间校验是否仍然有效
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    stat = os.stat(path)
+    index = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "chapters_span": [span_start, span_end],
+        "chapters": offsets,
+        "previews": [make_preview(chapter) for chapter in chapters]
+    }
+    tmp_index = path + CHAPTER_INDEX_SUFFIX + ".tmp"
+    with open(tmp_index, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_index, path + CHAPTER_INDEX_SUFFIX)
+
+def load_index(path: str) -> Optional[dict]:
+    """读取章节索引；文件被其他方式修改过时索引作废"""
+    try:
+        with open(path + CHAPTER_INDEX_SUFFIX, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if index["size"] != stat.st_size or index["mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return index
+
+def load_serial_meta_file(path: str) -> Optional[dict]:
+    """读取连续剧元数据（不解码章节正文），附带章节数 chapter_count"""
+    if not os.path.exists(path):
+        return None
+    index = load_index(path)
+    if index is None:
+        # 没有可用索引时退回完整读取
+        with open(path, "r", encoding="utf-8") as f:
+            story = json.load(f)
+        story["chapter_count"] = len(story.pop("chapters", []))
+        return story
+    start, end = index["chapters_span"]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        meta = json.loads(mm[:start] + b"[]" + mm[end:])
+    meta.pop("chapters", None)
+    meta["chapter_count"] = len(index["chapters"])
+    return meta
+
+def read_chapters_file(path: str, start: int, count: int) -> List[str]:
+    """读取第 start 章起（从1开始）的 count 章正文"""
+    index = load_index(path)
+    if index is None:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("chapters", [])[start - 1:start - 1 + count]
+    selected = index["chapters"][start - 1:start - 1 + count]
+    if not selected:
+        return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return [json.loads(mm[offset:offset + length]) for offset, length in selected]
+
+def chapter_previews_file(path: str) -> List[str]:
+    """读取全部章节的预览，有索引时不读取正文"""
+    index = load_index(path)
+    if index is not None:
+        return index["previews"]
+    with open(path, "r", encoding="utf-8") as f:
+        return [make_preview(chapter) for chapter in json.load(f).get("chapters", [])]
@@ -0,0 +1,184 @@
+"""
+cli.py
+无交互命令行：全部参数通过命令行给出，适合定时任务或嵌入其他程序调用
+"""
+
+import sys
+import json
+import argparse
+import contextlib
+from typing import List, Optional
+
+from metrics import chapter_context, run_profiled, set_trace_file
+from serial_planner import SERIAL_PLAN_CONCURRENCY
+from service import SERVICE_HOST, SERVICE_PORT, StoryService, run_service
+from storage import STORY_CHILD, STORY_HOUSEHOLD
+from utils import VALID_SETTINGS
+
+def _add_child_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--household", default=STORY_HOUSEHOLD, help="家庭标识")
+    parser.add_argument("--child", default=STORY_CHILD, help="孩子标识")
+    parser.add_argument("--months", type=int, help="孩子月龄，不提供时使用保存的孩子信息")
+
+def _add_story_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--setting", required=True, choices=VALID_SETTINGS, help="故事场景")
+    parser.add_argument("--character", required=True, help="主角，如：小兔子贝贝")
+    parser.add_argument("--elements", required=True, help="故事元素，如：友谊、勇气")
+    parser.add_argument("--summary", help="故事概要，不提供时先生成概要再按 --pick 选择")
+    parser.add_argument("--pick", type=int, default=1, choices=[1, 2, 3], help="选择第几个生成的概要")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="儿童睡前故事生成器（无交互模式）")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出结果")
+    parser.add_argument("--trace", help="把每次AI调用和语音合成的耗时、token 用量追加到该 JSONL 文件")
+    parser.add_argument("--profile", help="用 cProfile 分析本次运行，结果保存到该文件")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    profile = subparsers.add_parser("profile", help="查看或设置孩子信息")
+    profile.add_argument("--household", default=STORY_HOUSEHOLD, help="家庭标识")
+    profile.add_argument("--child", default=STORY_CHILD, help="孩子标识")
+    profile.add_argument("--set-months", type=int, help="设置孩子当前月龄")
+    profile.add_argument("--gender", default="", help="孩子性别（男/女）")
+
+    summaries = subparsers.add_parser("summaries", help="生成三个故事概要")
+    _add_child_args(summaries)
+    summaries.add_argument("--setting", required=True, choices=VALID_SETTINGS, help="故事场景")
+    summaries.add_argument("--character", required=True, help="主角")
+    summaries.add_argument("--elements", required=True, help="故事元素")
+
+    story = subparsers.add_parser("story", help="生成单元剧故事")
+    _add_child_args(story)
+    _add_story_args(story)
+    story.add_argument("--audio", action="store_true", help="同时合成语音")
+
+    chapter = subparsers.add_parser("chapter", help="续写连续剧的下一章，或用 --new 开始新的连续剧")
+    _add_child_args(chapter)
+    chapter.add_argument("--new", action="store_true", help="开始新的连续剧")
+    chapter.add_argument("--setting", choices=VALID_SETTINGS, help="故事场景")
+    chapter.add_argument("--character", help="主角（--new 时必填）")
+    chapter.add_argument("--elements", help="故事元素（--new 时必填）")
+    chapter.add_argument("--summary", help="故事概要，不提供时先生成概要再按 --pick 选择")
+    chapter.add_argument("--pick", type=int, default=1, choices=[1, 2, 3], help="选择第几个生成的概要")
+    chapter.add_argument("--audio", action="store_true", help="同时合成语音")
+
+    plan = subparsers.add_parser("plan", help="大纲模式：先生成28章大纲，再并发生成整部连续剧")
+    _add_child_args(plan)
+    _add_story_args(plan)
+    plan.add_argument("--concurrency", type=int, default=SERIAL_PLAN_CONCURRENCY, help="同时生成的章节数")
+
+    audio = subparsers.add_parser("audio", help="把文本合成为语音")
+    audio.add_argument("--text", help="需要合成的文本")
+    audio.add_argument("--file", help="从文件读取需要合成的文本")
+    audio.add_argument("--prefix", default="story", help="语音文件名前缀")
+
+    serve = subparsers.add_parser("serve", help="启动 HTTP 服务")
+    serve.add_argument("--host", default=SERVICE_HOST, help="监听地址")
+    serve.add_argument("--port", type=int, default=SERVICE_PORT, help="监听端口")
+    return parser
+
+def _output(command: str, result: dict, as_json: bool):
+    if as_json:
+        print(json.dumps(result, ensure_ascii=False))
+    elif command == "summaries":
+        for i, summary in enumerate(result["summaries"], 1):
+            print(f"{i}. {summary}")
+    elif command == "plan":
+        for i, beat in enumerate(result["outline"], 1):
+            print(f"第{i}章：{beat}")
+        print(f"已生成并保存{result['chapters']}章")
+    elif command in ("story", "chapter"):
+        if command == "chapter":
+            print(f"=== 第{result['chapter_num']}章 ===")
+        print(result[command])
+        if result.get("audio_file"):
+            print(f"语音文件：{result['audio_file']}")
+    else:
+        for key, value in result.items():
+            print(f"{key}: {value}")
+
+def _pick_summary(service: StoryService, args) -> str:
+    if args.summary:
+        return args.summary
+    summaries = service.summaries(
+        args.setting, args.character, args.elements, args.months, args.household, args.child
+    )
+    return summaries[min(args.pick, len(summaries)) - 1]
+
+def run(args, service: Optional[StoryService] = None) -> dict:
+    """执行一个子命令并返回结果"""
+    service = service or StoryService()
+    if args.command == "profile":
+        if args.set_months is not None:
+            return service.set_profile(args.set_months, args.gender, args.household, args.child)
+        profile = service.get_profile(args.household, args.child)
+        if profile is None:
+            raise ValueError("没有孩子信息，请使用 --set-months 设置")
+        return profile
+
+    if args.command == "summaries":
+        return {"summaries": service.summaries(
+            args.setting, args.character, args.elements, args.months, args.household, args.child
+        )}
+
+    if args.command == "story":
+        summary = _pick_summary(service, args)
+        story = service.story(
+            args.setting, args.character, args.elements, summary, args.months, args.household, args.child
+        )
+        result = {"summary": summary, "story": story}
+        if args.audio:
+            result["audio_file"] = service.audio(story, "story")
+        return result
+
+    if args.command == "chapter":
+        if args.new:
+            if not (args.setting and args.character and args.elements):
+                raise ValueError("开始新的连续剧需要 --setting、--character 和 --elements")
+            summary = _pick_summary(service, args)
+            result = service.start_serial(
+                args.setting, args.character, args.elements, summary, args.months, args.household, args.child
+            )
+        else:
+            result = service.next_chapter(args.setting, args.months, args.household, args.child)
+        if args.audio:
+            with chapter_context(result["chapter_num"]):
+                result["audio_file"] = service.audio(result["chapter"], f"chapter{result['chapter_num']}")
+        return result
+
+    if args.command == "plan":
+        summary = _pick_summary(service, args)
+        return service.plan_serial(
+            args.setting, args.character, args.elements, summary, args.months, args.household, args.child,
+            args.concurrency
+        )
+
+    if args.command == "audio":
+        text = args.text
+        if args.file:
+            with open(args.file, "r", encoding="utf-8") as f:
+                text = f.read()
+        return {"audio_file": service.audio(text, args.prefix)}
+
+    raise ValueError(f"未知的命令：{args.command}")
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        set_trace_file(args.trace)
+    if args.command == "serve":
+        run_service(args.host, args.port)
+        return
+    try:
+        # 生成过程中的进度信息输出到 stderr，stdout 只留结果
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_profiled(lambda: run(args), args.profile)
+    except ValueError as e:
+        print(f"错误：{str(e)}", file=sys.stderr)
+        sys.exit(2)
+    except RuntimeError as e:
+        print(f"生成失败：{str(e)}", file=sys.stderr)
+        sys.exit(1)
+    _output(args.command, result, args.json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+fake_llm.py
+本地模拟的 OpenAI 兼容服务，用于批量生成等功能的离线测试
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+# 固定的概要模板，去掉空白后约50个字，落在40-60字的要求之内
+FAKE_SUMMARY = "{name}在{place}里发现一颗会发光的种子，和好朋友们一起细心照顾它，种子开出花朵照亮了回家的小路。"
+FAKE_STORY_PARAGRAPH = "月亮升起来了，小伙伴们手拉着手，慢慢走回温暖的家。大家互相说晚安，甜甜地进入了梦乡。"
+FAKE_OUTLINE_BEAT = "主角和朋友们在{place}里遇到第{num}个小难题，大家一起想办法解决，收获了新的友谊。"
+FAKE_TRANSITION = "上一次的冒险结束后，小伙伴们又迎来了新的一天。"
+FAKE_REWRITE = "小伙伴们手拉着手，一起度过了愉快的一天。"
+
+# 模拟服务端的前缀缓存：相同前缀至少1024个 token 才缓存，按128个 token 为单位命中
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+# 记住最近多少个请求的提示词
+CACHE_RECENT_PROMPTS = 256
+
+def cached_prefix_tokens(prompt: str, recent: "deque") -> int:
+    """与最近请求的最长相同前缀中可以命中缓存的 token 数（每个字符算一个 token）"""
+    longest = 0
+    for previous in recent:
+        n = 0
+        limit = min(len(prompt), len(previous))
+        while n < limit and prompt[n] == previous[n]:
+            n += 1
+        longest = max(longest, n)
+    return longest // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS if longest >= CACHE_MIN_TOKENS else 0
+
+def fake_completion_text(messages: list) -> str:
+    """根据请求内容生成确定性的回复"""
+    prompt = messages[-1]["content"] if messages else ""
+    if "故事概要" in prompt and "三个" in prompt:
+        return "\n".join(
+            f"{i}. " + FAKE_SUMMARY.format(name=f"小兔子{i}号", place="森林")
+            for i in range(1, 4)
+        )
+    if "大纲" in prompt:
+        # 首次请求“设计N章的大纲”，补充请求“接着写出第A章到第B章”
+        repair = re.search(r"第(\d+)章到第(\d+)章", prompt)
+        full = re.search(r"设计(\d+)章的大纲", prompt)
+        start, end = (int(repair.group(1)), int(repair.group(2))) if repair else (1, int(full.group(1)) if full else 28)
+        return "\n".join(f"{i}. " + FAKE_OUTLINE_BEAT.format(place="森林", num=i) for i in range(start, end + 1))
+    if "过渡句" in prompt:
+        return FAKE_TRANSITION
+    if "请改写" in prompt:
+        return FAKE_REWRITE
+    if "概括" in prompt or "合并" in prompt:
+        return "主角和朋友们一起经历了一段温暖的冒险。"
+    return "\n\n".join([FAKE_STORY_PARAGRAPH] * 8)
+
+def _count_tokens(text: str) -> int:
+    # 粗略估算：每个字符算一个 token
+    return len(text)
+
+class FakeChatHandler(BaseHTTPRequestHandler):
+    """处理 /chat/completions 请求，兼容 Azure 的部署路径"""
+
+    # 支持 keep-alive，同一连接可以处理多个请求
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # 统计建立过的连接数，用于检查客户端是否复用连接
+        with self.server.stats_lock:
+            self.server.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        messages = body.get("messages", [])
+        content = fake_completion_text(messages)
+        # 系统消息和用户消息依次拼接，作为前缀缓存的比较对象
+        prompt = "".join(f"{m.get('role')}:{m.get('content', '')}\n" for m in messages)
+        with self.server.stats_lock:
+            cached_tokens = cached_prefix_tokens(prompt, self.server.recent_prompts)
+            self.server.recent_prompts.append(prompt)
+        # 前 slow_requests 个请求按 slow_latency 延迟，模拟长尾慢请求
+        with self.server.stats_lock:
+            slow = self.server.slow_requests > 0
+            self.server.slow_requests -= slow
+        delay = self.server.slow_latency if slow else self.server.latency
+        if delay:
+            time.sleep(delay)
+
+        # 按设定的失败率返回服务端错误（随机数可复现）
+        with self.server.stats_lock:
+            failed = self.server.failure_rate and self.server.rng.random() < self.server.failure_rate
+        if failed:
+            payload = json.dumps({"error": {"code": "500", "message": "fake server error"}}).encode("utf-8")
+            self.send_response(500)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        prompt_tokens = sum(_count_tokens(m.get("content", "")) for m in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": _count_tokens(content),
+            "total_tokens": prompt_tokens + _count_tokens(content),
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)}
+        }
+        # 服务端记录每个请求的用量，流式请求也能统计
+        with self.server.stats_lock:
+            self.server.usage_log.append(usage)
+        created = int(time.time())
+        model = body.get("model", "fake-model")
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            # 流式回复没有 Content-Length，发送完毕后关闭连接
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            # 按句子分片返回，模拟流式输出
+            pieces = [piece + "。" for piece in content.split("。") if piece]
+            for piece in pieces:
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            final = {
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            }
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            return
+
+        payload = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class FakeServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # 对冲请求胜出或到达截止时间后客户端会断开慢请求的连接，不打印错误
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+def start_fake_server(port: int = 0, latency: float = 0.0, failure_rate: float = 0.0,
+                      seed: int = 0, slow_requests: int = 0, slow_latency: float = 0.0) -> Tuple[ThreadingHTTPServer, str]:
+    """在后台线程启动模拟服务，返回服务对象和访问地址"""
+    server = FakeServer(("127.0.0.1", port), FakeChatHandler)
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.slow_requests = slow_requests
+    server.slow_latency = slow_latency
+    server.rng = random.Random(seed)
+    server.usage_log = []
+    server.recent_prompts = deque(maxlen=CACHE_RECENT_PROMPTS)
+    server.connection_count = 0
+    server.stats_lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容服务")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的模拟延迟（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="返回服务端错误的比例（0-1）")
+    parser.add_argument("--seed", type=int, default=0, help="失败随机数种子")
+    args = parser.parse_args()
+
+    server, url = start_fake_server(args.port, args.latency, args.failure_rate, args.seed)
+    print(f"模拟服务已启动：{url}")
+    print(f"请设置 AZURE_OPENAI_ENDPOINT={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
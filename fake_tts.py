@@ -0,0 +1,46 @@
+"""
+fake_tts.py
+本地模拟的语音合成后端，延迟和失败率可配置，用于离线测试和基准测试
+"""
+
+import time
+import random
+import asyncio
+import threading
+from typing import List, Tuple
+
+from tts import TTSBackend
+
+# 模拟的 MP3 数据：ID3 头 + 文本内容
+FAKE_ID3_HEADER = b"ID3\x04\x00\x00\x00\x00\x00\x00"
+
+class FakeTTSBackend(TTSBackend):
+    """按（固定延迟 + 每字延迟）模拟合成耗时，按失败率抛出异常；记录每次成功合成的起止时间"""
+
+    def __init__(self, latency: float = 0.0, per_char: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.per_char = per_char
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: List[Tuple[float, float]] = []
+        self.failures = 0
+
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency + self.per_char * len(text))
+        with self._lock:
+            failed = self.failure_rate and self._rng.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            else:
+                self.calls.append((start, time.perf_counter()))
+        if failed:
+            raise RuntimeError("fake tts error")
+        return FAKE_ID3_HEADER + text.encode("utf-8")
+
+    def reset(self):
+        """清空调用记录"""
+        with self._lock:
+            self.calls.clear()
+            self.failures = 0
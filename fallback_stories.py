@@ -0,0 +1,184 @@
+"""
+fallback_stories.py
+备用故事：按（年龄段、场景）保存预生成的故事和各家庭生成成功的故事，
+生成超过截止时间或失败时用同一年龄段、同一场景的故事代替失败提示
+"""
+
+import os
+import json
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from prompt_builder import AGE_BUCKETS, prompt_fields
+from utils import VALID_SETTINGS
+
+# 是否保存和使用备用故事
+FALLBACK_STORIES_ENABLED = os.getenv("FALLBACK_STORIES", "0") == "1"
+# 备用故事记录文件
+FALLBACK_STORY_FILE = os.getenv("FALLBACK_STORY_FILE", "fallback_stories.json")
+# 每个（年龄段、场景）最多保留的故事数量，超出时丢弃最早的
+FALLBACK_MAX_PER_BUCKET = int(os.getenv("FALLBACK_MAX_PER_BUCKET", "5"))
+# 内存中最多保留几个家庭的故事（最近使用的），其余家庭用到时再读取各自的文件
+FALLBACK_CACHED_HOUSEHOLDS = int(os.getenv("FALLBACK_CACHED_HOUSEHOLDS", "64"))
+# 预生成时主角用占位符代替，取用时替换为真实主角
+CHARACTER_PLACEHOLDER = "【主角】"
+# 每个年龄段用于构建提示词的代表月龄
+BUCKET_MONTHS = {2: 24, 4: 48, 6: 72}
+# 预生成时使用的故事元素
+WARM_ELEMENTS = "友谊"
+
+class FallbackStories:
+    """按（年龄段、场景）分组的备用故事，每组只保留最近的几个。
+    预生成的故事主角是占位符，所有家庭共用（buckets，保存在 path 中）；生成成功的故事带有孩子的名字和故事元素，
+    只给同一个家庭使用，每个家庭单独保存一个文件，保存时只重写这个家庭的文件"""
+
+    def __init__(self, path: str = FALLBACK_STORY_FILE, max_per_bucket: int = FALLBACK_MAX_PER_BUCKET,
+                 max_households: int = FALLBACK_CACHED_HOUSEHOLDS):
+        self.path = path
+        self.max_per_bucket = max_per_bucket
+        self.max_households = max_households
+        self._lock = threading.Lock()
+        self._households: "OrderedDict[str, Dict[str, List[dict]]]" = OrderedDict()
+        self.data = {"buckets": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+            # 旧版本的记录不区分家庭，只保留其中预生成的故事
+            for key, stories in self.data["buckets"].items():
+                self.data["buckets"][key] = [e for e in stories if e["character"] == CHARACTER_PLACEHOLDER]
+            # 旧版本把所有家庭的故事放在同一个文件里，拆分到各家庭的文件
+            legacy = self.data.pop("households", None)
+            if legacy is not None:
+                for household, groups in legacy.items():
+                    if not os.path.exists(self.household_file(household)):
+                        self._write(self.household_file(household), groups)
+                self._write(self.path, self.data)
+
+    @staticmethod
+    def bucket_key(bucket: int, setting: str) -> str:
+        _, age_display, _, _, _ = AGE_BUCKETS[bucket]
+        return f"{age_display}|{setting}"
+
+    def household_file(self, household: str) -> str:
+        """家庭自己的备用故事文件，与 path 放在同一目录"""
+        tag = hashlib.sha1(household.encode("utf-8")).hexdigest()[:16]
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.{tag}{ext}"
+
+    @staticmethod
+    def _write(path: str, data: dict):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def _household(self, household: str) -> Dict[str, List[dict]]:
+        """返回这个家庭的故事（按分组），需要时从文件读取；内存中只保留最近使用的几个家庭"""
+        groups = self._households.get(household)
+        if groups is not None:
+            self._households.move_to_end(household)
+            return groups
+        groups = {}
+        path = self.household_file(household)
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    groups = json.load(f)
+            except (OSError, ValueError):
+                groups = {}
+        self._households[household] = groups
+        while len(self._households) > self.max_households:
+            self._households.popitem(last=False)
+        return groups
+
+    def remember(self, prompt: str, story: str, household: Optional[str] = None):
+        """保存一个生成成功的故事：预生成的故事所有家庭共用，其他故事只保存到 household 名下；
+        没有 household 或不是模板生成的提示词（如连续剧章节）时忽略"""
+        fields = prompt_fields(prompt)
+        if not fields or not story:
+            return
+        bucket, setting, character = fields
+        if character != CHARACTER_PLACEHOLDER and household is None:
+            return
+        with self._lock:
+            if character == CHARACTER_PLACEHOLDER:
+                path, data, groups = self.path, self.data, self.data["buckets"]
+            else:
+                groups = self._household(household)
+                path, data = self.household_file(household), groups
+            stories = groups.setdefault(self.bucket_key(bucket, setting), [])
+            if any(entry["story"] == story for entry in stories):
+                return
+            stories.append({"character": character, "story": story})
+            del stories[:-self.max_per_bucket]
+            try:
+                self._write(path, data)
+            except OSError as e:
+                # 保存失败不影响本次已生成的故事
+                print(f"保存备用故事失败：{str(e)}")
+
+    def pick(self, prompt: str, household: Optional[str] = None) -> Optional[str]:
+        """从预生成的故事和这个家庭自己的故事中取一个同一年龄段、同一场景的，并把原来的主角换成提示词中的主角"""
+        fields = prompt_fields(prompt)
+        if not fields:
+            return None
+        bucket, setting, character = fields
+        key = self.bucket_key(bucket, setting)
+        with self._lock:
+            stories = list(self.data["buckets"].get(key, []))
+            if household is not None:
+                stories += self._household(household).get(key, [])
+        if not stories:
+            return None
+        entry = random.choice(stories)
+        return entry["story"].replace(entry["character"], character) if entry["character"] else entry["story"]
+
+    def count(self, bucket: int, setting: str) -> int:
+        """预生成的故事数量"""
+        with self._lock:
+            return len(self.data["buckets"].get(self.bucket_key(bucket, setting), []))
+
+    def warm(self, settings=VALID_SETTINGS, per_bucket: int = 1):
+        """为每个年龄段和场景预生成故事，已有足够故事的组合跳过"""
+        # 延迟导入：story_generator 生成故事时也会用到本模块
+        from story_generator import STORY_FAILURE_MESSAGE, build_prompt, generate_story
+        for display, months in BUCKET_MONTHS.items():
+            for setting in settings:
+                prompt = build_prompt(months, CHARACTER_PLACEHOLDER, WARM_ELEMENTS, setting)
+                bucket = prompt_fields(prompt)[0]
+                for _ in range(per_bucket - self.count(bucket, setting)):
+                    print(f"预生成备用故事：{display}岁 / {setting}")
+                    # 不使用全局备用故事，生成结果只保存到这里
+                    story = generate_story(prompt, use_fallback=False)
+                    if story == STORY_FAILURE_MESSAGE:
+                        break
+                    self.remember(prompt, story)
+
+_stories: Optional[FallbackStories] = None
+_stories_lock = threading.Lock()
+
+def get_fallback_stories() -> Optional[FallbackStories]:
+    """返回全局备用故事；未启用时返回 None"""
+    global _stories
+    if not FALLBACK_STORIES_ENABLED:
+        return None
+    with _stories_lock:
+        if _stories is None:
+            _stories = FallbackStories()
+        return _stories
+
+def main():
+    parser = argparse.ArgumentParser(description="预生成备用故事")
+    parser.add_argument("--file", default=FALLBACK_STORY_FILE, help="备用故事记录文件")
+    parser.add_argument("--per-bucket", type=int, default=1, help="每个年龄段和场景预生成的故事数量")
+    args = parser.parse_args()
+    stories = FallbackStories(args.file)
+    stories.warm(per_bucket=args.per_bucket)
+    print(f"备用故事已保存到 {args.file}")
+
+if __name__ == "__main__":
+    main()
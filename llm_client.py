@@ -0,0 +1,262 @@
+"""
+llm_client.py
+共享的 Azure OpenAI 客户端：整个进程复用同一个连接池（keep-alive），超时和重试策略统一配置
+openai 在第一次创建客户端时才导入，只重置信息或阅读旧故事时不必承担它的导入开销
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Deque, Dict, Optional
+
+from dotenv import load_dotenv
+
+from metrics import note_attempt, record_event, record_usage, span
+
+if TYPE_CHECKING:
+    from openai import AzureOpenAI, AsyncAzureOpenAI
+
+# 只在这里加载一次环境变量；其他模块在导入时读取配置，所以 .env 不能延迟加载
+load_dotenv()
+
+# 请求超时（秒）：总超时和建立连接的超时
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# SDK 内置重试次数（连接错误、429、5xx 时按指数退避重试）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# 连接池大小和空闲连接保持时间（秒）
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+# 对冲请求：首个请求超过该操作近期延迟的某个分位数仍未返回时，再发出一个相同的请求
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE", "1") != "0"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+# 延迟样本不足时，对冲等待时间取该值（秒）和按 max_tokens 估计的生成时间中较大的一个，
+# 避免正常生成中的长故事被当作慢请求重复计费
+LLM_HEDGE_DEFAULT_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_SECONDS", "15"))
+LLM_HEDGE_TOKENS_PER_SECOND = float(os.getenv("LLM_HEDGE_TOKENS_PER_SECOND", "40"))
+# 一次调用最多同时发出的请求数（含首个请求；失败后的补发也计入），默认只对冲一次
+LLM_HEDGE_MAX_REQUESTS = int(os.getenv("LLM_HEDGE_MAX_REQUESTS", "2"))
+# 计算分位数所需的最少样本数和保留的样本数
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# 单个故事的总截止时间（秒），包含对冲和失败后的补发
+STORY_DEADLINE_SECONDS = float(os.getenv("STORY_DEADLINE_SECONDS", "45"))
+# 连续剧章节没有备用内容，截止时间更长，与原来的请求超时加两次重试相当
+CHAPTER_DEADLINE_SECONDS = float(os.getenv("CHAPTER_DEADLINE_SECONDS", "180"))
+
+_lock = threading.Lock()
+_client: Optional["AzureOpenAI"] = None
+_async_client: Optional["AsyncAzureOpenAI"] = None
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+# 每种操作最近的成功请求延迟（秒）
+_latencies: Dict[str, Deque[float]] = {}
+# 当前调用使用的请求限流器（批量生成时设置）
+_request_limiter = contextvars.ContextVar("request_limiter", default=None)
+
+class TokenBucket:
+    """线程安全的令牌桶限流器，控制对 Azure 部署的 HTTP 请求速率"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int = 1) -> float:
+        """预订令牌，返回还需等待的秒数；令牌不足时先记欠账，之后的请求依次排在后面"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(-self.tokens / self.rate, 0.0)
+
+    def acquire(self, tokens: int = 1):
+        """等待直到取得足够的令牌"""
+        time.sleep(self.reserve(tokens))
+
+def call_with_limiter(limiter: Optional[TokenBucket], func, *args):
+    """在限流器下执行 func：其间发出的每个 HTTP 请求（包括 SDK 重试和对冲请求）都先取一个令牌"""
+    token = _request_limiter.set(limiter)
+    try:
+        return func(*args)
+    finally:
+        _request_limiter.reset(token)
+
+def get_deployment() -> str:
+    """当前使用的模型部署名称"""
+    return os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+
+def _client_options() -> dict:
+    return {
+        "azure_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION"),
+        "max_retries": LLM_MAX_RETRIES,
+    }
+
+def _on_request(request):
+    note_attempt()
+    limiter = _request_limiter.get()
+    if limiter:
+        limiter.acquire()
+
+async def _on_request_async(request):
+    note_attempt()
+    limiter = _request_limiter.get()
+    if limiter:
+        import asyncio
+        await asyncio.sleep(limiter.reserve())
+
+def _pool_options() -> dict:
+    from openai import Timeout
+    try:
+        from httpx import Limits
+    except ImportError:
+        # 较新的 openai 版本改用 httpx2 作为底层 HTTP 库
+        from httpx2 import Limits
+    return {
+        "timeout": Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        "limits": Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_SECONDS
+        ),
+    }
+
+def get_client() -> "AzureOpenAI":
+    """返回全局同步客户端，多线程共享同一个连接池"""
+    global _client
+    with _lock:
+        if _client is None:
+            from openai import AzureOpenAI, DefaultHttpxClient
+            # 每发出一次 HTTP 请求计数一次，用于统计 SDK 内部的重试次数
+            http_client = DefaultHttpxClient(event_hooks={"request": [_on_request]}, **_pool_options())
+            _client = AzureOpenAI(http_client=http_client, **_client_options())
+        return _client
+
+def get_async_client() -> "AsyncAzureOpenAI":
+    """返回全局异步客户端，供 asyncio 代码使用"""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+            http_client = DefaultAsyncHttpxClient(event_hooks={"request": [_on_request_async]}, **_pool_options())
+            _async_client = AsyncAzureOpenAI(http_client=http_client, **_client_options())
+        return _async_client
+
+def create_chat_completion(operation: str, chapter: Optional[int] = None, **kwargs):
+    """发起一次非流式对话请求，记录耗时、token 用量和重试次数；chapter 为连续剧章节号"""
+    attrs = {"chapter": chapter} if chapter is not None else {}
+    with span("llm", operation, **attrs) as event:
+        response = get_client().chat.completions.create(**kwargs)
+        record_usage(event, getattr(response, "usage", None))
+    return response
+
+def record_latency(operation: str, seconds: float):
+    """记录一次成功请求的延迟，用于计算对冲等待时间"""
+    with _lock:
+        _latencies.setdefault(operation, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+def hedge_delay(operation: str, max_tokens: Optional[int] = None) -> float:
+    """首个请求等待多久仍未返回时发出对冲请求：近期延迟的 LLM_HEDGE_PERCENTILE 分位数；
+    样本不足时按 max_tokens 估计生成时间"""
+    with _lock:
+        samples = sorted(_latencies.get(operation, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return max(LLM_HEDGE_DEFAULT_SECONDS, (max_tokens or 0) / LLM_HEDGE_TOKENS_PER_SECOND)
+    index = min(int(len(samples) * LLM_HEDGE_PERCENTILE / 100), len(samples) - 1)
+    return samples[index]
+
+def completion_deadline(max_tokens: int, minimum: float) -> float:
+    """截止时间（秒）：不少于 minimum，也不少于按 max_tokens 估计的生成时间的两倍"""
+    return max(minimum, 2 * max_tokens / LLM_HEDGE_TOKENS_PER_SECOND)
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONNECTIONS, thread_name_prefix="llm-hedge")
+        return _hedge_executor
+
+def _record_hedge_loser(operation: str, chapter: Optional[int], future):
+    """没被采用的请求无法中途取消，返回后仍记录它的耗时和 token 用量"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    response, seconds = future.result()
+    usage = {}
+    record_usage(usage, getattr(response, "usage", None))
+    record_event("llm", f"{operation}_hedge_loser", seconds * 1000, chapter=chapter, **usage)
+
+def hedged_chat_completion(operation: str, deadline: float, chapter: Optional[int] = None, **kwargs):
+    """在截止时刻 deadline（time.monotonic() 的时间）之前完成的非流式对话请求。
+    首个请求超过 hedge_delay 仍未返回时再发出一个相同的请求，取先成功的结果；
+    某个请求失败时立即补发，不再使用 SDK 的退避重试。到达截止时刻仍没有结果时抛出 TimeoutError。
+    没被采用的请求返回后记为 <operation>_hedge_loser"""
+    attrs = {"chapter": chapter} if chapter is not None else {}
+    with span("llm", operation, **attrs) as event:
+        def attempt():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"{operation} 已超过截止时间")
+            start = time.perf_counter()
+            client = get_client().with_options(timeout=remaining, max_retries=0)
+            response = client.chat.completions.create(**kwargs)
+            seconds = time.perf_counter() - start
+            record_latency(operation, seconds)
+            return response, seconds
+
+        executor = _get_hedge_executor()
+        max_requests = LLM_HEDGE_MAX_REQUESTS if LLM_HEDGE_ENABLED else 1
+        delay = hedge_delay(operation, kwargs.get("max_tokens"))
+        pending = set()
+        launched = 0
+        next_launch = time.monotonic()
+        last_error = None
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            # 首个请求、对冲时间已到或前面的请求都已失败时发出新请求
+            if launched < max_requests and (not pending or now >= next_launch):
+                # 每个请求在各自的上下文副本中执行，埋点仍然记在本次调用上
+                pending.add(executor.submit(contextvars.copy_context().run, attempt))
+                launched += 1
+                next_launch = now + delay
+                continue
+            if not pending:
+                break
+            until = min(deadline, next_launch) if launched < max_requests else deadline
+            done, pending = wait(pending, timeout=max(until - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    event["hedged"] = launched > 1
+                    response, _ = future.result()
+                    record_usage(event, getattr(response, "usage", None))
+                    for loser in list(done - {future}) + list(pending):
+                        loser.add_done_callback(lambda f: _record_hedge_loser(operation, chapter, f))
+                    return response
+                last_error = future.exception()
+        event["hedged"] = launched > 1
+        # 超过截止时间仍在进行的请求同样计费
+        for late in pending:
+            late.add_done_callback(lambda f: _record_hedge_loser(operation, chapter, f))
+        if last_error and not pending:
+            raise last_error
+        raise TimeoutError(f"{operation} 在截止时间内没有完成")
+
+def reset_clients():
+    """关闭同步客户端并丢弃全部客户端，下次使用时按当前环境变量重新创建；
+    之前记录的请求延迟属于旧的服务，一并清空"""
+    global _client, _async_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        # 异步客户端需要在事件循环中关闭，这里只丢弃引用
+        _client = None
+        _async_client = None
+        _latencies.clear()
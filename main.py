@@ -3,14 +3,37 @@ from datetime import datetime
 
 # 导入各个模块
 from user_profile import load_or_init_child_info, reset_child_info
-from story_generator import build_prompt, select_story_summary, generate_story
+from story_generator import build_prompt, build_story_prompt, select_story_summary, generate_story, remember_story
 from serial_story import (
     load_serial_story, save_serial_story, show_serial_story_info, 
-    generate_serial_story_chapter, SERIAL_STORY_FILE
+    generate_chapter_journaled, update_story_memory, SERIAL_STORY_FILE,
+    load_serial_meta, read_serial_story, get_chapter_count, get_chapters, update_serial_meta
 )
-from tts import generate_audio_file
+from tts import generate_audio_file, audio_cache_key
+from metrics import chapter_context, run_profiled
+from story_pipeline import generate_story_with_audio
+from summary_pool import POOL_EXIT_WAIT, SUMMARY_POOL_ENABLED, get_summary_pool
+from speculative import SPECULATIVE_ENABLED, SpeculativeStoryGenerator
+from prefetch import SERIAL_PREFETCH_ENABLED, get_pending_chapter, start_prefetch_process
+from storage import STORY_HOUSEHOLD
 from utils import get_setting_choice, get_story_type, get_character_info, get_story_elements
 
+def offer_chapter_audio(serial_story: dict):
+    """重读连续剧时按章节提供语音，合成过的章节直接使用缓存的文件"""
+    total = get_chapter_count(serial_story)
+    choice = input(f"\n需要收听哪一章的语音？(1-{total}，直接回车跳过)：").strip()
+    if not choice.isdigit() or not 1 <= int(choice) <= total:
+        return
+    chapter_num = int(choice)
+    # 只读取选中的章节
+    chapter = get_chapters(serial_story, chapter_num, 1)[0]
+    with chapter_context(chapter_num):
+        generate_audio_file(chapter, f"chapter{chapter_num}")
+    # 记录章节对应的语音缓存键
+    chapter_audio = dict(serial_story.get('chapter_audio', {}))
+    chapter_audio[str(chapter_num)] = audio_cache_key(chapter)
+    update_serial_meta(serial_story, chapter_audio=chapter_audio)
+
 def main():
     try:
         # 检查是否需要重置信息
@@ -28,8 +51,8 @@ def main():
         # 场景选择
         setting = get_setting_choice()
         
-        # 检查是否有未完成的连续剧
-        serial_story = load_serial_story()
+        # 检查是否有未完成的连续剧（只读取元数据，章节正文按需加载）
+        serial_story = load_serial_meta(setting)
         
         # 如果选择了连续剧，并且有未完成的故事，且场景相同
         if story_type == 2 and serial_story and serial_story['setting'] == setting:
@@ -58,17 +81,15 @@ def main():
                 if choice == 1:  # 重新阅读
                     print("\n=== 完整故事内容 ===")
                     print(f"\n故事梗概：\n{serial_story['story_summary']}\n")
-                    for i, chapter in enumerate(serial_story['chapters'], 1):
-                        print(f"\n第{i}章：")
-                        print(chapter)
+                    read_serial_story(serial_story)
+                    offer_chapter_audio(serial_story)
                     return
                 
                 elif choice == 3:  # 查看完整故事
                     print("\n=== 完整故事内容 ===")
                     print(f"\n故事梗概：\n{serial_story['story_summary']}\n")
-                    for i, chapter in enumerate(serial_story['chapters'], 1):
-                        print(f"\n第{i}章：")
-                        print(chapter)
+                    read_serial_story(serial_story)
+                    offer_chapter_audio(serial_story)
                     return
                 
                 # 如果选择2（生成新故事）或不是相同的故事类型，继续执行下面的代码
@@ -89,31 +110,46 @@ def main():
                         print("请输入有效的数字。")
                 
                 if choice == 1:  # 继续故事
+                    # 续写需要完整记录
+                    serial_story = load_serial_story(setting)
                     # 使用已保存的角色和场景信息
                     character = serial_story['character']
                     elements = serial_story['elements']
                     base_prompt = build_prompt(current_months, character, elements, setting)
                     
-                    # 生成下一章
-                    chapter = generate_serial_story_chapter(
-                        base_prompt,
-                        serial_story['current_chapter'] + 1,
-                        serial_story['chapters'],
-                        serial_story['story_summary']
-                    )
+                    # 有预生成的下一章时直接使用
+                    pending = get_pending_chapter(serial_story, current_months)
+                    serial_story.pop('pending', None)
+                    if pending:
+                        print(f"\n[预生成] 第{pending['chapter_num']}章已提前准备好。")
+                        chapter = pending['chapter']
+                    else:
+                        # 旧记录没有章节摘要时补齐一次，之后只摘要新章节
+                        update_story_memory(serial_story)
+                        
+                        # 生成下一章；上次生成后未能保存的章节直接从预写日志恢复
+                        chapter = generate_chapter_journaled(
+                            serial_story, base_prompt, serial_story['current_chapter'] + 1
+                        )
                     if chapter:
                         serial_story['chapters'].append(chapter)
                         serial_story['current_chapter'] += 1
+                        update_story_memory(serial_story)
+                        if pending and pending.get('audio_file'):
+                            serial_story.setdefault('chapter_audio', {})[str(serial_story['current_chapter'])] = audio_cache_key(chapter)
                         save_serial_story(serial_story)
                         print(f"\n=== 第{serial_story['current_chapter']}章 ===\n{chapter}\n")
+                        if pending and pending.get('audio_file') and os.path.exists(pending['audio_file']):
+                            print(f"本章语音已提前生成：{pending['audio_file']}")
+                        if SERIAL_PREFETCH_ENABLED:
+                            start_prefetch_process()
                     return
                 
                 elif choice == 3:  # 查看完整故事
                     print("\n=== 完整故事内容 ===")
                     print(f"\n故事梗概：\n{serial_story['story_summary']}\n")
-                    for i, chapter in enumerate(serial_story['chapters'], 1):
-                        print(f"\n第{i}章：")
-                        print(chapter)
+                    read_serial_story(serial_story)
+                    offer_chapter_audio(serial_story)
                     return
         
         # 输入主角信息
@@ -123,21 +159,57 @@ def main():
         # 生成基础prompt
         base_prompt = build_prompt(current_months, character, elements, setting)
 
+        # 启用概要池时优先展示预生成的概要，池中不足时在后台补充
+        summary_pool = get_summary_pool() if SUMMARY_POOL_ENABLED else None
+        summary_source = None
+        if summary_pool:
+            summary_source = lambda: summary_pool.take(
+                current_months, setting, elements, character, household=STORY_HOUSEHOLD
+            )
+
         if story_type == 1:  # 单元剧
+            # 启用推测生成时，概要一展示就在后台同时生成三个完整故事
+            speculative = SpeculativeStoryGenerator(base_prompt) if SPECULATIVE_ENABLED else None
+            
             # 选择故事概要
-            selected_summary = select_story_summary(base_prompt)
+            selected_summary = select_story_summary(
+                base_prompt, summary_source, speculative.start if speculative else None, household=STORY_HOUSEHOLD
+            )
+            if not selected_summary:
+                if speculative:
+                    speculative.shutdown()
+                return
             
             # 根据选择的概要生成完整故事
-            final_prompt = base_prompt + f"\n请根据以下故事概要展开创作：\n{selected_summary}"
+            final_prompt = build_story_prompt(base_prompt, selected_summary)
 
-            print("\n正在生成故事，请稍候...\n")
-            story = generate_story(final_prompt)
-            print("=== 睡前故事 ===\n" + story + "\n")
-            
-            # 询问是否需要语音合成
+            # 询问是否需要语音合成，需要时边生成故事边合成语音
             tts_choice = input("是否需要将故事转换为语音？(y/n)：").strip().lower()
-            if tts_choice == 'y':
-                generate_audio_file(story, "story")
+            
+            # 选定后只保留对应的推测结果，其余两个立即取消
+            story = None
+            if speculative:
+                story = speculative.take(selected_summary)
+                speculative.shutdown()
+            
+            if story:
+                print("\n=== 睡前故事 ===\n" + story + "\n")
+                if tts_choice == 'y':
+                    generate_audio_file(story, "story")
+                remember_story(final_prompt, story, STORY_HOUSEHOLD)
+            elif tts_choice == 'y':
+                print("\n=== 睡前故事 ===\n")
+                story, _ = generate_story_with_audio(final_prompt, "story")
+                remember_story(final_prompt, story, STORY_HOUSEHOLD)
+            else:
+                # generate_story 自己记录生成的故事
+                print("\n正在生成故事，请稍候...\n")
+                story = generate_story(final_prompt, household=STORY_HOUSEHOLD)
+                print("=== 睡前故事 ===\n" + story + "\n")
+            
+            # 稍等后台补充概要池，已生成的概要下次可以直接使用
+            if summary_pool:
+                summary_pool.wait(POOL_EXIT_WAIT)
         
         else:  # 连续剧
             # 开始新的连续剧
@@ -145,7 +217,9 @@ def main():
             print("注意：连续剧共28章，每章都会保持故事的连贯性。")
             
             # 选择故事概要
-            selected_summary = select_story_summary(base_prompt)
+            selected_summary = select_story_summary(base_prompt, summary_source, household=STORY_HOUSEHOLD)
+            if not selected_summary:
+                return
             
             # 创建新的连续剧
             serial_story = {
@@ -154,13 +228,16 @@ def main():
                 "elements": elements,
                 "current_chapter": 1,
                 "chapters": [],
-                "story_summary": selected_summary
+                "story_summary": selected_summary,
+                "chapter_summaries": [],
+                "arc_summaries": []
             }
             
             # 生成第一章
-            chapter = generate_serial_story_chapter(base_prompt, 1, [], selected_summary)
+            chapter = generate_chapter_journaled(serial_story, base_prompt, 1)
             if chapter:
                 serial_story['chapters'].append(chapter)
+                update_story_memory(serial_story)
                 save_serial_story(serial_story)
                 print("\n=== 第1章 ===\n" + chapter + "\n")
                 
@@ -168,6 +245,14 @@ def main():
                 tts_choice = input("是否需要将这一章转换为语音？(y/n)：").strip().lower()
                 if tts_choice == 'y':
                     generate_audio_file(chapter, "chapter1")
+                    serial_story.setdefault('chapter_audio', {})["1"] = audio_cache_key(chapter)
+                    save_serial_story(serial_story)
+                # 最后一次保存之后再开始预生成，否则上面的保存会覆盖预生成写入的下一章
+                if SERIAL_PREFETCH_ENABLED:
+                    start_prefetch_process()
+            
+            if summary_pool:
+                summary_pool.wait(POOL_EXIT_WAIT)
             return
 
     except ValueError as e:
@@ -177,4 +262,5 @@ def main():
         print("请检查网络连接和API配置是否正确。")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    # 设置 STORY_PROFILE 时用 cProfile 分析本次运行
+    run_profiled(main) 
\ No newline at end of file
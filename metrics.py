@@ -0,0 +1,198 @@
+"""
+metrics.py
+热路径埋点：记录每次AI调用和语音合成的耗时、token 用量、重试次数、缓存命中和章节号，
+输出为 JSONL 追踪文件或 Prometheus 文本格式，并支持用 cProfile 分析单次运行
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Callable, Dict, Iterator, Optional
+
+# 设置后每次调用追加一行 JSON 到该文件
+TRACE_FILE = os.getenv("STORY_TRACE_FILE")
+# 设置后用 cProfile 分析整个运行，结果保存到该文件
+PROFILE_FILE = os.getenv("STORY_PROFILE")
+# 耗时直方图的分桶上限（毫秒）
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+# 当前正在执行的调用，以及当前章节号
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_chapter = contextvars.ContextVar("current_chapter", default=None)
+
+class Metrics:
+    """按（类型、名称）汇总调用指标，同时把每个事件写入追踪文件"""
+
+    def __init__(self, trace_file: Optional[str] = None):
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self._calls: Dict[tuple, dict] = {}
+        self._cache: Dict[tuple, int] = {}
+
+    def record(self, event: dict):
+        """汇总一次调用，并写入追踪文件"""
+        key = (event["kind"], event["name"])
+        with self._lock:
+            stats = self._calls.setdefault(key, {
+                "count": 0, "errors": 0, "ms_sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS_MS),
+                "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "retries": 0
+            })
+            stats["count"] += 1
+            stats["errors"] += event.get("status") == "error"
+            stats["ms_sum"] += event["ms"]
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if event["ms"] <= bound:
+                    stats["buckets"][i] += 1
+            stats["prompt_tokens"] += event.get("prompt_tokens", 0)
+            stats["completion_tokens"] += event.get("completion_tokens", 0)
+            stats["cached_tokens"] += event.get("cached_tokens", 0)
+            stats["retries"] += event.get("retries", 0)
+            self._write(event)
+
+    def record_cache(self, cache: str, hit: bool):
+        """记录一次缓存查询"""
+        with self._lock:
+            key = (cache, "hit" if hit else "miss")
+            self._cache[key] = self._cache.get(key, 0) + 1
+            self._write({"kind": "cache", "name": cache, "hit": hit, "chapter": _current_chapter.get(),
+                         "ts": round(time.time(), 3)})
+
+    def _write(self, event: dict):
+        if not self.trace_file:
+            return
+        with open(self.trace_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def snapshot(self) -> dict:
+        """返回汇总结果"""
+        with self._lock:
+            return {
+                "calls": {f"{kind}.{name}": dict(stats, buckets=list(stats["buckets"]))
+                          for (kind, name), stats in self._calls.items()},
+                "cache": {f"{cache}.{result}": count for (cache, result), count in self._cache.items()}
+            }
+
+    def render_prometheus(self) -> str:
+        """以 Prometheus 文本格式输出汇总结果"""
+        lines = [
+            "# TYPE story_call_duration_ms histogram",
+            "# TYPE story_call_errors_total counter",
+            "# TYPE story_tokens_total counter",
+            "# TYPE story_retries_total counter",
+            "# TYPE story_cache_requests_total counter",
+        ]
+        with self._lock:
+            for (kind, name), stats in sorted(self._calls.items()):
+                labels = f'kind="{kind}",name="{name}"'
+                for bound, count in zip(LATENCY_BUCKETS_MS, stats["buckets"]):
+                    lines.append(f'story_call_duration_ms_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'story_call_duration_ms_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+                lines.append(f'story_call_duration_ms_sum{{{labels}}} {stats["ms_sum"]:.3f}')
+                lines.append(f'story_call_duration_ms_count{{{labels}}} {stats["count"]}')
+                lines.append(f'story_call_errors_total{{{labels}}} {stats["errors"]}')
+                lines.append(f'story_tokens_total{{{labels},type="prompt"}} {stats["prompt_tokens"]}')
+                lines.append(f'story_tokens_total{{{labels},type="completion"}} {stats["completion_tokens"]}')
+                lines.append(f'story_tokens_total{{{labels},type="cached"}} {stats["cached_tokens"]}')
+                lines.append(f'story_retries_total{{{labels}}} {stats["retries"]}')
+            for (cache, result), count in sorted(self._cache.items()):
+                lines.append(f'story_cache_requests_total{{cache="{cache}",result="{result}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """清空汇总结果"""
+        with self._lock:
+            self._calls.clear()
+            self._cache.clear()
+
+_metrics = Metrics(TRACE_FILE)
+
+def get_metrics() -> Metrics:
+    """返回全局指标实例"""
+    return _metrics
+
+def set_trace_file(path: Optional[str]):
+    """修改追踪文件路径，None 表示不写追踪文件"""
+    _metrics.trace_file = path
+
+@contextlib.contextmanager
+def span(kind: str, name: str, **attrs) -> Iterator[dict]:
+    """记录一次调用的耗时和结果；调用过程中可以向返回的字典补充 token 用量等信息"""
+    event = {"kind": kind, "name": name, "chapter": _current_chapter.get(), "retries": 0, "attempts": 0}
+    event.update(attrs)
+    token = _current_span.set(event)
+    start = time.perf_counter()
+    try:
+        yield event
+        event.setdefault("status", "ok")
+    except BaseException as e:
+        event["status"] = "error"
+        event["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        event["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        event["ts"] = round(time.time(), 3)
+        _metrics.record(event)
+
+def record_event(kind: str, name: str, ms: float, **attrs):
+    """记录一次无法用 span 包住的调用（例如跨越多次 yield 的流式输出）"""
+    event = {"kind": kind, "name": name, "chapter": _current_chapter.get(), "status": "ok"}
+    event.update(attrs)
+    event["ms"] = round(ms, 3)
+    event["ts"] = round(time.time(), 3)
+    _metrics.record(event)
+
+def note_attempt():
+    """当前调用又发出了一次 HTTP 请求；第二次起计为重试"""
+    event = _current_span.get()
+    if event is not None:
+        event["attempts"] += 1
+        event["retries"] = max(event["attempts"] - 1, 0)
+
+def record_usage(event: dict, usage):
+    """从回复的 usage 字段中记录 token 用量"""
+    if usage is None:
+        return
+    event["prompt_tokens"] = getattr(usage, "prompt_tokens", 0) or 0
+    event["completion_tokens"] = getattr(usage, "completion_tokens", 0) or 0
+    # 服务端命中前缀缓存的提示词 token 数，不支持缓存的服务没有这个字段
+    details = getattr(usage, "prompt_tokens_details", None)
+    event["cached_tokens"] = getattr(details, "cached_tokens", 0) or 0
+
+def cached_token_ratio(snapshot: dict, kind: str = "llm") -> float:
+    """提示词 token 中命中服务端前缀缓存的比例"""
+    calls = [stats for name, stats in snapshot["calls"].items() if name.startswith(kind + ".")]
+    prompt_tokens = sum(stats["prompt_tokens"] for stats in calls)
+    cached_tokens = sum(stats["cached_tokens"] for stats in calls)
+    return round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0
+
+def record_cache(cache: str, hit: bool):
+    """记录一次缓存查询"""
+    _metrics.record_cache(cache, hit)
+
+@contextlib.contextmanager
+def chapter_context(chapter_num: Optional[int]) -> Iterator[None]:
+    """在此范围内记录的调用都带上章节号"""
+    token = _current_chapter.set(chapter_num)
+    try:
+        yield
+    finally:
+        _current_chapter.reset(token)
+
+def run_profiled(func: Callable, profile_file: Optional[str] = PROFILE_FILE, top: int = 25):
+    """设置了分析文件时用 cProfile 运行 func，保存结果并在 stderr 打印最耗时的函数"""
+    if not profile_file:
+        return func()
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_file)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(top)
+        print(f"性能分析结果已保存为：{profile_file}", file=sys.stderr)
@@ -0,0 +1,94 @@
+"""
+prefetch.py
+连续剧预生成：保存第N章后在后台生成第N+1章及其语音，第二天直接使用
+"""
+
+import os
+import sys
+import subprocess
+from datetime import datetime
+from typing import Optional
+
+from story_generator import build_prompt, convert_months_to_prompt_info
+from serial_story import (
+    load_serial_story, save_serial_story, generate_chapter_journaled, update_story_memory
+)
+from tts import generate_audio_file
+from user_profile import get_current_months
+
+# 是否在保存章节后自动预生成下一章
+SERIAL_PREFETCH_ENABLED = os.getenv("SERIAL_PREFETCH", "0") == "1"
+
+def get_pending_chapter(serial_story: dict, months: int) -> Optional[dict]:
+    """返回可以直接使用的预生成章节；章节号不对或年龄段已变化时作废"""
+    pending = serial_story.get('pending')
+    if not pending:
+        return None
+    age_display, _, _ = convert_months_to_prompt_info(months)
+    if pending['chapter_num'] != serial_story['current_chapter'] + 1:
+        print("[预生成] 预生成的章节与当前进度不符，已作废")
+    elif pending['age_display'] != age_display:
+        print("[预生成] 孩子的年龄段已变化，预生成的章节已作废")
+    else:
+        return pending
+    serial_story.pop('pending', None)
+    return None
+
+def prefetch_next_chapter(with_audio: bool = True) -> Optional[dict]:
+    """生成下一章及其语音，作为待用章节保存到连续剧记录中"""
+    serial_story = load_serial_story()
+    months = get_current_months()
+    if not serial_story or months is None:
+        print("没有找到连续剧或孩子信息记录，无需预生成。")
+        return None
+
+    chapter_num = serial_story['current_chapter'] + 1
+    if chapter_num > 28:
+        print("故事已经完成28章，无需预生成。")
+        return None
+    if get_pending_chapter(serial_story, months):
+        print(f"第{chapter_num}章已经预生成，无需重复生成。")
+        return serial_story['pending']
+
+    age_display, _, _ = convert_months_to_prompt_info(months)
+    base_prompt = build_prompt(months, serial_story['character'], serial_story['elements'], serial_story['setting'])
+    update_story_memory(serial_story)
+    # 章节先写入预写日志，语音合成期间崩溃也不会丢失
+    chapter = generate_chapter_journaled(serial_story, base_prompt, chapter_num)
+    if not chapter:
+        return None
+    audio_file = generate_audio_file(chapter, f"chapter{chapter_num}") if with_audio else None
+
+    # 生成期间进度可能已经变化，重新读取后再写入
+    latest = load_serial_story(serial_story['setting'])
+    if (not latest or latest['current_chapter'] + 1 != chapter_num
+            or latest['setting'] != serial_story['setting']
+            or latest.get('serial_id') != serial_story.get('serial_id')):
+        print("连续剧进度已变化，放弃本次预生成结果。")
+        return None
+    latest['chapter_summaries'] = serial_story['chapter_summaries']
+    latest['arc_summaries'] = serial_story['arc_summaries']
+    latest['pending'] = {
+        "chapter_num": chapter_num,
+        "chapter": chapter,
+        "audio_file": audio_file,
+        "age_display": age_display,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    save_serial_story(latest)
+    print(f"第{chapter_num}章已预生成并保存。")
+    return latest['pending']
+
+def start_prefetch_process():
+    """在独立的后台进程中预生成下一章，主程序退出后仍会继续"""
+    script = os.path.abspath(__file__)
+    subprocess.Popen(
+        [sys.executable, script],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    print("[预生成] 已在后台开始准备下一章及其语音。")
+
+if __name__ == "__main__":
+    prefetch_next_chapter()
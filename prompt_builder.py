@@ -0,0 +1,142 @@
+"""
+prompt_builder.py
+提示词组装：按年龄段和场景预编译的模板、本地 token 估算、按优先级裁剪上下文，以及根据字数要求推导 max_tokens
+"""
+
+import os
+import re
+import math
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+# 提示词（不含回复）的 token 预算，超出时先裁掉较旧的章节全文
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+# 每个中文字符大约占用的 token 数，随模型的分词器而不同
+TOKENS_PER_CJK_CHAR = float(os.getenv("TOKENS_PER_CJK_CHAR", "1.0"))
+# 模型常常写得比字数要求略多，回复的 token 上限按字数上限留出余量
+COMPLETION_MARGIN = 1.25
+# 无法从提示词判断字数要求时使用的回复上限
+DEFAULT_MAX_TOKENS = 1024
+
+# 年龄段：（最大月龄，显示年龄，最少字数，最多字数，风格要求），最后一档没有月龄上限
+AGE_BUCKETS = [
+    (36, 2, 400, 600, "- 使用非常简单的词汇和句子\n- 重复句式，有节奏感，适合朗读\n- 内容温柔，没有复杂情节"),
+    (60, 4, 600, 1000, "- 语言简单清晰，加入基础情节\n- 有角色简单互动和因果关系\n- 风格温和、结局温馨"),
+    (None, 6, 1000, 1500, "- 故事情节稍复杂，加入冲突与解决\n- 增加对话和情感表达\n- 故事结构完整，寓意积极向上"),
+]
+
+# 字数要求这一行同时用来从提示词中识别年龄段
+WORD_LIMIT_LINE = "- 字数控制在{min_chars} 到 {max_chars}字之间"
+# 服务端按前缀缓存提示词：所有请求都相同的规则放在最前面，其次是年龄段和场景，
+# 每次请求不同的主角和故事元素放在最后，相同前缀越长，命中缓存的 token 越多
+PROMPT_TEMPLATE = """你是一个有爱心的儿童故事作家，擅长创作睡前故事。\n
+请严格遵守以下要求：
+- 内容积极健康，适合儿童阅读
+- 结局温馨美好
+- 不要包含恐怖、暴力、消极等内容
+- 用中文输出故事，分段清晰，适合朗读
+{word_limit_line}
+{style_notes}\n
+这次的故事写给一个{age_display}岁的孩子。\n故事发生在：{setting}。\n
+故事主角名字叫：{{character}}。\n故事应包含元素：{{elements}}。\n"""
+
+# 中日韩文字和全角标点，每个字单独计 token；其他字符大约4个计1个 token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# 从模板生成的提示词中取回主角和场景
+CHARACTER_PATTERN = re.compile(r"故事主角名字叫：(.*?)。\n")
+SETTING_PATTERN = re.compile(r"故事发生在：(.*?)。\n")
+
+def get_age_bucket(months: int) -> int:
+    """返回月龄所在年龄段的下标"""
+    for i, (max_months, _, _, _, _) in enumerate(AGE_BUCKETS):
+        if max_months is None or months <= max_months:
+            return i
+    return len(AGE_BUCKETS) - 1
+
+def word_limit_text(bucket: int) -> str:
+    """年龄段的字数范围，如“600 到 1000”"""
+    _, _, min_chars, max_chars, _ = AGE_BUCKETS[bucket]
+    return f"{min_chars} 到 {max_chars}"
+
+@lru_cache(maxsize=None)
+def compiled_template(bucket: int, setting: str) -> str:
+    """预编译年龄段和场景固定的部分，只留下主角和故事元素待填入"""
+    _, age_display, min_chars, max_chars, style_notes = AGE_BUCKETS[bucket]
+    return PROMPT_TEMPLATE.format(
+        age_display=age_display,
+        # 场景文本中的花括号需要转义，避免第二次格式化时被当作占位符
+        setting=setting.replace("{", "{{").replace("}", "}}"),
+        word_limit_line=WORD_LIMIT_LINE.format(min_chars=min_chars, max_chars=max_chars),
+        style_notes=style_notes
+    )
+
+def render_prompt(months: int, character: str, elements: str, setting: str) -> str:
+    """用预编译的模板生成故事提示词"""
+    return compiled_template(get_age_bucket(months), setting).format(character=character, elements=elements)
+
+def count_tokens(text: str) -> int:
+    """本地估算 token 数，不调用任何服务"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return math.ceil(cjk * TOKENS_PER_CJK_CHAR + (len(text) - cjk) / 4)
+
+def max_tokens_for_chars(max_chars: int) -> int:
+    """写满 max_chars 个字需要的回复 token 上限"""
+    return math.ceil(max_chars * TOKENS_PER_CJK_CHAR * COMPLETION_MARGIN)
+
+def char_ceiling(prompt: str) -> Optional[int]:
+    """从提示词中的字数要求得到字数上限，没有字数要求时返回 None"""
+    for _, _, min_chars, max_chars, _ in AGE_BUCKETS:
+        if WORD_LIMIT_LINE.format(min_chars=min_chars, max_chars=max_chars) in prompt:
+            return max_chars
+    return None
+
+def prompt_fields(prompt: str) -> Optional[Tuple[int, str, str]]:
+    """从模板生成的提示词中取回（年龄段下标，场景，主角），不是模板生成的提示词时返回 None"""
+    character = CHARACTER_PATTERN.search(prompt)
+    setting = SETTING_PATTERN.search(prompt)
+    if not character or not setting:
+        return None
+    for i, (_, _, min_chars, max_chars, _) in enumerate(AGE_BUCKETS):
+        if WORD_LIMIT_LINE.format(min_chars=min_chars, max_chars=max_chars) in prompt:
+            return i, setting.group(1), character.group(1)
+    return None
+
+def completion_budget(prompt: str) -> int:
+    """根据提示词中的字数要求推导回复的 max_tokens，幼儿的短故事不必预留完整的1024个 token"""
+    max_chars = char_ceiling(prompt)
+    return max_tokens_for_chars(max_chars) if max_chars else DEFAULT_MAX_TOKENS
+
+# 提示词片段：（文本，优先级，分组标题）。优先级0为必需内容，数字越大越先被裁掉；
+# 同一优先级先裁掉靠前（更早）的片段。相邻的同组片段共用一个标题
+PromptSection = Tuple[str, int, str]
+
+def fit_sections(sections: List[PromptSection], budget: Optional[int] = None) -> List[PromptSection]:
+    """按优先级裁剪片段，直到总 token 数不超过预算；必需内容不裁剪"""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    kept = list(sections)
+    total = count_tokens(render_sections(kept))
+    # 可裁剪的片段：优先级高的在前，同优先级按原顺序
+    candidates = sorted(
+        (i for i, (_, priority, _) in enumerate(sections) if priority > 0),
+        key=lambda i: (-sections[i][1], i)
+    )
+    dropped = set()
+    for i in candidates:
+        if total <= budget:
+            break
+        dropped.add(i)
+        kept = [section for j, section in enumerate(sections) if j not in dropped]
+        total = count_tokens(render_sections(kept))
+    return kept
+
+def render_sections(sections: List[PromptSection]) -> str:
+    """拼接片段：不同片段之间空一行，同组片段放在同一个标题下"""
+    parts = []
+    last_group = None
+    for text, _, group in sections:
+        if group and group == last_group:
+            parts[-1] += "\n" + text
+        else:
+            parts.append(f"{group}：\n{text}" if group else text)
+        last_group = group
+    return "\n\n".join(parts)
@@ -0,0 +1,175 @@
+"""
+response_cache.py
+AI回复的本地磁盘缓存：按请求内容哈希寻址，按大小和时间淘汰
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
+from typing import Optional
+
+# 缓存目录，未设置时不启用缓存
+CACHE_DIR = os.getenv("STORY_CACHE_DIR")
+# 缓存总大小上限（MB）和最长保存天数
+CACHE_MAX_MB = float(os.getenv("STORY_CACHE_MAX_MB", "50"))
+CACHE_MAX_AGE_DAYS = float(os.getenv("STORY_CACHE_MAX_AGE_DAYS", "30"))
+# 每个请求最多缓存几个不同的回复，命中时从中随机挑选
+CACHE_VARIANTS = int(os.getenv("STORY_CACHE_VARIANTS", "1"))
+
+def make_cache_key(deployment: str, system_message: str, user_prompt: str,
+                   temperature: float, top_p: float, max_tokens: int) -> str:
+    """根据请求参数计算缓存键"""
+    payload = json.dumps(
+        [deployment, system_message, user_prompt, temperature, top_p, max_tokens],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """按内容寻址的回复缓存，每个键对应一个 JSON 文件，文件修改时间即最近访问时间；
+    过期和淘汰都按最近访问时间计算，批量生成和服务的多个线程可以共用一个实例"""
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_age: float, variants: int = 1):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.variants = max(variants, 1)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _entry_paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+    def _load(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+        except OSError:
+            pass
+
+    def _expired(self, path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(path) > self.max_age
+        except OSError:
+            return False
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存；超过 max_age 未被访问的条目视为过期；缓存的回复数量还不够时视为未命中，以便补充新的回复"""
+        path = self._path(key)
+        with self._lock:
+            if self._expired(path):
+                self._remove(path)
+            entry = self._load(key)
+            if not entry or len(entry["variants"]) < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            try:
+                # 更新修改时间，作为最近访问时间参与过期和淘汰
+                os.utime(path)
+            except OSError:
+                pass
+        return random.choice(entry["variants"])
+
+    def put(self, key: str, content: str):
+        """写入一个回复，写满后按大小淘汰最久未访问的条目；写入失败只打印错误，不影响已生成的回复"""
+        try:
+            with self._lock:
+                self._put(key, content)
+        except OSError as e:
+            print(f"写入回复缓存失败：{str(e)}")
+
+    def _put(self, key: str, content: str):
+        path = self._path(key)
+        entry = self._load(key) or {"variants": []}
+        if content in entry["variants"]:
+            return
+        entry["variants"] = (entry["variants"] + [content])[-self.variants:]
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        # 每次写入使用独立的临时文件，其他进程同时写同一个键时不会替换成对方写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.total_bytes += os.path.getsize(path) - old_size
+
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def evict(self):
+        """删除过期条目，再按最近访问时间从旧到新删除，直到总大小低于上限"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for path in self._entry_paths():
+            mtime = os.path.getmtime(path)
+            if now - mtime > self.max_age:
+                self._remove(path)
+            else:
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+
+    def stats(self) -> dict:
+        """返回命中统计"""
+        with self._lock:
+            hits, misses, total_bytes = self.hits, self.misses, self.total_bytes
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "bytes": total_bytes
+        }
+
+_response_cache = None
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """返回全局缓存实例，未配置 STORY_CACHE_DIR 时返回 None"""
+    global _response_cache
+    if _response_cache is None and CACHE_DIR:
+        _response_cache = ResponseCache(
+            CACHE_DIR,
+            int(CACHE_MAX_MB * 1024 * 1024),
+            CACHE_MAX_AGE_DAYS * 24 * 3600,
+            CACHE_VARIANTS
+        )
+    return _response_cache
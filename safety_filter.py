@@ -0,0 +1,241 @@
+"""
+safety_filter.py
+内容安全审查：用 Aho-Corasick 多模式自动机在本地检查生成的故事是否含有恐怖、暴力、消极的词语，
+在合成语音和保存之前只重写出问题的段落；流式输出按句检查
+"""
+
+import os
+import re
+import time
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from llm_client import create_chat_completion, get_deployment
+from metrics import record_event
+from utils import SentenceSplitter, split_sentences
+
+# 是否审查生成的内容
+SAFETY_FILTER_ENABLED = os.getenv("SAFETY_FILTER", "1") != "0"
+# 自定义词表文件：每行一个词，# 开头为注释；其中的词追加到内置词表
+SAFETY_LEXICON_FILE = os.getenv("SAFETY_LEXICON_FILE", "")
+# 一段内容最多重写几次，仍不合格时放弃
+SAFETY_MAX_REWRITES = int(os.getenv("SAFETY_MAX_REWRITES", "2"))
+
+# 内置词表：睡前故事里不应出现的恐怖、暴力和消极的词语
+DEFAULT_LEXICON = [
+    # 恐怖
+    "恐怖", "吓死", "鬼魂", "厉鬼", "僵尸", "恶魔", "魔鬼", "吸血鬼", "尸体", "血淋淋", "阴森",
+    # 暴力
+    "杀死", "杀掉", "杀人", "打死", "砍死", "刺死", "咬死", "鲜血", "流血", "枪杀", "折磨", "虐待",
+    # 消极
+    "自杀", "去死", "笨蛋", "蠢货", "废物", "滚开", "没人爱你", "抛弃你",
+]
+
+REWRITE_SYSTEM_MESSAGE = "你是一个儿童故事编辑，负责把不适合儿童的内容改写得温和、积极。"
+REWRITE_INSTRUCTIONS = (
+    "下面这段儿童睡前故事含有不适合儿童的词语（{terms}）。请改写这段内容，去掉这些词语和相关情节，"
+    "保持原来的情节走向和语气，字数相近，只输出改写后的内容。\n{context}要改写的内容：{text}"
+)
+REWRITE_CONTEXT = "这段内容紧接在“{prefix}”之后，已经讲过的部分不要重复。\n"
+
+# 段落分隔：流式输出中的换行
+PARAGRAPH_BREAK = re.compile(r"(\n+)")
+
+# 匹配结果：（开始下标，结束下标，词语）
+Match = Tuple[int, int, str]
+
+class AhoCorasick:
+    """多模式匹配自动机：构建一次，之后每次查找只需扫描文本一遍，与词表大小无关"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # 每个状态结束的全部词语（包括沿失败指针可达的后缀），查找时不必再回溯
+        self.output: List[List[str]] = [[]]
+        for pattern in patterns:
+            if pattern:
+                self._add(pattern.lower())
+        self._build()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        if pattern not in self.output[state]:
+            self.output[state].append(pattern)
+
+    def _build(self):
+        """按层次遍历计算失败指针"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, target in self.goto[state].items():
+                queue.append(target)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[target] = self.goto[fallback].get(char, 0)
+                self.output[target] = self.output[target] + self.output[self.fail[target]]
+
+    def search(self, text: str, first_only: bool = False) -> List[Match]:
+        """返回文本中出现的全部词语；first_only 时找到第一个就返回"""
+        goto, fail, output = self.goto, self.fail, self.output
+        matches = []
+        state = 0
+        for i, char in enumerate(text.lower()):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                matches.extend((i + 1 - len(term), i + 1, term) for term in output[state])
+                if first_only:
+                    break
+        return matches
+
+def load_lexicon(path: str = SAFETY_LEXICON_FILE) -> List[str]:
+    """内置词表加上自定义词表文件中的词"""
+    terms = list(DEFAULT_LEXICON)
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                term = line.strip()
+                if term and not term.startswith("#"):
+                    terms.append(term)
+    return terms
+
+_filter: Optional[AhoCorasick] = None
+_filter_lock = threading.Lock()
+
+def get_safety_filter() -> AhoCorasick:
+    """全局自动机，第一次使用时按词表构建，之后复用"""
+    global _filter
+    with _filter_lock:
+        if _filter is None:
+            _filter = AhoCorasick(load_lexicon())
+        return _filter
+
+def find_unsafe(text: str) -> List[str]:
+    """返回文本中出现的词表词语（去重，按出现顺序）"""
+    terms = []
+    for _, _, term in get_safety_filter().search(text):
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+def rewrite_text(text: str, terms: List[str], prefix: str = "") -> Optional[str]:
+    """请AI改写一段不合格的内容；prefix 是同一段中已经输出、不能再改的部分"""
+    context = REWRITE_CONTEXT.format(prefix=prefix) if prefix else ""
+    try:
+        response = create_chat_completion(
+            "safety_rewrite",
+            model=get_deployment(),
+            messages=[
+                {"role": "system", "content": REWRITE_SYSTEM_MESSAGE},
+                {"role": "user", "content": REWRITE_INSTRUCTIONS.format(terms="、".join(terms), context=context, text=text)}
+            ],
+            max_tokens=max(len(text) * 2, 200),
+            temperature=0.7,
+            top_p=0.95
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"改写内容失败：{str(e)}")
+        return None
+
+Rewriter = Callable[[str, List[str], str], Optional[str]]
+
+def rewrite_until_safe(text: str, prefix: str = "", rewrite: Rewriter = rewrite_text) -> Optional[str]:
+    """反复改写直到不再命中词表，超过 SAFETY_MAX_REWRITES 次仍不合格时返回 None"""
+    terms = find_unsafe(text)
+    for _ in range(SAFETY_MAX_REWRITES):
+        if not terms:
+            return text
+        print(f"\n[内容审查] 发现不适合儿童的词语：{'、'.join(terms)}，正在改写这一段...")
+        text = rewrite(text, terms, prefix)
+        if not text:
+            return None
+        terms = find_unsafe(text)
+    return None if terms else text
+
+def screen_story(text: str, rewrite: Rewriter = rewrite_text) -> Optional[str]:
+    """审查完整的故事或章节：只重写命中词表的段落；某一段改写后仍不合格时返回 None"""
+    if not SAFETY_FILTER_ENABLED or not text:
+        return text
+    start = time.perf_counter()
+    paragraphs = text.split("\n")
+    rewritten = 0
+    for i, paragraph in enumerate(paragraphs):
+        if not paragraph.strip() or not get_safety_filter().search(paragraph, first_only=True):
+            continue
+        safe = rewrite_until_safe(paragraph, rewrite=rewrite)
+        if safe is None:
+            record_event("safety", "screen", (time.perf_counter() - start) * 1000, chars=len(text),
+                         rewritten=rewritten, rejected=True)
+            return None
+        paragraphs[i] = safe
+        rewritten += 1
+    record_event("safety", "screen", (time.perf_counter() - start) * 1000, chars=len(text),
+                 rewritten=rewritten, rejected=False)
+    return "\n".join(paragraphs)
+
+class StreamScreen:
+    """流式审查：逐句检查，已经通过的句子立即输出；某句命中词表时暂停输出，
+    等这一段结束后只改写本段从该句开始的部分。改写后仍不合格的部分直接略去"""
+
+    def __init__(self, rewrite: Rewriter = rewrite_text):
+        self.rewrite = rewrite
+        self.splitter = SentenceSplitter()
+        # 本段已经输出的句子和暂停输出的句子
+        self.spoken: List[str] = []
+        self.held: List[str] = []
+        self.rewritten = 0
+        self.dropped = 0
+
+    def feed(self, text: str) -> List[str]:
+        """输入模型输出的片段，返回可以输出的句子和段落分隔"""
+        if not SAFETY_FILTER_ENABLED:
+            return [text] if text else []
+        out = []
+        for piece in PARAGRAPH_BREAK.split(text):
+            if not piece:
+                continue
+            if piece.startswith("\n"):
+                out += self._end_paragraph()
+                out.append(piece)
+            else:
+                for sentence in self.splitter.feed(piece):
+                    out += self._sentence(sentence)
+        return out
+
+    def flush(self) -> List[str]:
+        """输出结束时调用，处理最后一段"""
+        return self._end_paragraph() if SAFETY_FILTER_ENABLED else []
+
+    def _sentence(self, sentence: str) -> List[str]:
+        if self.held or get_safety_filter().search(sentence, first_only=True):
+            self.held.append(sentence)
+            return []
+        self.spoken.append(sentence)
+        return [sentence]
+
+    def _end_paragraph(self) -> List[str]:
+        out = []
+        for sentence in self.splitter.flush():
+            out += self._sentence(sentence)
+        if self.held:
+            safe = rewrite_until_safe("".join(self.held), "".join(self.spoken), self.rewrite)
+            if safe is None:
+                print("\n[内容审查] 改写后仍不合格，已略去这部分内容")
+                self.dropped += 1
+            else:
+                self.rewritten += 1
+                out += split_sentences(safe)
+        self.spoken = []
+        self.held = []
+        return out
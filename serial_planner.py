@@ -0,0 +1,216 @@
+"""
+serial_planner.py
+大纲模式：先把故事梗概扩展为28章的大纲，再按各章的大纲并发生成全部章节，
+最后用一次轻量的衔接检查让相邻章节自然过渡。适合一次生成整部连续剧（存档、礼物版）
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from llm_client import create_chat_completion, get_deployment
+from prompt_builder import completion_budget
+from safety_filter import find_unsafe, screen_story
+from serial_story import ARC_SIZE
+from utils import split_sentences
+
+# 连续剧总章数
+SERIAL_CHAPTERS = 28
+# 同时生成的章节数
+SERIAL_PLAN_CONCURRENCY = int(os.getenv("SERIAL_PLAN_CONCURRENCY", "8"))
+# 生成大纲最多调用AI的次数（第二次只补充缺少的章节）
+MAX_OUTLINE_CALLS = 2
+# 每章大纲约40字，回复上限按章数计算
+OUTLINE_TOKENS_PER_BEAT = 80
+
+CHAPTER_SYSTEM_MESSAGE = "你是一个专业的儿童故事作家，擅长创作连续剧式的故事。请确保故事适合儿童阅读，内容积极向上。"
+OUTLINE_SYSTEM_MESSAGE = "你是一个专业的儿童故事策划人，擅长为连续剧设计结构清晰、前后呼应的章节大纲。"
+OUTLINE_INSTRUCTIONS = (
+    "\n请根据以下故事梗概设计{count}章的大纲（上面的字数要求指每一章正文的字数）：\n{summary}\n"
+    "要求：\n1. 用数字编号（1. 2. 3. ...）逐章列出，每章一行\n2. 每章用一句话（30-50字）写出本章的主要情节\n"
+    "3. 第1章介绍主要角色和背景，最后一章圆满结局\n4. 章节之间情节连贯，埋下的伏笔在后面得到回应"
+)
+OUTLINE_REPAIR_INSTRUCTIONS = (
+    "\n故事梗概：\n{summary}\n已有的章节大纲：\n{existing}\n"
+    "请接着写出第{start}章到第{end}章的大纲，用数字编号（{start}. {next}. ...）逐章列出，每章一行，每章一句话（30-50字）"
+)
+TRANSITION_INSTRUCTIONS = (
+    "下面是第{prev}章的结尾和第{num}章的开头。请写一到两句承上启下的过渡句放在第{num}章开头，"
+    "使两章自然衔接，不要重复原文，只输出过渡句。\n第{prev}章结尾：{tail}\n第{num}章开头：{head}"
+)
+
+# 大纲的一项：“12. ”“12、”等编号，之后直到下一个编号之前的内容都属于这一章
+OUTLINE_ITEM_PATTERN = re.compile(r"^\s*(\d+)\s*[.、．)）:：](.*?)(?=^\s*\d+\s*[.、．)）:：]|\Z)", re.M | re.S)
+
+def parse_outline_items(content: str) -> Dict[int, str]:
+    """解析带编号的大纲，返回 {章节号: 情节}；编号和情节一起匹配，内容为空的章节不出现在结果中"""
+    items = {}
+    for match in OUTLINE_ITEM_PATTERN.finditer(content):
+        lines = [line.strip() for line in match.group(2).splitlines() if line.strip()]
+        if lines:
+            items.setdefault(int(match.group(1)), " ".join(lines))
+    return items
+
+def parse_outline(content: str) -> List[str]:
+    """解析带编号的大纲，按编号顺序返回每章的情节"""
+    items = parse_outline_items(content)
+    return [items[num] for num in sorted(items)]
+
+def generate_outline(base_prompt: str, story_summary: str, chapters: int = SERIAL_CHAPTERS) -> Optional[List[str]]:
+    """把故事梗概扩展为每章一句话的大纲；数量不足时只请求缺少的章节，仍不足时返回 None"""
+    beats = []
+    for _ in range(MAX_OUTLINE_CALLS):
+        missing = chapters - len(beats)
+        if beats:
+            existing = "\n".join(f"{i}. {beat}" for i, beat in enumerate(beats, 1))
+            instructions = OUTLINE_REPAIR_INSTRUCTIONS.format(
+                summary=story_summary, existing=existing, start=len(beats) + 1, next=len(beats) + 2, end=chapters
+            )
+        else:
+            instructions = OUTLINE_INSTRUCTIONS.format(count=chapters, summary=story_summary)
+        try:
+            response = create_chat_completion(
+                "outline",
+                model=get_deployment(),
+                messages=[
+                    {"role": "system", "content": OUTLINE_SYSTEM_MESSAGE},
+                    {"role": "user", "content": base_prompt + instructions}
+                ],
+                max_tokens=OUTLINE_TOKENS_PER_BEAT * missing,
+                temperature=0.7,
+                top_p=0.95
+            )
+            # 只接收从下一章起编号连续的情节，缺少的章节由下一次调用补充，不会错位
+            items = parse_outline_items(response.choices[0].message.content)
+            while len(beats) < chapters and len(beats) + 1 in items:
+                beats.append(items[len(beats) + 1])
+        except Exception as e:
+            print(f"生成大纲失败：{str(e)}")
+        if len(beats) >= chapters:
+            print(f"已生成{chapters}章大纲")
+            return beats
+    print(f"大纲章数不足（当前{len(beats)}章）")
+    return None
+
+def build_beat_prompt(base_prompt: str, story_summary: str, outline: List[str], chapter_num: int) -> str:
+    """按大纲构建章节提示词，不依赖其他章节的正文。各章共用的提示词、梗概和完整大纲在前，
+    并发生成的各章可以命中服务端的前缀缓存；本章及前后相邻章节的情节放在最后"""
+    total = len(outline)
+    prompt = f"{base_prompt}\n\n故事梗概：\n{story_summary}"
+    prompt += "\n\n各章情节：\n" + "\n".join(f"第{i}章：{beat}" for i, beat in enumerate(outline, 1))
+    prompt += f"\n\n这是第{chapter_num}章，总共{total}章。"
+    prompt += f"\n\n本章情节：\n{outline[chapter_num - 1]}"
+    if chapter_num > 1:
+        prompt += f"\n\n上一章情节：\n{outline[chapter_num - 2]}"
+    if chapter_num < total:
+        prompt += f"\n\n下一章情节：\n{outline[chapter_num]}"
+    if chapter_num == 1:
+        prompt += "\n这是第一章，请为整个故事做好铺垫，介绍主要角色和背景。"
+    elif chapter_num == total:
+        prompt += "\n这是最后一章，请为整个故事画上圆满的句号，确保所有情节都得到妥善解决。"
+    else:
+        prompt += "\n请只写本章情节，自然承接上一章，并为下一章留下伏笔，不要提前写出下一章的内容。"
+    return prompt
+
+def generate_beat_chapter(base_prompt: str, story_summary: str, outline: List[str], chapter_num: int) -> Optional[str]:
+    """按大纲生成一章"""
+    try:
+        response = create_chat_completion(
+            "chapter",
+            chapter=chapter_num,
+            model=get_deployment(),
+            messages=[
+                {"role": "system", "content": CHAPTER_SYSTEM_MESSAGE},
+                {"role": "user", "content": build_beat_prompt(base_prompt, story_summary, outline, chapter_num)}
+            ],
+            max_tokens=completion_budget(base_prompt),
+            temperature=0.8,
+            top_p=0.95
+        )
+        # 改写后仍未通过内容审查时返回 None，稍后和失败的章节一起重新生成
+        return screen_story(response.choices[0].message.content.strip())
+    except Exception as e:
+        print(f"生成第{chapter_num}章失败：{str(e)}")
+        return None
+
+def generate_transition(previous: str, chapter: str, chapter_num: int) -> Optional[str]:
+    """为第 chapter_num 章生成承上启下的过渡句，只发送上一章结尾和本章开头"""
+    tail = "".join(split_sentences(previous)[-2:])
+    head = "".join(split_sentences(chapter)[:2])
+    try:
+        response = create_chat_completion(
+            "continuity",
+            chapter=chapter_num,
+            model=get_deployment(),
+            messages=[
+                {"role": "system", "content": "你是一个儿童故事编辑，擅长让连续剧的章节之间自然衔接。"},
+                {"role": "user", "content": TRANSITION_INSTRUCTIONS.format(
+                    prev=chapter_num - 1, num=chapter_num, tail=tail, head=head
+                )}
+            ],
+            max_tokens=120,
+            temperature=0.5,
+            top_p=0.95
+        )
+        transition = response.choices[0].message.content.strip()
+        # 过渡句可有可无，未通过内容审查时直接不用
+        return None if find_unsafe(transition) else transition
+    except Exception as e:
+        print(f"生成第{chapter_num}章过渡句失败：{str(e)}")
+        return None
+
+def smooth_transitions(chapters: List[str], concurrency: int = SERIAL_PLAN_CONCURRENCY) -> List[str]:
+    """衔接检查：并发为第2章起的每一章加上过渡句；某一处失败时保留原文"""
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        transitions = list(pool.map(
+            lambda i: generate_transition(chapters[i - 1], chapters[i], i + 1), range(1, len(chapters))
+        ))
+    smoothed = chapters[:1]
+    for chapter, transition in zip(chapters[1:], transitions):
+        smoothed.append(f"{transition}\n\n{chapter}" if transition else chapter)
+    return smoothed
+
+def plan_serial(base_prompt: str, setting: str, character: str, elements: str, story_summary: str,
+                concurrency: int = SERIAL_PLAN_CONCURRENCY, smooth: bool = True,
+                on_chapter: Callable[[int], None] = None) -> dict:
+    """一次生成整部连续剧：大纲 → 并发生成全部章节 → 衔接检查，返回可以直接保存的连续剧记录"""
+    outline = generate_outline(base_prompt, story_summary)
+    if not outline:
+        raise RuntimeError("大纲生成失败")
+
+    def generate(chapter_num: int) -> Optional[str]:
+        chapter = generate_beat_chapter(base_prompt, story_summary, outline, chapter_num)
+        if chapter and on_chapter:
+            on_chapter(chapter_num)
+        return chapter
+
+    print(f"正在并发生成{len(outline)}章（并发数{concurrency}）...")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        chapters = list(pool.map(generate, range(1, len(outline) + 1)))
+    # 失败的章节再单独生成一次
+    for i, chapter in enumerate(chapters):
+        if not chapter:
+            chapters[i] = generate(i + 1)
+    failed = [i + 1 for i, chapter in enumerate(chapters) if not chapter]
+    if failed:
+        raise RuntimeError(f"第{'、'.join(map(str, failed))}章生成失败")
+
+    if smooth:
+        print("正在检查章节衔接...")
+        chapters = smooth_transitions(chapters, concurrency)
+
+    return {
+        "character": character,
+        "setting": setting,
+        "elements": elements,
+        "current_chapter": len(chapters),
+        "chapters": chapters,
+        "story_summary": story_summary,
+        "outline": outline,
+        # 大纲本身就是每章的摘要，篇章摘要由大纲拼接，不需要额外调用AI
+        "chapter_summaries": list(outline),
+        "arc_summaries": [
+            "".join(outline[start:start + ARC_SIZE]) for start in range(0, len(outline) - ARC_SIZE + 1, ARC_SIZE)
+        ]
+    }
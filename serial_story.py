@@ -5,35 +5,124 @@ serial_story.py
 
 import os
 import json
-import openai
-from dotenv import load_dotenv
-from typing import Dict, List, Optional
-
-# 加载环境变量
-load_dotenv()
-
-# Azure OpenAI 配置
-openai.api_type = "azure"
-openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai.api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-openai.api_key = os.getenv("AZURE_OPENAI_API_KEY")
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+from llm_client import (
+    CHAPTER_DEADLINE_SECONDS, completion_deadline, create_chat_completion, get_deployment, hedged_chat_completion
+)
+from chapter_journal import JOURNAL_SUFFIX, ChapterJournal, prompt_hash, serial_key
+from safety_filter import screen_story
+from prompt_builder import PROMPT_TOKEN_BUDGET, PromptSection, completion_budget, count_tokens, fit_sections, render_sections
+from storage import STORY_CHILD, STORY_HOUSEHOLD, get_story_store, household_path
+from chapter_store import (
+    make_preview, write_serial_file, load_serial_meta_file, read_chapters_file, chapter_previews_file
+)
 
 # 连续剧记录文件
 SERIAL_STORY_FILE = "serial_story.json"
 
-def load_serial_story() -> dict:
-    """加载连续剧信息"""
-    if os.path.exists(SERIAL_STORY_FILE):
-        with open(SERIAL_STORY_FILE, "r", encoding="utf-8") as f:
+# 上下文压缩配置：只保留最近几章的全文，更早的章节以摘要形式提供
+RECENT_CHAPTERS_FULL_TEXT = int(os.getenv("SERIAL_RECENT_CHAPTERS", "2"))
+# 每满多少章合并为一个篇章摘要（28章共4个篇章）
+ARC_SIZE = 7
+# 超出提示词预算时的裁剪顺序：先裁章节全文（从最早的开始），再裁章节摘要，最后裁篇章摘要
+ARC_PRIORITY = 1
+CHAPTER_SUMMARY_PRIORITY = 2
+FULL_TEXT_PRIORITY = 3
+# 分页阅读时每页显示的章节数
+CHAPTER_PAGE_SIZE = int(os.getenv("CHAPTER_PAGE_SIZE", "3"))
+
+def load_serial_story(setting: str = None, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> dict:
+    """加载连续剧信息；使用数据库存储时按（家庭、场景）查找最近的连续剧"""
+    store = get_story_store()
+    if store:
+        return store.find_serial(household, child, setting)
+    path = household_path(SERIAL_STORY_FILE, household, child)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     return None
 
-def save_serial_story(story_data: dict):
-    """保存连续剧信息"""
-    with open(SERIAL_STORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(story_data, f, ensure_ascii=False, indent=2)
+def save_serial_story(story_data: dict, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD):
+    """保存连续剧信息；使用数据库存储时只追加新章节"""
+    store = get_story_store()
+    if store:
+        store.save_serial(story_data, household, child)
+    else:
+        # 原子写入（临时文件 + 替换），同时写入章节偏移索引，之后可以只读取元数据或单个章节
+        write_serial_file(household_path(SERIAL_STORY_FILE, household, child), story_data)
+    # 已保存的章节从预写日志中移除
+    get_chapter_journal(household, child).commit(serial_key(story_data, household, child), story_data.get('current_chapter', 0))
+
+def get_chapter_journal(household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> ChapterJournal:
+    """连续剧记录旁边的章节预写日志"""
+    return ChapterJournal(household_path(SERIAL_STORY_FILE, household, child) + JOURNAL_SUFFIX)
+
+def load_serial_meta(setting: str = None, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> dict:
+    """只加载连续剧元数据，不读取章节正文；章节数见 chapter_count"""
+    store = get_story_store()
+    if store:
+        return store.find_serial_meta(household, child, setting)
+    return load_serial_meta_file(household_path(SERIAL_STORY_FILE, household, child))
+
+def get_chapter_count(serial_story: dict) -> int:
+    """已生成的章节数，完整记录和元数据都适用"""
+    if 'chapters' in serial_story:
+        return len(serial_story['chapters'])
+    return serial_story.get('chapter_count', 0)
+
+def get_chapters(serial_story: dict, start: int, count: int,
+                 household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> List[str]:
+    """按需读取第 start 章起（从1开始）的 count 章正文"""
+    if 'chapters' in serial_story:
+        return serial_story['chapters'][start - 1:start - 1 + count]
+    store = get_story_store()
+    if store:
+        return store.get_chapters(serial_story['serial_id'], start, count)
+    return read_chapters_file(household_path(SERIAL_STORY_FILE, household, child), start, count)
+
+def get_chapter_previews(serial_story: dict, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> List[str]:
+    """读取全部章节的预览"""
+    if 'chapters' in serial_story:
+        return [make_preview(chapter) for chapter in serial_story['chapters']]
+    store = get_story_store()
+    if store:
+        return store.chapter_previews(serial_story['serial_id'])
+    return chapter_previews_file(household_path(SERIAL_STORY_FILE, household, child))
+
+def iter_chapter_pages(serial_story: dict, page_size: int = CHAPTER_PAGE_SIZE,
+                       household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> Iterator[List[Tuple[int, str]]]:
+    """逐页读取章节，每页返回（章节号，正文）列表"""
+    total = get_chapter_count(serial_story)
+    for start in range(1, total + 1, page_size):
+        chapters = get_chapters(serial_story, start, page_size, household, child)
+        yield [(start + i, chapter) for i, chapter in enumerate(chapters)]
 
-def show_serial_story_info(serial_story: dict):
+def read_serial_story(serial_story: dict, page_size: int = CHAPTER_PAGE_SIZE,
+                      household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD):
+    """分页阅读全部章节，每页之后可以选择结束阅读"""
+    total = get_chapter_count(serial_story)
+    for page in iter_chapter_pages(serial_story, page_size, household, child):
+        for i, chapter in page:
+            print(f"\n第{i}章：")
+            print(chapter)
+        if page[-1][0] < total:
+            if input(f"\n已阅读{page[-1][0]}/{total}章，按回车继续，输入 q 结束阅读：").strip().lower() == 'q':
+                return
+
+def update_serial_meta(serial_story: dict, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD, **fields):
+    """只更新连续剧元数据（如章节语音记录），不重写章节"""
+    serial_story.update(fields)
+    store = get_story_store()
+    if store:
+        store.update_serial_meta(serial_story['serial_id'], fields)
+        return
+    # JSON 文件中章节和元数据在同一个文件内，只能整体重写
+    full_story = serial_story if 'chapters' in serial_story else load_serial_story(household=household, child=child)
+    full_story.update(fields)
+    save_serial_story(full_story, household, child)
+
+def show_serial_story_info(serial_story: dict, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD):
     """显示连续剧信息"""
     print("\n=== 当前连续剧信息 ===")
     print(f"主角：{serial_story['character']}")
@@ -41,46 +130,195 @@ def show_serial_story_info(serial_story: dict):
     print(f"故事元素：{serial_story['elements']}")
     print(f"当前进度：第{serial_story['current_chapter']}章 / 共28章")
     print("\n已生成章节：")
-    for i, chapter in enumerate(serial_story['chapters'], 1):
+    # 只读取预先计算的章节预览，不加载正文
+    for i, preview in enumerate(get_chapter_previews(serial_story, household, child), 1):
         print(f"\n第{i}章：")
-        print(chapter[:100] + "..." if len(chapter) > 100 else chapter)
+        print(preview)
+
+def summarize_chapter(chapter: str, chapter_num: int) -> str:
+    """将单章内容压缩为简短摘要（每章只在保存时摘要一次）"""
+    try:
+        response = create_chat_completion(
+            "chapter_summary",
+            chapter=chapter_num,
+            model=get_deployment(),
+            messages=[
+                {"role": "system", "content": "你是一个儿童故事编辑，擅长为连续剧章节撰写简洁的前情提要。"},
+                {"role": "user", "content": f"请用不超过80个字概括下面第{chapter_num}章的主要情节、角色变化和留下的伏笔：\n{chapter}"}
+            ],
+            max_tokens=200,
+            temperature=0.3,
+            top_p=0.95
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"生成第{chapter_num}章摘要失败：{str(e)}")
+        # 摘要失败时退化为截取开头，保证记忆结构完整
+        return chapter[:80]
 
-def generate_serial_story_chapter(prompt: str, chapter_num: int, previous_chapters: list, story_summary: str = None) -> str:
-    """生成连续剧的章节"""
+def summarize_arc(chapter_summaries: List[str], start_chapter: int) -> str:
+    """将一个篇章内的多章摘要合并为篇章摘要"""
+    end_chapter = start_chapter + len(chapter_summaries) - 1
+    joined = "\n".join(
+        f"第{start_chapter + i}章：{summary}" for i, summary in enumerate(chapter_summaries)
+    )
+    try:
+        response = create_chat_completion(
+            "arc_summary",
+            chapter=end_chapter,
+            model=get_deployment(),
+            messages=[
+                {"role": "system", "content": "你是一个儿童故事编辑，擅长为连续剧章节撰写简洁的前情提要。"},
+                {"role": "user", "content": f"请把下面第{start_chapter}-{end_chapter}章的摘要合并成不超过150个字的篇章梗概，保留关键情节和未解决的伏笔：\n{joined}"}
+            ],
+            max_tokens=300,
+            temperature=0.3,
+            top_p=0.95
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"生成第{start_chapter}-{end_chapter}章篇章摘要失败：{str(e)}")
+        return " ".join(chapter_summaries)
+
+def update_story_memory(serial_story: dict) -> dict:
+    """为尚未摘要的章节补充摘要，每满ARC_SIZE章合并为一个篇章摘要"""
+    chapters = serial_story.get('chapters', [])
+    chapter_summaries = serial_story.setdefault('chapter_summaries', [])
+    arc_summaries = serial_story.setdefault('arc_summaries', [])
+    
+    # 已经摘要过的章节不再重复处理
+    for i in range(len(chapter_summaries), len(chapters)):
+        chapter_summaries.append(summarize_chapter(chapters[i], i + 1))
+    
+    while (len(arc_summaries) + 1) * ARC_SIZE <= len(chapter_summaries):
+        start = len(arc_summaries) * ARC_SIZE
+        arc_summaries.append(summarize_arc(chapter_summaries[start:start + ARC_SIZE], start + 1))
+    return serial_story
+
+def build_context_sections(previous_chapters: list, chapter_summaries: list = None,
+                           arc_summaries: list = None, recent: int = RECENT_CHAPTERS_FULL_TEXT) -> List[PromptSection]:
+    """把前文拆成可按优先级裁剪的片段：篇章摘要 + 章节摘要 + 最近几章全文"""
+    if not previous_chapters:
+        return []
+    # 没有摘要信息时沿用旧逻辑，拼接全部章节
+    if chapter_summaries is None:
+        return [(chapter, FULL_TEXT_PRIORITY, "前文概要") for chapter in previous_chapters]
+    
+    arc_summaries = arc_summaries or []
+    total = len(previous_chapters)
+    older_end = max(total - recent, 0)
+    sections = []
+    
+    # 完全早于最近章节的篇章使用篇章摘要
+    covered = 0
+    for i, arc in enumerate(arc_summaries):
+        arc_end = (i + 1) * ARC_SIZE
+        if arc_end > older_end:
+            break
+        sections.append((f"第{i * ARC_SIZE + 1}-{arc_end}章：{arc}", ARC_PRIORITY, "前情回顾"))
+        covered = arc_end
+    
+    # 其余较早章节使用章节摘要，缺少摘要时退回全文
+    for i in range(covered, older_end):
+        if i < len(chapter_summaries):
+            sections.append((f"第{i + 1}章：{chapter_summaries[i]}", CHAPTER_SUMMARY_PRIORITY, "章节摘要"))
+        else:
+            sections.append((f"第{i + 1}章：{previous_chapters[i]}", FULL_TEXT_PRIORITY, "章节摘要"))
+    
+    # 最近几章保留全文，保证衔接自然
+    for i in range(older_end, total):
+        sections.append((f"第{i + 1}章：\n{previous_chapters[i]}", FULL_TEXT_PRIORITY, "前文概要"))
+    return sections
+
+def build_previous_context(previous_chapters: list, chapter_summaries: list = None,
+                           arc_summaries: list = None, recent: int = RECENT_CHAPTERS_FULL_TEXT) -> str:
+    """构建前文上下文：篇章摘要 + 章节摘要 + 最近几章全文"""
+    sections = build_context_sections(previous_chapters, chapter_summaries, arc_summaries, recent)
+    return "\n\n" + render_sections(sections) if sections else ""
+
+def generate_serial_story_chapter(prompt: str, chapter_num: int, previous_chapters: list, story_summary: str = None,
+                                  chapter_summaries: list = None, arc_summaries: list = None,
+                                  prompt_budget: int = PROMPT_TOKEN_BUDGET,
+                                  deadline_seconds: Optional[float] = None) -> str:
+    """生成连续剧的章节；提示词超出 prompt_budget 个 token 时裁剪较旧的上下文，
+    慢请求会触发对冲请求，deadline_seconds 内没有生成成功时返回 None。
+    deadline_seconds 默认为 CHAPTER_DEADLINE_SECONDS，章节很长时按回复上限延长"""
     try:
         if chapter_num > 28:
             print("\n故事已经完成28章，可以开始新的故事了！")
             return None
             
         print(f"\n正在生成第{chapter_num}章...")
-        chapter_prompt = f"{prompt}\n\n这是第{chapter_num}章，总共28章。"
+        # 按前缀缓存的顺序排列：同一部连续剧每章都相同的提示词和故事梗概在前，
+        # 前文按章节顺序追加，章节号和写作要求每次都不同，放在最后
+        sections = [(prompt, 0, "")]
         
         # 添加故事梗概
         if story_summary:
-            chapter_prompt += f"\n\n故事梗概：\n{story_summary}"
+            sections.append((story_summary, 0, "故事梗概"))
             
-        if previous_chapters:
-            chapter_prompt += "\n\n前文概要：\n" + "\n".join(previous_chapters)
+        # 传入章节摘要时只发送最近几章全文，避免提示词随章节数线性增长
+        sections += build_context_sections(previous_chapters, chapter_summaries, arc_summaries)
         
         # 根据章节数调整提示
         if chapter_num == 1:
-            chapter_prompt += "\n这是第一章，请为整个故事做好铺垫，介绍主要角色和背景。"
+            direction = "\n这是第一章，请为整个故事做好铺垫，介绍主要角色和背景。"
         elif chapter_num == 28:
-            chapter_prompt += "\n这是最后一章，请为整个故事画上圆满的句号，确保所有情节都得到妥善解决。"
+            direction = "\n这是最后一章，请为整个故事画上圆满的句号，确保所有情节都得到妥善解决。"
         else:
-            chapter_prompt += "\n请继续发展故事情节，注意与前文的连贯性，并为下一章留下伏笔。"
+            direction = "\n请继续发展故事情节，注意与前文的连贯性，并为下一章留下伏笔。"
+        direction = f"\n\n这是第{chapter_num}章，总共28章。{direction}"
+        
+        # 超出提示词预算时按优先级裁掉较旧的上下文
+        kept = fit_sections(sections, prompt_budget - count_tokens(direction))
+        if len(kept) < len(sections):
+            print(f"提示词超出预算，已省略{len(sections) - len(kept)}段较早的上下文")
+        chapter_prompt = render_sections(kept) + direction
         
-        response = openai.ChatCompletion.create(
-            engine=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        max_tokens = completion_budget(prompt)
+        if deadline_seconds is None:
+            deadline_seconds = completion_deadline(max_tokens, CHAPTER_DEADLINE_SECONDS)
+        response = hedged_chat_completion(
+            "chapter",
+            deadline=time.monotonic() + deadline_seconds,
+            chapter=chapter_num,
+            model=get_deployment(),
             messages=[
                 {"role": "system", "content": "你是一个专业的儿童故事作家，擅长创作连续剧式的故事。请确保故事适合儿童阅读，内容积极向上。"},
                 {"role": "user", "content": chapter_prompt}
             ],
-            max_tokens=1024,
+            max_tokens=max_tokens,
             temperature=0.8,
             top_p=0.95
         )
-        return response.choices[0].message.content.strip()
+        # 保存和合成语音之前审查内容，改写后仍不合格时视为生成失败
+        chapter = screen_story(response.choices[0].message.content.strip())
+        if chapter is None:
+            print("章节改写后仍未通过内容审查")
+        return chapter
     except Exception as e:
         print(f"生成章节失败：{str(e)}")
-        return None 
\ No newline at end of file
+        return None
+
+def generate_chapter_journaled(serial_story: dict, prompt: str, chapter_num: int,
+                               household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> str:
+    """按（连续剧、章节号）幂等地生成章节：预写日志中有尚未保存的同一章时直接恢复，
+    新生成的章节先写入日志，save_serial_story 成功后才从日志中移除"""
+    journal = get_chapter_journal(household, child)
+    key = serial_key(serial_story, household, child)
+    digest = prompt_hash(prompt)
+    chapter = journal.recover(key, chapter_num, digest)
+    if chapter:
+        print(f"\n[恢复] 第{chapter_num}章已生成但尚未保存，直接使用")
+        return chapter
+    chapter = generate_serial_story_chapter(
+        prompt,
+        chapter_num,
+        serial_story.get('chapters', []),
+        serial_story.get('story_summary'),
+        serial_story.get('chapter_summaries'),
+        serial_story.get('arc_summaries')
+    )
+    if chapter:
+        journal.record(key, chapter_num, chapter, digest)
+    return chapter
@@ -0,0 +1,385 @@
+"""
+service.py
+常驻进程的故事服务：命令行和 HTTP 接口共用的无交互操作，AI客户端、缓存和孩子信息在请求之间保持复用
+"""
+
+import os
+import uuid
+import asyncio
+import argparse
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from story_generator import (
+    STORY_FAILURE_MESSAGE, build_prompt, build_story_prompt, generate_story, generate_story_summaries,
+    has_told_summary, remember_summary
+)
+from serial_story import (
+    load_serial_story, save_serial_story, generate_chapter_journaled, update_story_memory
+)
+from metrics import get_metrics
+from prefetch import get_pending_chapter
+from serial_planner import SERIAL_PLAN_CONCURRENCY, plan_serial
+from summary_pool import SUMMARY_POOL_ENABLED, get_summary_pool
+from storage import STORY_CHILD, STORY_HOUSEHOLD
+from tts import audio_cache_key, generate_audio_file
+from user_profile import get_elapsed_months, read_child_info, write_child_info
+from utils import VALID_SETTINGS
+
+# HTTP 服务默认监听地址
+SERVICE_HOST = os.getenv("STORY_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("STORY_SERVICE_PORT", "8080"))
+# 同时执行的生成任务数
+SERVICE_WORKERS = int(os.getenv("STORY_SERVICE_WORKERS", "8"))
+
+class StoryService:
+    """无交互的故事操作；参数错误时抛出 ValueError，AI生成失败时抛出 RuntimeError"""
+
+    def __init__(self):
+        self._profiles: Dict[tuple, dict] = {}
+        self._locks: Dict[tuple, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _child_lock(self, household: str, child: str) -> threading.Lock:
+        # 同一个孩子的连续剧操作依次执行，避免两个请求同时写入同一章
+        with self._locks_guard:
+            return self._locks.setdefault((household, child), threading.Lock())
+
+    # ---------- 孩子信息 ----------
+
+    def get_profile(self, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> Optional[dict]:
+        """读取孩子信息，读取过的记录保存在内存中"""
+        key = (household, child)
+        if key not in self._profiles:
+            data = read_child_info(household, child)
+            if data is None:
+                return None
+            self._profiles[key] = data
+        data = self._profiles[key]
+        return dict(data, months=data["base_months"] + get_elapsed_months(data["start_date"]))
+
+    def set_profile(self, months: int, gender: str = "", household: str = STORY_HOUSEHOLD,
+                    child: str = STORY_CHILD) -> dict:
+        """保存孩子当前月龄和性别"""
+        if months < 0:
+            raise ValueError("月龄不能为负数")
+        data = {"start_date": datetime.now().strftime("%Y-%m-%d"), "base_months": months, "gender": gender}
+        write_child_info(data, household, child)
+        self._profiles[(household, child)] = data
+        return self.get_profile(household, child)
+
+    def resolve_months(self, months: Optional[int], household: str, child: str) -> int:
+        """优先使用请求中的月龄，否则使用保存的孩子信息"""
+        if months is not None:
+            return int(months)
+        profile = self.get_profile(household, child)
+        if profile is None:
+            raise ValueError("没有孩子信息，请提供月龄")
+        return profile["months"]
+
+    # ---------- 故事 ----------
+
+    @staticmethod
+    def _check_setting(setting: str):
+        if setting not in VALID_SETTINGS:
+            raise ValueError(f"无效的场景：{setting}，可选：{'、'.join(VALID_SETTINGS)}")
+
+    def summaries(self, setting: str, character: str, elements: str, months: Optional[int] = None,
+                  household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> List[str]:
+        """生成三个故事概要；启用概要池时优先使用预生成的概要"""
+        self._check_setting(setting)
+        months = self.resolve_months(months, household, child)
+        if SUMMARY_POOL_ENABLED:
+            pooled = get_summary_pool().take(months, setting, elements, character, household=household)
+            if pooled and not has_told_summary(pooled, household):
+                return pooled
+        summaries = generate_story_summaries(build_prompt(months, character, elements, setting), household=household)
+        if not summaries:
+            raise RuntimeError("故事概要生成失败")
+        return summaries
+
+    def story(self, setting: str, character: str, elements: str, summary: str, months: Optional[int] = None,
+              household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> str:
+        """根据选定的概要生成完整故事"""
+        self._check_setting(setting)
+        if not summary:
+            raise ValueError("请提供故事概要")
+        months = self.resolve_months(months, household, child)
+        base_prompt = build_prompt(months, character, elements, setting)
+        remember_summary(base_prompt, summary, household)
+        story = generate_story(build_story_prompt(base_prompt, summary), household=household)
+        if not story or story == STORY_FAILURE_MESSAGE:
+            raise RuntimeError("故事生成失败")
+        return story
+
+    # ---------- 连续剧 ----------
+
+    def start_serial(self, setting: str, character: str, elements: str, summary: str,
+                     months: Optional[int] = None, household: str = STORY_HOUSEHOLD,
+                     child: str = STORY_CHILD) -> dict:
+        """开始新的连续剧并生成第一章"""
+        self._check_setting(setting)
+        if not summary:
+            raise ValueError("请提供故事概要")
+        months = self.resolve_months(months, household, child)
+        base_prompt = build_prompt(months, character, elements, setting)
+        remember_summary(base_prompt, summary, household)
+        with self._child_lock(household, child):
+            serial_story = {
+                "character": character,
+                "setting": setting,
+                "elements": elements,
+                "current_chapter": 1,
+                "chapters": [],
+                "story_summary": summary,
+                "chapter_summaries": [],
+                "arc_summaries": []
+            }
+            chapter = generate_chapter_journaled(serial_story, base_prompt, 1, household, child)
+            if not chapter:
+                raise RuntimeError("章节生成失败")
+            serial_story['chapters'].append(chapter)
+            update_story_memory(serial_story)
+            save_serial_story(serial_story, household, child)
+        return {"chapter_num": 1, "chapter": chapter, "setting": setting, "character": character}
+
+    def next_chapter(self, setting: Optional[str] = None, months: Optional[int] = None,
+                     household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> dict:
+        """续写连续剧的下一章；有预生成的章节时直接使用"""
+        months = self.resolve_months(months, household, child)
+        with self._child_lock(household, child):
+            serial_story = load_serial_story(setting, household, child)
+            if not serial_story or (setting and serial_story['setting'] != setting):
+                raise ValueError("没有找到可以续写的连续剧")
+            chapter_num = serial_story['current_chapter'] + 1
+            if chapter_num > 28:
+                raise ValueError("故事已经完成28章")
+
+            pending = get_pending_chapter(serial_story, months)
+            serial_story.pop('pending', None)
+            if pending:
+                chapter = pending['chapter']
+            else:
+                update_story_memory(serial_story)
+                base_prompt = build_prompt(
+                    months, serial_story['character'], serial_story['elements'], serial_story['setting']
+                )
+                chapter = generate_chapter_journaled(serial_story, base_prompt, chapter_num, household, child)
+                if not chapter:
+                    raise RuntimeError("章节生成失败")
+            serial_story['chapters'].append(chapter)
+            serial_story['current_chapter'] = chapter_num
+            update_story_memory(serial_story)
+            if pending and pending.get('audio_file'):
+                serial_story.setdefault('chapter_audio', {})[str(chapter_num)] = audio_cache_key(chapter)
+            save_serial_story(serial_story, household, child)
+        return {
+            "chapter_num": chapter_num,
+            "chapter": chapter,
+            "setting": serial_story['setting'],
+            "character": serial_story['character']
+        }
+
+    def plan_serial(self, setting: str, character: str, elements: str, summary: str,
+                    months: Optional[int] = None, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD,
+                    concurrency: int = SERIAL_PLAN_CONCURRENCY) -> dict:
+        """大纲模式：一次生成整部连续剧并保存"""
+        self._check_setting(setting)
+        if not summary:
+            raise ValueError("请提供故事概要")
+        months = self.resolve_months(months, household, child)
+        base_prompt = build_prompt(months, character, elements, setting)
+        with self._child_lock(household, child):
+            serial_story = plan_serial(base_prompt, setting, character, elements, summary, concurrency)
+            save_serial_story(serial_story, household, child)
+        return {
+            "chapters": serial_story['current_chapter'],
+            "outline": serial_story['outline'],
+            "setting": setting,
+            "character": character
+        }
+
+    # ---------- 语音 ----------
+
+    def audio(self, text: str, prefix: str = "story") -> str:
+        """合成语音并返回文件路径；相同内容直接返回缓存的文件"""
+        if not text:
+            raise ValueError("请提供需要合成的文本")
+        # 文件名加上随机后缀，并发请求不会写到同一个文件
+        return generate_audio_file(text, f"{prefix}_{uuid.uuid4().hex[:8]}")
+
+# ---------- HTTP 接口 ----------
+
+def _optional_int(value) -> Optional[int]:
+    return None if value in (None, "") else int(value)
+
+def create_app(service: Optional[StoryService] = None):
+    """创建 aiohttp 应用；生成任务在线程池中执行，事件循环可以同时处理多个请求"""
+    from aiohttp import web
+    from concurrent.futures import ThreadPoolExecutor
+
+    service = service or StoryService()
+    executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS)
+
+    async def call(func, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, lambda: func(**kwargs))
+
+    async def read_body(request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="请求内容不是有效的JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="请求内容必须是JSON对象")
+        body.setdefault("household", STORY_HOUSEHOLD)
+        body.setdefault("child", STORY_CHILD)
+        return body
+
+    def handler(func):
+        async def wrapped(request):
+            try:
+                return await func(request)
+            except (KeyError, TypeError) as e:
+                return web.json_response({"error": f"缺少或错误的参数：{e}"}, status=400)
+            except ValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+            except RuntimeError as e:
+                return web.json_response({"error": str(e)}, status=502)
+        return wrapped
+
+    @handler
+    async def health(request):
+        return web.json_response({"status": "ok"})
+
+    async def metrics(request):
+        # Prometheus 文本格式的调用耗时、token 用量、重试和缓存命中统计
+        return web.Response(text=get_metrics().render_prometheus(), content_type="text/plain")
+
+    @handler
+    async def get_profile(request):
+        profile = await call(
+            service.get_profile,
+            household=request.query.get("household", STORY_HOUSEHOLD),
+            child=request.query.get("child", STORY_CHILD)
+        )
+        if profile is None:
+            return web.json_response({"error": "没有孩子信息"}, status=404)
+        return web.json_response(profile)
+
+    @handler
+    async def set_profile(request):
+        body = await read_body(request)
+        profile = await call(
+            service.set_profile, months=int(body["months"]), gender=body.get("gender", ""),
+            household=body["household"], child=body["child"]
+        )
+        return web.json_response(profile)
+
+    @handler
+    async def summaries(request):
+        body = await read_body(request)
+        result = await call(
+            service.summaries, setting=body["setting"], character=body["character"],
+            elements=body["elements"], months=_optional_int(body.get("months")),
+            household=body["household"], child=body["child"]
+        )
+        return web.json_response({"summaries": result})
+
+    @handler
+    async def story(request):
+        body = await read_body(request)
+        result = await call(
+            service.story, setting=body["setting"], character=body["character"],
+            elements=body["elements"], summary=body["summary"], months=_optional_int(body.get("months")),
+            household=body["household"], child=body["child"]
+        )
+        return web.json_response({"story": result})
+
+    @handler
+    async def chapter(request):
+        body = await read_body(request)
+        months = _optional_int(body.get("months"))
+        if body.get("new"):
+            result = await call(
+                service.start_serial, setting=body["setting"], character=body["character"],
+                elements=body["elements"], summary=body["summary"], months=months,
+                household=body["household"], child=body["child"]
+            )
+        else:
+            result = await call(
+                service.next_chapter, setting=body.get("setting"), months=months,
+                household=body["household"], child=body["child"]
+            )
+        return web.json_response(result)
+
+    @handler
+    async def plan(request):
+        body = await read_body(request)
+        result = await call(
+            service.plan_serial, setting=body["setting"], character=body["character"],
+            elements=body["elements"], summary=body["summary"], months=_optional_int(body.get("months")),
+            household=body["household"], child=body["child"],
+            concurrency=int(body.get("concurrency", SERIAL_PLAN_CONCURRENCY))
+        )
+        return web.json_response(result)
+
+    @handler
+    async def audio(request):
+        body = await read_body(request)
+        path = await call(service.audio, text=body["text"], prefix=body.get("prefix", "story"))
+        return web.FileResponse(path, headers={"Content-Type": "audio/mpeg"})
+
+    async def shutdown(app):
+        executor.shutdown(wait=False)
+
+    app = web.Application()
+    app.add_routes([
+        web.get("/health", health),
+        web.get("/metrics", metrics),
+        web.get("/profile", get_profile),
+        web.post("/profile", set_profile),
+        web.post("/summaries", summaries),
+        web.post("/story", story),
+        web.post("/chapter", chapter),
+        web.post("/plan", plan),
+        web.post("/audio", audio),
+    ])
+    app.on_cleanup.append(shutdown)
+    return app
+
+def start_background_service(port: int = 0, service: Optional[StoryService] = None) -> Tuple[Callable[[], None], str]:
+    """在后台线程启动 HTTP 服务（测试和基准用），返回停止函数和访问地址"""
+    from aiohttp import web
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_app(service))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    loop.run_until_complete(site.start())
+    host, actual_port = runner.addresses[0][:2]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return stop, f"http://{host}:{actual_port}"
+
+def run_service(host: str = SERVICE_HOST, port: int = SERVICE_PORT):
+    """启动 HTTP 服务，直到进程退出"""
+    from aiohttp import web
+    print(f"故事服务已启动：http://{host}:{port}")
+    web.run_app(create_app(), host=host, port=port, print=None)
+
+def main():
+    parser = argparse.ArgumentParser(description="故事生成 HTTP 服务")
+    parser.add_argument("--host", default=SERVICE_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help="监听端口")
+    args = parser.parse_args()
+    run_service(args.host, args.port)
+
+if __name__ == "__main__":
+    main()
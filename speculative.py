@@ -0,0 +1,85 @@
+"""
+speculative.py
+推测生成：在用户挑选概要的同时，预先并发生成三个完整故事
+"""
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from story_generator import STORY_FAILURE_MESSAGE, build_story_prompt, generate_story_stream
+
+# 是否启用推测生成
+SPECULATIVE_ENABLED = os.getenv("SPECULATIVE_STORY", "0") == "1"
+# 每次运行最多发起的推测生成次数，超出后不再推测（成本上限）
+SPECULATIVE_MAX_CALLS = int(os.getenv("SPECULATIVE_MAX_CALLS", "6"))
+
+def generate_story_cancellable(prompt: str, cancel_event: threading.Event) -> Optional[str]:
+    """流式生成故事，取消时立即关闭连接，不再为后续内容付费"""
+    parts = []
+    stream = generate_story_stream(prompt)
+    try:
+        for text in stream:
+            if cancel_event.is_set():
+                return None
+            parts.append(text)
+    finally:
+        stream.close()
+    story = "".join(parts).strip()
+    return story or None
+
+class SpeculativeStoryGenerator:
+    """为展示中的每个概要预先生成完整故事，用户选定后丢弃其余结果"""
+
+    def __init__(self, base_prompt: str, max_calls: int = SPECULATIVE_MAX_CALLS,
+                 generate: Callable[[str, threading.Event], Optional[str]] = generate_story_cancellable):
+        self.base_prompt = base_prompt
+        self.max_calls = max_calls
+        self.generate = generate
+        self.calls = 0
+        self._executor = ThreadPoolExecutor(max_workers=3)
+        self._futures: Dict[str, Future] = {}
+        self._cancel_events: Dict[str, threading.Event] = {}
+
+    def start(self, summaries: List[str]):
+        """开始为一组概要推测生成；之前的推测结果全部丢弃"""
+        self.discard()
+        for summary in summaries:
+            if self.calls >= self.max_calls:
+                print("\n[推测生成] 已达到推测次数上限，剩余概要将在选定后再生成")
+                break
+            self.calls += 1
+            cancel_event = threading.Event()
+            prompt = build_story_prompt(self.base_prompt, summary)
+            self._cancel_events[summary] = cancel_event
+            self._futures[summary] = self._executor.submit(self.generate, prompt, cancel_event)
+
+    def take(self, summary: str) -> Optional[str]:
+        """取出选定概要对应的故事并取消其余推测；没有推测结果时返回 None"""
+        future = self._futures.pop(summary, None)
+        self._cancel_events.pop(summary, None)
+        self.discard()
+        if future is None:
+            return None
+        try:
+            story = future.result()
+        except Exception as e:
+            print(f"推测生成失败：{str(e)}")
+            return None
+        if not story or story == STORY_FAILURE_MESSAGE:
+            return None
+        return story
+
+    def discard(self):
+        """取消全部推测：尚未开始的直接取消，正在生成的关闭连接"""
+        for summary, future in self._futures.items():
+            future.cancel()
+            self._cancel_events[summary].set()
+        self._futures.clear()
+        self._cancel_events.clear()
+
+    def shutdown(self):
+        """丢弃推测结果并关闭线程池"""
+        self.discard()
+        self._executor.shutdown(wait=False)
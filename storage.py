@@ -0,0 +1,333 @@
+"""
+storage.py
+多家庭存储：用 SQLite（WAL 模式）保存孩子信息和连续剧，追加章节时不重写已有章节
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+from chapter_store import make_preview
+
+# 设置数据库路径后使用 SQLite 存储，否则沿用 child_info.json 和 serial_story.json
+STORY_DB_PATH = os.getenv("STORY_DB_PATH")
+# 当前家庭和孩子
+STORY_HOUSEHOLD = os.getenv("STORY_HOUSEHOLD", "default")
+STORY_CHILD = os.getenv("STORY_CHILD", "default")
+
+# 连续剧中单独成列的字段，其余字段（篇章摘要、预生成章节等）存入 meta
+SERIAL_COLUMNS = ["character", "setting", "elements", "story_summary", "current_chapter"]
+CHAPTER_FIELDS = ["serial_id", "chapters", "chapter_summaries", "chapter_count"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS children (
+    household TEXT NOT NULL,
+    child TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    base_months INTEGER NOT NULL,
+    gender TEXT,
+    PRIMARY KEY (household, child)
+);
+CREATE TABLE IF NOT EXISTS serials (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    household TEXT NOT NULL,
+    child TEXT NOT NULL,
+    character TEXT,
+    setting TEXT,
+    elements TEXT,
+    story_summary TEXT,
+    current_chapter INTEGER NOT NULL DEFAULT 0,
+    meta TEXT NOT NULL DEFAULT '{}',
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_serials_household_setting ON serials (household, setting, updated);
+CREATE TABLE IF NOT EXISTS chapters (
+    serial_id INTEGER NOT NULL REFERENCES serials (id) ON DELETE CASCADE,
+    chapter_num INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    summary TEXT,
+    preview TEXT,
+    PRIMARY KEY (serial_id, chapter_num)
+);
+"""
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class StoryStore:
+    """SQLite 存储：每次写入都在一个事务内完成，崩溃时不会留下写了一半的数据"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self._add_preview_column()
+
+    def _add_preview_column(self):
+        """旧数据库没有章节预览列时补上，并为已有章节计算预览"""
+        columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(chapters)")]
+        if "preview" in columns:
+            return
+        with self._transaction() as conn:
+            conn.execute("ALTER TABLE chapters ADD COLUMN preview TEXT")
+            rows = conn.execute("SELECT serial_id, chapter_num, text FROM chapters").fetchall()
+            conn.executemany(
+                "UPDATE chapters SET preview = ? WHERE serial_id = ? AND chapter_num = ?",
+                [(make_preview(r["text"]), r["serial_id"], r["chapter_num"]) for r in rows]
+            )
+
+    def _transaction(self):
+        return _Transaction(self.conn, self._lock)
+
+    # ---------- 孩子信息 ----------
+
+    def get_child(self, household: str, child: str) -> Optional[dict]:
+        """读取孩子信息，格式与 child_info.json 相同"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT start_date, base_months, gender FROM children WHERE household = ? AND child = ?",
+                (household, child)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def save_child(self, household: str, child: str, info: dict):
+        """保存孩子信息"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO children (household, child, start_date, base_months, gender) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (household, child, info["start_date"], info["base_months"], info.get("gender", ""))
+            )
+
+    def delete_child(self, household: str, child: str) -> bool:
+        """删除孩子信息及其连续剧，返回是否有记录被删除"""
+        with self._transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM children WHERE household = ? AND child = ?", (household, child)
+            ).rowcount
+            deleted += conn.execute(
+                "DELETE FROM serials WHERE household = ? AND child = ?", (household, child)
+            ).rowcount
+        return deleted > 0
+
+    # ---------- 连续剧 ----------
+
+    def _serial_meta_from_row(self, row: sqlite3.Row) -> dict:
+        story = json.loads(row["meta"])
+        story.update({column: row[column] for column in SERIAL_COLUMNS})
+        story["serial_id"] = row["id"]
+        return story
+
+    def _serial_from_row(self, row: sqlite3.Row) -> dict:
+        story = self._serial_meta_from_row(row)
+        chapter_rows = self.conn.execute(
+            "SELECT text, summary FROM chapters WHERE serial_id = ? ORDER BY chapter_num", (row["id"],)
+        ).fetchall()
+        story["chapters"] = [r["text"] for r in chapter_rows]
+        # 章节摘要只保留连续的前缀，避免中间缺失时错位
+        summaries = []
+        for r in chapter_rows:
+            if r["summary"] is None:
+                break
+            summaries.append(r["summary"])
+        story["chapter_summaries"] = summaries
+        return story
+
+    def _find_serial_row(self, household: str, child: str, setting: Optional[str]) -> Optional[sqlite3.Row]:
+        if setting is None:
+            return self.conn.execute(
+                "SELECT * FROM serials WHERE household = ? AND child = ? ORDER BY updated DESC, id DESC LIMIT 1",
+                (household, child)
+            ).fetchone()
+        return self.conn.execute(
+            "SELECT * FROM serials WHERE household = ? AND setting = ? AND child = ? "
+            "ORDER BY updated DESC, id DESC LIMIT 1",
+            (household, setting, child)
+        ).fetchone()
+
+    def find_serial(self, household: str, child: str, setting: Optional[str] = None) -> Optional[dict]:
+        """查找某个孩子最近更新的连续剧，指定场景时只查找该场景"""
+        with self._lock:
+            row = self._find_serial_row(household, child, setting)
+            return self._serial_from_row(row) if row else None
+
+    def find_serial_meta(self, household: str, child: str, setting: Optional[str] = None) -> Optional[dict]:
+        """同 find_serial，但不读取章节正文，只附带章节数 chapter_count"""
+        with self._lock:
+            row = self._find_serial_row(household, child, setting)
+            if not row:
+                return None
+            story = self._serial_meta_from_row(row)
+            story["chapter_count"] = self.conn.execute(
+                "SELECT COUNT(*) FROM chapters WHERE serial_id = ?", (row["id"],)
+            ).fetchone()[0]
+        return story
+
+    def get_chapters(self, serial_id: int, start: int, count: int) -> List[str]:
+        """读取第 start 章起（从1开始）的 count 章正文"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT text FROM chapters WHERE serial_id = ? AND chapter_num >= ? ORDER BY chapter_num LIMIT ?",
+                (serial_id, start, count)
+            ).fetchall()
+        return [row["text"] for row in rows]
+
+    def chapter_previews(self, serial_id: int) -> List[str]:
+        """读取全部章节的预览，不读取正文"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT preview FROM chapters WHERE serial_id = ? ORDER BY chapter_num", (serial_id,)
+            ).fetchall()
+        return [row["preview"] for row in rows]
+
+    def update_serial_meta(self, serial_id: int, fields: dict):
+        """只更新连续剧的元数据字段，不涉及章节"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT meta FROM serials WHERE id = ?", (serial_id,)).fetchone()
+            if row is None:
+                return
+            meta = json.loads(row["meta"])
+            meta.update({k: v for k, v in fields.items() if k not in SERIAL_COLUMNS and k not in CHAPTER_FIELDS})
+            columns = [column for column in SERIAL_COLUMNS if column in fields]
+            conn.execute(
+                "UPDATE serials SET " + "".join(f"{column} = ?, " for column in columns) + "meta = ?, updated = ? WHERE id = ?",
+                [fields[column] for column in columns] + [json.dumps(meta, ensure_ascii=False), _now(), serial_id]
+            )
+
+    def list_serials(self, household: str) -> List[dict]:
+        """列出某个家庭的全部连续剧（不含章节内容）"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, child, character, setting, current_chapter, updated FROM serials "
+                "WHERE household = ? ORDER BY updated DESC", (household,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def save_serial(self, story: dict, household: str, child: str) -> int:
+        """保存连续剧：更新元数据，只追加新的章节，返回连续剧编号"""
+        meta = {k: v for k, v in story.items() if k not in SERIAL_COLUMNS and k not in CHAPTER_FIELDS}
+        values = [story.get(column) for column in SERIAL_COLUMNS]
+        now = _now()
+        with self._transaction() as conn:
+            serial_id = story.get("serial_id")
+            if serial_id is None:
+                cursor = conn.execute(
+                    "INSERT INTO serials (household, child, character, setting, elements, story_summary, "
+                    "current_chapter, meta, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [household, child] + values + [json.dumps(meta, ensure_ascii=False), now, now]
+                )
+                serial_id = cursor.lastrowid
+            else:
+                conn.execute(
+                    "UPDATE serials SET character = ?, setting = ?, elements = ?, story_summary = ?, "
+                    "current_chapter = ?, meta = ?, updated = ? WHERE id = ?",
+                    values + [json.dumps(meta, ensure_ascii=False), now, serial_id]
+                )
+
+            stored = conn.execute(
+                "SELECT COALESCE(MAX(chapter_num), 0) FROM chapters WHERE serial_id = ?", (serial_id,)
+            ).fetchone()[0]
+            chapters = story.get("chapters", [])
+            summaries = story.get("chapter_summaries", [])
+            conn.executemany(
+                "INSERT INTO chapters (serial_id, chapter_num, text, summary, preview) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (serial_id, i + 1, chapters[i], summaries[i] if i < len(summaries) else None,
+                     make_preview(chapters[i]))
+                    for i in range(stored, len(chapters))
+                ]
+            )
+            # 补上之前保存时还没有的章节摘要
+            conn.executemany(
+                "UPDATE chapters SET summary = ? WHERE serial_id = ? AND chapter_num = ? AND summary IS NULL",
+                [(summaries[i], serial_id, i + 1) for i in range(min(stored, len(summaries)))]
+            )
+        story["serial_id"] = serial_id
+        return serial_id
+
+    def migrate_from_json(self, child_file: str, serial_file: str, household: str, child: str) -> dict:
+        """把旧的 JSON 记录导入数据库，重复执行不会重复导入"""
+        result = {"child": False, "serial": False}
+        if os.path.exists(child_file) and self.get_child(household, child) is None:
+            with open(child_file, "r", encoding="utf-8") as f:
+                self.save_child(household, child, json.load(f))
+            result["child"] = True
+        if os.path.exists(serial_file):
+            with open(serial_file, "r", encoding="utf-8") as f:
+                story = json.load(f)
+            existing = self.find_serial(household, child, story.get("setting"))
+            if not existing or existing.get("story_summary") != story.get("story_summary"):
+                story.pop("serial_id", None)
+                self.save_serial(story, household, child)
+                result["serial"] = True
+        return result
+
+class _Transaction:
+    """加锁并在 BEGIN IMMEDIATE / COMMIT 之间执行写操作，出错时回滚"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+        return False
+
+def household_path(path: str, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> str:
+    """不使用数据库时（家庭、孩子）各自的 JSON 文件；只有 default 家庭的 default 孩子沿用原来的文件名，
+    与 STORY_HOUSEHOLD 的设置无关，命令行和服务对同一家庭总是使用同一个文件"""
+    if (household, child) == ("default", "default"):
+        return path
+    tag = hashlib.sha1(f"{household}\0{child}".encode("utf-8")).hexdigest()[:16]
+    root, ext = os.path.splitext(path)
+    return f"{root}.{tag}{ext}"
+
+_story_store = None
+
+def get_story_store() -> Optional[StoryStore]:
+    """返回全局存储实例，未设置 STORY_DB_PATH 时返回 None"""
+    global _story_store
+    if _story_store is None and STORY_DB_PATH:
+        _story_store = StoryStore(STORY_DB_PATH)
+    return _story_store
+
+def main():
+    parser = argparse.ArgumentParser(description="故事数据存储管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="把 child_info.json 和 serial_story.json 导入数据库")
+    migrate_parser.add_argument("--db", default=STORY_DB_PATH or "stories.db", help="数据库路径")
+    migrate_parser.add_argument("--household", default=STORY_HOUSEHOLD, help="家庭标识")
+    migrate_parser.add_argument("--child", default=STORY_CHILD, help="孩子标识")
+    migrate_parser.add_argument("--child-file", help="孩子信息文件，默认为该家庭和孩子的 child_info.json")
+    migrate_parser.add_argument("--serial-file", help="连续剧文件，默认为该家庭和孩子的 serial_story.json")
+    args = parser.parse_args()
+
+    child_file = args.child_file or household_path("child_info.json", args.household, args.child)
+    serial_file = args.serial_file or household_path("serial_story.json", args.household, args.child)
+    store = StoryStore(args.db)
+    result = store.migrate_from_json(child_file, serial_file, args.household, args.child)
+    print(f"孩子信息：{'已导入' if result['child'] else '无需导入'}")
+    print(f"连续剧：{'已导入' if result['serial'] else '无需导入'}")
+    print(f"请设置 STORY_DB_PATH={args.db} 以使用数据库存储")
+
+if __name__ == "__main__":
+    main()
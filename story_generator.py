@@ -3,121 +3,201 @@ story_generator.py
 AI故事生成与概要生成相关逻辑
 """
 
-import openai
 import os
-from typing import List
-from dotenv import load_dotenv
+import re
+import time
+from typing import Callable, Iterator, List, Optional
+from llm_client import STORY_DEADLINE_SECONDS, create_chat_completion, get_client, get_deployment, hedged_chat_completion
+from fallback_stories import get_fallback_stories
+from metrics import record_cache, record_event, span
+from prompt_builder import AGE_BUCKETS, char_ceiling, prompt_fields, completion_budget, get_age_bucket, render_prompt, word_limit_text
+from response_cache import get_response_cache, make_cache_key
+from safety_filter import StreamScreen, screen_story
+from story_index import get_story_index
+from utils import LengthLimiter
 
-# 加载环境变量
-load_dotenv()
+# 故事生成失败时返回的提示文本
+STORY_FAILURE_MESSAGE = "抱歉，故事生成失败，请稍后重试。"
 
-# Azure OpenAI 配置
-openai.api_type = "azure"
-openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai.api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-openai.api_key = os.getenv("AZURE_OPENAI_API_KEY")
+# 系统提示词和概要生成要求
+SUMMARY_SYSTEM_MESSAGE = "你是一个专业的儿童故事策划人。请确保每个故事概要控制在40-60个字之间。"
+SUMMARY_INSTRUCTIONS = "\n请根据上述要求生成三个不同方向的故事概要，要求：\n1. 每个概要控制在40-60个字之间\n2. 用数字编号（1. 2. 3.）分别列出三个概要\n3. 每个概要应该包含：主角、场景、主要情节和结局\n4. 确保三个概要风格统一，但内容各不相同\n5. 请仔细检查字数，确保每个概要都在40-60个字之间"
+SUMMARY_REPAIR_INSTRUCTIONS = "\n已经选定以下故事概要：\n{existing}\n请再生成{count}个与上面方向不同的故事概要，要求：\n1. 每个概要控制在40-60个字之间\n2. 用数字编号（1. 2. ...）列出\n3. 每个概要应该包含：主角、场景、主要情节和结局"
+STORY_SYSTEM_MESSAGE = "你是一个温柔的儿童故事作家。"
+
+# 流式生成时达到年龄段字数上限后，在下一个句末停止接收，设为0关闭
+STORY_EARLY_STOP = os.getenv("STORY_EARLY_STOP", "1") != "0"
+
+# 概要数量、字数范围，以及生成一组概要最多调用AI的次数
+SUMMARY_COUNT = 3
+SUMMARY_MIN_CHARS = 40
+SUMMARY_MAX_CHARS = 60
+MAX_SUMMARY_CALLS = 3
+
+# 以“1. ”“2、”“3．”“1）”等编号开头的概要，一直匹配到下一个编号或文本结尾
+SUMMARY_PATTERN = re.compile(r"^\s*\d+\s*[.、．)）:：]\s*(.+?)(?=^\s*\d+\s*[.、．)）:：]|\Z)", re.M | re.S)
 
 # 这里可以放置生成故事概要、生成完整故事等函数
 
 def convert_months_to_prompt_info(months: int):
     """年龄段判断与提示模板"""
-    if months <= 36:
-        return 2, "400 到 600", "- 使用非常简单的词汇和句子\n- 重复句式，有节奏感，适合朗读\n- 内容温柔，没有复杂情节"
-    elif months <= 60:
-        return 4, "600 到 1000", "- 语言简单清晰，加入基础情节\n- 有角色简单互动和因果关系\n- 风格温和、结局温馨"
-    else:
-        return 6, "1000 到 1500", "- 故事情节稍复杂，加入冲突与解决\n- 增加对话和情感表达\n- 故事结构完整，寓意积极向上"
+    bucket = get_age_bucket(months)
+    _, age_display, _, _, style_notes = AGE_BUCKETS[bucket]
+    return age_display, word_limit_text(bucket), style_notes
 
 def build_prompt(months: int, character: str, elements: str, setting: str) -> str:
-    """Prompt 构建器"""
-    age_display, word_limit, style_notes = convert_months_to_prompt_info(months)
-    prompt = f"""你是一个有爱心的儿童故事作家，请为一个{age_display}岁的孩子创作一个睡前故事。\n
-故事主角名字叫：{character}。\n故事应包含元素：{elements}。\n故事发生在：{setting}。\n
-请严格遵守以下要求：
-- 字数控制在{word_limit}字之间
-- {style_notes}
-- 内容积极健康，适合儿童阅读
-- 结局温馨美好
-- 不要包含恐怖、暴力、消极等内容
-- 用中文输出故事，分段清晰，适合朗读\n"""
-    return prompt
-
-def generate_story_summaries(prompt: str) -> list:
-    """生成故事概要列表"""
+    """Prompt 构建器：年龄段和场景固定的部分只格式化一次"""
+    return render_prompt(months, character, elements, setting)
+
+def count_summary_chars(summary: str) -> int:
+    """计算概要字数（不含空白）"""
+    return len(''.join(c for c in summary if c.strip()))
+
+def parse_summaries(content: str) -> List[str]:
+    """从AI回复中解析带编号的概要，编号后直到下一个编号之前的内容都属于同一个概要"""
+    summaries = []
+    for match in SUMMARY_PATTERN.finditer(content):
+        lines = [line.strip() for line in match.group(1).splitlines() if line.strip()]
+        if lines:
+            summaries.append(" ".join(lines))
+    return summaries
+
+def trim_summary(summary: str) -> str:
+    """在句子或分句边界处截短过长的概要，无法截到字数范围内时返回 None"""
+    sentence_cut = None
+    clause_cut = None
+    for i, char in enumerate(summary):
+        if char not in "。！？；，":
+            continue
+        # 在分句处截断时把逗号、分号换成句号
+        candidate = summary[:i] + ("。" if char in "；，" else char)
+        char_count = count_summary_chars(candidate)
+        if char_count > SUMMARY_MAX_CHARS:
+            break
+        if char_count >= SUMMARY_MIN_CHARS:
+            if char in "。！？":
+                sentence_cut = candidate
+            else:
+                clause_cut = candidate
+    # 优先在完整句子处结束
+    return sentence_cut or clause_cut
+
+def build_story_prompt(base_prompt: str, summary: str) -> str:
+    """根据选定的概要构建完整故事的提示词"""
+    return base_prompt + f"\n请根据以下故事概要展开创作：\n{summary}"
+
+def _prompt_setting(prompt: str) -> str:
+    fields = prompt_fields(prompt)
+    return fields[1] if fields else None
+
+def has_told_summary(summaries: List[str], household: str) -> bool:
+    """启用相似故事索引时，这组概要中是否有与这个家庭以前讲过的故事几乎相同的"""
+    index = get_story_index() if household else None
+    return bool(index) and any(index.is_duplicate(household, "summary", summary) for summary in summaries)
+
+def remember_summary(prompt: str, summary: str, household: str):
+    """记录用户选定的概要，之后的概要与它雷同时会被剔除"""
+    index = get_story_index() if household else None
+    if index and summary:
+        index.remember(household, "summary", summary, _prompt_setting(prompt))
+
+def remember_story(prompt: str, story: str, household: str):
+    """记录讲给这个家庭的完整故事；流式生成和推测生成的故事也要记录"""
+    index = get_story_index() if household else None
+    if index and story and story != STORY_FAILURE_MESSAGE:
+        index.remember(household, "story", story, _prompt_setting(prompt))
+
+def generate_story_summaries(prompt: str, use_cache: bool = True, stats: dict = None, household: str = None) -> list:
+    """生成故事概要列表：保留合格的概要，只为缺少的名额请求AI补充。
+    提供 household 且启用相似故事索引时，剔除与这个家庭以前讲过的故事雷同的概要，并提醒AI避开最近的情节"""
+    deployment = get_deployment()
+    valid_summaries = []
+    calls = 0
+    from_cache = False
+    cache = get_response_cache() if use_cache else None
+    cache_key = make_cache_key(deployment, SUMMARY_SYSTEM_MESSAGE, prompt + SUMMARY_INSTRUCTIONS, 0.8, 0.95, 500)
+    index = get_story_index() if household else None
+    # 提示放在最后，不影响缓存键和提示词前缀
+    avoid_hint = index.avoid_hint(household, _prompt_setting(prompt)) if index else ""
+    
     try:
         print("正在生成故事概要...")
-        print("提示：正在连接AI服务，这可能需要几秒钟时间...")
-        
-        response = openai.ChatCompletion.create(
-            engine=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-            messages=[
-                {"role": "system", "content": "你是一个专业的儿童故事策划人。请确保每个故事概要控制在40-60个字之间。"},
-                {"role": "user", "content": prompt + "\n请根据上述要求生成三个不同方向的故事概要，要求：\n1. 每个概要控制在40-60个字之间\n2. 用数字编号（1. 2. 3.）分别列出三个概要\n3. 每个概要应该包含：主角、场景、主要情节和结局\n4. 确保三个概要风格统一，但内容各不相同\n5. 请仔细检查字数，确保每个概要都在40-60个字之间"}
-            ],
-            max_tokens=500,
-            temperature=0.8,
-            top_p=0.95
-        )
+        content = cache.get(cache_key) if cache else None
+        if cache:
+            record_cache("summaries", bool(content))
+        if content:
+            print("[缓存命中] 使用已缓存的故事概要")
+            from_cache = True
         
-        if not response or not response.choices:
-            print("错误：AI服务返回空响应")
-            return []
+        while len(valid_summaries) < SUMMARY_COUNT:
+            missing = SUMMARY_COUNT - len(valid_summaries)
+            if content is None:
+                if calls >= MAX_SUMMARY_CALLS:
+                    break
+                if valid_summaries:
+                    # 只请求缺少的概要，并告知已有的方向以避免重复
+                    existing = "\n".join(f"- {summary}" for summary in valid_summaries)
+                    user_prompt = prompt + SUMMARY_REPAIR_INSTRUCTIONS.format(existing=existing, count=missing)
+                    max_tokens = 200 * missing
+                    print(f"\n正在补充{missing}个故事概要...")
+                else:
+                    user_prompt = prompt + SUMMARY_INSTRUCTIONS
+                    max_tokens = 500
+                    print("提示：正在连接AI服务，这可能需要几秒钟时间...")
+                user_prompt += avoid_hint
+                
+                calls += 1
+                response = create_chat_completion(
+                    "summary_repair" if valid_summaries else "summary",
+                    model=deployment,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_SYSTEM_MESSAGE},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    max_tokens=max_tokens,
+                    temperature=0.8,
+                    top_p=0.95
+                )
+                if not response or not response.choices:
+                    print("错误：AI服务返回空响应")
+                    continue
+                content = response.choices[0].message.content.strip()
+                print("\nAI返回的原始内容：")
+                print(content)
             
-        content = response.choices[0].message.content.strip()
-        print("\nAI返回的原始内容：")
-        print(content)
-        print("\n正在解析故事概要...")
-        
-        # 优化概要解析逻辑
-        summaries = []
-        current_summary = []
+            print("\n正在解析故事概要...")
+            for summary in parse_summaries(content):
+                if len(valid_summaries) >= SUMMARY_COUNT:
+                    break
+                char_count = count_summary_chars(summary)
+                print(f"发现概要，字数：{char_count}")
+                if char_count > SUMMARY_MAX_CHARS:
+                    trimmed = trim_summary(summary)
+                    if trimmed:
+                        print(f"概要过长，已在句子边界处截短为{count_summary_chars(trimmed)}字")
+                        summary = trimmed
+                        char_count = count_summary_chars(summary)
+                if index and index.is_duplicate(household, "summary", summary):
+                    print("概要与以前讲过的故事过于相似，将单独补充")
+                elif SUMMARY_MIN_CHARS <= char_count <= SUMMARY_MAX_CHARS and summary not in valid_summaries:
+                    valid_summaries.append(summary)
+                else:
+                    print(f"概要字数不符合要求（当前{char_count}字），将单独补充")
+            content = None
         
-        for line in content.strip().split("\n"):
-            line = line.strip()
-            if not line:
-                continue
-                
-            # 检查是否是新的概要开始（以数字开头）
-            if line[0].isdigit() and line[1:3] in [". ", "、", "．"]:
-                if current_summary:
-                    summary_text = " ".join(current_summary)
-                    char_count = len(''.join(c for c in summary_text if c.strip()))
-                    print(f"发现概要，字数：{char_count}")
-                    summaries.append(summary_text)
-                current_summary = [line[3:].strip()]
-            else:
-                current_summary.append(line)
+        print(f"本次概要生成共调用AI {calls} 次")
+        if stats is not None:
+            stats["calls"] = calls
         
-        # 添加最后一个概要
-        if current_summary:
-            summary_text = " ".join(current_summary)
-            char_count = len(''.join(c for c in summary_text if c.strip()))
-            print(f"发现概要，字数：{char_count}")
-            summaries.append(summary_text)
+        if len(valid_summaries) < SUMMARY_COUNT:
+            print(f"概要数量不足（当前{len(valid_summaries)}个），已达到最多{MAX_SUMMARY_CALLS}次调用")
+            return []
         
-        # 确保只返回三个概要，并且每个概要都在40-60个字之间
-        if len(summaries) >= 3:
-            # 检查每个概要的字数
-            valid_summaries = []
-            for i, summary in enumerate(summaries[:3], 1):
-                # 移除所有标点符号和空格后计算字数
-                char_count = len(''.join(c for c in summary if c.strip()))
-                print(f"概要{i}字数：{char_count}")
-                if 40 <= char_count <= 60:
-                    valid_summaries.append(summary)
-                else:
-                    print(f"概要{i}字数不符合要求（当前{char_count}字），需要重新生成")
-                    return generate_story_summaries(prompt)
-            
-            if len(valid_summaries) == 3:
-                print("成功生成三个符合要求的概要！")
-                return valid_summaries
-            else:
-                print(f"概要数量不足（当前{len(valid_summaries)}个），需要重新生成")
-                return generate_story_summaries(prompt)
-        else:
-            print(f"生成的概要数量不足（当前{len(summaries)}个），需要重新生成")
-            return generate_story_summaries(prompt)
+        print("成功生成三个符合要求的概要！")
+        # 只缓存校验通过的概要
+        if cache and not from_cache:
+            cache.put(cache_key, "\n".join(f"{i}. {summary}" for i, summary in enumerate(valid_summaries, 1)))
+        return valid_summaries
             
     except Exception as e:
         print(f"生成故事概要时发生错误：{str(e)}")
@@ -125,22 +205,47 @@ def generate_story_summaries(prompt: str) -> list:
         import traceback
         print("错误详情：")
         print(traceback.format_exc())
+        if stats is not None:
+            stats["calls"] = calls
         return []
 
-def select_story_summary(prompt: str) -> str:
-    """让用户选择或重新生成故事概要"""
+def select_story_summary(prompt: str, summary_source: Callable[[], list] = None,
+                         on_summaries: Callable[[list], None] = None, household: str = None) -> str:
+    """让用户选择或重新生成故事概要；提供 summary_source 时优先使用预生成的概要，
+    on_summaries 在每组概要展示给用户时调用。用户选择退出或多次生成失败时返回 None"""
+    with span("flow", "select_summary") as event:
+        summary = _select_story_summary(prompt, summary_source, on_summaries, event, household)
+    remember_summary(prompt, summary, household)
+    return summary
+
+def _select_story_summary(prompt: str, summary_source: Callable[[], list],
+                          on_summaries: Callable[[list], None], event: dict, household: str) -> str:
     max_retries = 3
     retry_count = 0
+    # 统计本次选择共调用AI的次数；重新生成时跳过缓存
+    total_calls = 0
+    regenerate = False
     
     while retry_count < max_retries:
         print(f"\n尝试生成故事概要（第{retry_count + 1}次）...")
-        summaries = generate_story_summaries(prompt)
+        summaries = summary_source() if summary_source else []
+        if has_told_summary(summaries, household):
+            print("[概要池] 预生成的概要与以前讲过的故事过于相似，重新生成")
+            summaries = []
+        if summaries:
+            print("[概要池] 使用预生成的故事概要")
+        else:
+            call_stats = {}
+            summaries = generate_story_summaries(prompt, use_cache=not regenerate, stats=call_stats,
+                                                 household=household)
+            total_calls += call_stats.get("calls", 0)
+            event["llm_calls"] = total_calls
         
         if not summaries:
             retry_count += 1
+            event["retries"] = retry_count
             if retry_count < max_retries:
                 print(f"生成失败，将在3秒后重试...")
-                import time
                 time.sleep(3)
                 continue
             else:
@@ -150,41 +255,170 @@ def select_story_summary(prompt: str) -> str:
         print("\n=== 故事概要选项 ===")
         for i, summary in enumerate(summaries, 1):
             print(f"\n{i}. {summary}")
+        if on_summaries:
+            on_summaries(summaries)
         
         print("\n请选择：")
         print("1-3: 选择对应的故事概要")
         print("0: 重新生成故事概要")
-        print("q: 退出程序")
+        print("q: 退出")
         
         choice = input("\n请输入您的选择: ").strip().lower()
         
         if choice == 'q':
-            exit(0)
+            return None
         elif choice == '0':
             print("\n正在重新生成故事概要...")
+            regenerate = True
             continue
         elif choice in ['1', '2', '3']:
+            print(f"本次选择概要共调用AI {total_calls} 次")
             return summaries[int(choice) - 1]
         else:
             print("无效的选择，请重试。")
     
     return None
 
-def generate_story(prompt: str) -> str:
-    """故事生成器"""
+def generate_story(prompt: str, deadline_seconds: float = STORY_DEADLINE_SECONDS, use_fallback: bool = True,
+                   household: str = None) -> str:
+    """故事生成器：deadline_seconds 内没有生成成功时，改用同一年龄段和场景的备用故事（启用时），
+    只从预生成的故事和 household 自己的故事中选取。
+    提供 household 且启用相似故事索引时，与这个家庭以前讲过的故事雷同的结果会带着“避开这些情节”的提示重新生成一次，
+    重新生成失败时仍使用原来的故事"""
+    index = get_story_index() if household else None
+    start = time.monotonic()
+    story = _generate_story(prompt, deadline_seconds, use_fallback, household)
+    if not index or story == STORY_FAILURE_MESSAGE:
+        return story
+    remaining = deadline_seconds - (time.monotonic() - start)
+    if index.is_duplicate(household, "story", story) and remaining > 0:
+        print("故事与以前讲过的故事过于相似，正在重新生成...")
+        # 不使用备用故事：雷同的真实故事也比备用故事合适
+        retry = _generate_story(prompt + index.avoid_hint(household, _prompt_setting(prompt)), remaining, False,
+                                household)
+        if retry != STORY_FAILURE_MESSAGE:
+            story = retry
+    remember_story(prompt, story, household)
+    return story
+
+def _generate_story(prompt: str, deadline_seconds: float, use_fallback: bool, household: Optional[str]) -> str:
+    fallback = get_fallback_stories() if use_fallback else None
     try:
+        deployment = get_deployment()
+        cache = get_response_cache()
+        # 回复上限按提示词中的字数要求推导
+        max_tokens = completion_budget(prompt)
+        cache_key = make_cache_key(deployment, STORY_SYSTEM_MESSAGE, prompt, 0.8, 0.95, max_tokens)
+        cached = cache.get(cache_key) if cache else None
+        if cache:
+            record_cache("story", bool(cached))
+        if cached:
+            print("[缓存命中] 使用已缓存的故事")
+            return cached
+        
         print("正在连接Azure OpenAI服务...")
-        response = openai.ChatCompletion.create(
-            engine=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        # 慢请求会触发对冲请求，到达截止时间仍没有结果时抛出 TimeoutError
+        response = hedged_chat_completion(
+            "story",
+            deadline=time.monotonic() + deadline_seconds,
+            model=deployment,
             messages=[
-                {"role": "system", "content": "你是一个温柔的儿童故事作家。"},
+                {"role": "system", "content": STORY_SYSTEM_MESSAGE},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=1024,
+            max_tokens=max_tokens,
             temperature=0.8,
             top_p=0.95
         )
-        return response.choices[0].message.content.strip()
+        # 合成语音和保存之前审查内容，只改写出问题的段落
+        story = screen_story(response.choices[0].message.content.strip())
+        if story is None:
+            raise ValueError("故事改写后仍未通过内容审查")
+        if cache and story:
+            cache.put(cache_key, story)
+        if fallback:
+            fallback.remember(prompt, story, household)
+        return story
+    except Exception as e:
+        print(e)
+        story = fallback.pick(prompt, household) if fallback else None
+        if fallback:
+            record_cache("fallback_story", bool(story))
+        if story:
+            print("[备用故事] 生成超时或失败，使用同一年龄段和场景的备用故事")
+            return story
+        return STORY_FAILURE_MESSAGE
+
+def generate_story_stream(prompt: str, early_stop: bool = STORY_EARLY_STOP) -> Iterator[str]:
+    """流式故事生成器，逐段返回模型输出的文本；提前关闭生成器会同时关闭连接。
+    early_stop 时按提示词中的字数上限在句末截断，超出的部分既不计费也不会被合成语音"""
+    response = None
+    try:
+        deployment = get_deployment()
+        cache = get_response_cache()
+        # 回复上限按提示词中的字数要求推导
+        max_tokens = completion_budget(prompt)
+        cache_key = make_cache_key(deployment, STORY_SYSTEM_MESSAGE, prompt, 0.8, 0.95, max_tokens)
+        cached = cache.get(cache_key) if cache else None
+        if cache:
+            record_cache("story", bool(cached))
+        if cached:
+            print("[缓存命中] 使用已缓存的故事")
+            yield cached
+            return
+        
+        print("正在连接Azure OpenAI服务...")
+        start = time.perf_counter()
+        # span 只包住建立连接这一步：生成器跨越多次 yield，整段耗时在结束后单独记录
+        with span("llm", "story_stream_connect"):
+            response = get_client().chat.completions.create(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": STORY_SYSTEM_MESSAGE},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=max_tokens,
+                temperature=0.8,
+                top_p=0.95,
+                stream=True
+            )
+        parts = []
+        first_token_ms = None
+        max_chars = char_ceiling(prompt) if early_stop else None
+        limiter = LengthLimiter(max_chars) if max_chars else None
+        # 逐句审查：通过的句子立即输出，出问题的段落改写后再输出
+        screen = StreamScreen()
+        for chunk in response:
+            # Azure 的首个分片可能只包含内容过滤结果，没有 choices
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - start) * 1000, 3)
+                if limiter:
+                    content = limiter.feed(content)
+                for text in screen.feed(content) if content else []:
+                    parts.append(text)
+                    yield text
+                if limiter and limiter.done:
+                    # 关闭连接（见 finally），服务端随即停止生成
+                    print(f"\n[字数控制] 已达到{max_chars}字上限，在句末停止生成")
+                    break
+        for text in screen.flush():
+            parts.append(text)
+            yield text
+        # 完整接收或在句末截断后才写入缓存
+        story = "".join(parts).strip()
+        record_event("llm", "story_stream", (time.perf_counter() - start) * 1000,
+                     first_token_ms=first_token_ms, chars=len(story), truncated=bool(limiter and limiter.done),
+                     rewritten=screen.rewritten, dropped=screen.dropped)
+        if cache and story:
+            cache.put(cache_key, story)
     except Exception as e:
         print(e)
-        return "抱歉，故事生成失败，请稍后重试。" 
\ No newline at end of file
+    finally:
+        # 调用方不再需要时关闭流，服务端随即停止生成
+        close = getattr(response, "close", None)
+        if close:
+            close() 
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""
+story_index.py
+按家庭记录讲过的故事：用字符 n-gram 的 MinHash 签名和 LSH 分桶在本地找出与以前几乎相同的概要和故事，
+在展示之前剔除，并在下一次的提示词中提醒AI避开最近讲过的情节
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import operator
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from storage import STORY_HOUSEHOLD
+
+# 设置后启用相似故事索引，每个家庭一个追加写入的 JSONL 文件
+STORY_INDEX_DIR = os.getenv("STORY_INDEX_DIR", "")
+# 估计的相似度（n-gram 集合的 Jaccard 系数）达到该值即视为雷同
+STORY_DUP_THRESHOLD = float(os.getenv("STORY_DUP_THRESHOLD", "0.6"))
+# 每个家庭最多保留的记录数，超出时丢弃最早的；每天几个故事也足够保存数年
+STORY_INDEX_MAX_ENTRIES = int(os.getenv("STORY_INDEX_MAX_ENTRIES", "3000"))
+# 同时保留在内存中的家庭数，超出时释放最久未使用的
+MAX_LOADED_HOUSEHOLDS = 32
+# “避开这些情节”提示中列出的最近概要数和每条的字数
+AVOID_HINT_COUNT = 3
+AVOID_HINT_CHARS = 30
+
+# 字符 n-gram 长度；签名的格数，LSH 分为 BANDS 段、每段 ROWS 格。
+# 相似度0.6的两段文本成为候选的概率约89%，0.7时约98%，0.2以下几乎不会成为候选
+NGRAM = 3
+BANDS = 16
+ROWS = 4
+NUM_HASHES = BANDS * ROWS
+# 32位哈希值的高6位决定落在哪一格，低26位参与比较
+_BIN_SHIFT = 26
+_VALUE_MASK = (1 << _BIN_SHIFT) - 1
+_EMPTY = 1 << 32
+
+# 只比较文字和数字，忽略标点和空白
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+AVOID_HINT = "\n最近已经讲过下面这些故事，请构思不同的情节：\n{plots}"
+
+def minhash(text: str) -> array:
+    """文本的 MinHash 签名：NUM_HASHES 个32位整数。
+    用单次哈希分格（one permutation hashing）代替 NUM_HASHES 个独立的哈希函数：每个 n-gram 只算一次哈希，
+    按高位分到一格并保留每格的最小值；空格取右侧最近的非空格，加上距离作为偏移（旋转致密化）"""
+    text = NON_WORD_PATTERN.sub("", text)
+    signature = [_EMPTY] * NUM_HASHES
+    for i in range(max(len(text) - NGRAM + 1, 1)):
+        # crc32 的低位分布不均，乘以奇数常数打散后再取高位
+        h = zlib.crc32(text[i:i + NGRAM].encode("utf-8")) * 0x9E3779B1 & 0xFFFFFFFF
+        slot, value = h >> _BIN_SHIFT, h & _VALUE_MASK
+        if value < signature[slot]:
+            signature[slot] = value
+    filled = list(signature)
+    for slot in range(NUM_HASHES):
+        if signature[slot] == _EMPTY:
+            distance = 1
+            while signature[(slot + distance) % NUM_HASHES] == _EMPTY:
+                distance += 1
+            filled[slot] = signature[(slot + distance) % NUM_HASHES] + (distance << _BIN_SHIFT)
+    return array("I", filled)
+
+def similarity(a: array, b: array) -> float:
+    """两个签名估计的 Jaccard 相似度"""
+    return sum(map(operator.eq, a, b)) / NUM_HASHES
+
+def _band_keys(signature: array) -> List[Tuple[int, ...]]:
+    # 每段取间隔 BANDS 的格：致密化后相邻的格常常来自同一个值，放在同一段会产生大量误报的候选
+    return [(band,) + tuple(signature[band::BANDS]) for band in range(BANDS)]
+
+class HouseholdIndex:
+    """一个家庭的记录和 LSH 分桶；记录按时间先后排列，超过上限时淘汰最早的。
+    新记录追加到文件末尾，文件行数达到上限的两倍时只保留仍在内存中的记录"""
+
+    def __init__(self, path: str, max_entries: int = STORY_INDEX_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        self.buckets: Dict[Tuple[int, ...], List[int]] = {}
+        self._next_id = 0
+        self._lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 写了一半的最后一行，忽略
+                        continue
+                    self._lines += 1
+                    self._insert(dict(entry, sig=array("I", bytes.fromhex(entry["sig"]))))
+
+    def _insert(self, entry: dict):
+        entry_id = self._next_id
+        self._next_id += 1
+        self.entries[entry_id] = entry
+        for key in _band_keys(entry["sig"]):
+            self.buckets.setdefault((entry["kind"],) + key, []).append(entry_id)
+        while len(self.entries) > self.max_entries:
+            old_id, old = self.entries.popitem(last=False)
+            for key in _band_keys(old["sig"]):
+                bucket = self.buckets[(old["kind"],) + key]
+                bucket.remove(old_id)
+                if not bucket:
+                    del self.buckets[(old["kind"],) + key]
+
+    def find(self, kind: str, signature: array, threshold: float = STORY_DUP_THRESHOLD) -> Optional[dict]:
+        """返回最相似且达到阈值的记录；只和落在同一个桶里的候选比较签名"""
+        candidates = set()
+        for key in _band_keys(signature):
+            candidates.update(self.buckets.get((kind,) + key, ()))
+        best, best_score = None, threshold
+        for entry_id in candidates:
+            score = similarity(signature, self.entries[entry_id]["sig"])
+            if score >= best_score:
+                best, best_score = self.entries[entry_id], score
+        return best
+
+    def add(self, kind: str, text: str, signature: array, setting: str = None):
+        entry = {
+            "kind": kind, "sig": signature, "setting": setting,
+            # 只保留开头几个字，用于生成提示，不保存全文
+            "text": text[:AVOID_HINT_CHARS] if kind == "summary" else "",
+            "ts": round(time.time())
+        }
+        self._insert(entry)
+        if self._lines + 1 >= self.max_entries * 2:
+            self._compact()
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(self._dumps(entry) + "\n")
+            self._lines += 1
+
+    def recent(self, kind: str, setting: str = None, count: int = AVOID_HINT_COUNT) -> List[str]:
+        """最近的几条记录的开头，优先同一场景"""
+        texts = [e["text"] for e in reversed(self.entries.values())
+                 if e["kind"] == kind and e["text"] and (setting is None or e["setting"] == setting)]
+        return texts[:count]
+
+    @staticmethod
+    def _dumps(entry: dict) -> str:
+        return json.dumps(dict(entry, sig=entry["sig"].tobytes().hex()), ensure_ascii=False)
+
+    def _compact(self):
+        """重写文件，只保留仍在内存中的记录"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(self._dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self.entries)
+
+class StoryIndex:
+    """所有家庭的相似故事索引，按需加载各家庭的记录"""
+
+    def __init__(self, directory: str = STORY_INDEX_DIR, max_entries: int = STORY_INDEX_MAX_ENTRIES,
+                 threshold: float = STORY_DUP_THRESHOLD):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._loaded: "OrderedDict[str, HouseholdIndex]" = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def _household(self, household: Optional[str]) -> HouseholdIndex:
+        household = household or STORY_HOUSEHOLD
+        index = self._loaded.get(household)
+        if index is None:
+            name = hashlib.sha1(household.encode("utf-8")).hexdigest()[:16]
+            index = HouseholdIndex(os.path.join(self.directory, f"{name}.jsonl"), self.max_entries)
+            self._loaded[household] = index
+            if len(self._loaded) > MAX_LOADED_HOUSEHOLDS:
+                self._loaded.popitem(last=False)
+        self._loaded.move_to_end(household)
+        return index
+
+    def is_duplicate(self, household: Optional[str], kind: str, text: str) -> bool:
+        """text 是否与这个家庭以前的同类记录几乎相同"""
+        signature = minhash(text)
+        with self._lock:
+            return self._household(household).find(kind, signature, self.threshold) is not None
+
+    def remember(self, household: Optional[str], kind: str, text: str, setting: str = None):
+        """记录讲过的概要（kind="summary"）或故事（kind="story"）"""
+        if not text:
+            return
+        signature = minhash(text)
+        with self._lock:
+            index = self._household(household)
+            # 同一段内容只记录一次
+            if index.find(kind, signature, 1.0) is None:
+                index.add(kind, text, signature, setting)
+
+    def avoid_hint(self, household: Optional[str], setting: str = None) -> str:
+        """“避开这些情节”的提示，没有记录时为空"""
+        with self._lock:
+            index = self._household(household)
+            plots = index.recent("summary", setting) or index.recent("summary")
+        return AVOID_HINT.format(plots="\n".join(f"- {plot}" for plot in plots)) if plots else ""
+
+_index: Optional[StoryIndex] = None
+_index_lock = threading.Lock()
+
+def get_story_index() -> Optional[StoryIndex]:
+    """返回全局相似故事索引；未设置 STORY_INDEX_DIR 时返回 None"""
+    global _index
+    if not STORY_INDEX_DIR:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = StoryIndex()
+        return _index
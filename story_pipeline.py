@@ -0,0 +1,56 @@
+"""
+story_pipeline.py
+流式故事生成与边生成边合成语音的流水线
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Tuple
+
+from story_generator import STORY_FAILURE_MESSAGE, generate_story_stream
+from tts import stream_text_to_speech
+from utils import SentenceSplitter
+
+async def _stream_story_to_audio(prompt: str, output_file: str) -> str:
+    """在线程中消费模型输出，切分句子后送入语音合成队列"""
+    loop = asyncio.get_running_loop()
+    sentence_queue = asyncio.Queue()
+    story_parts = []
+
+    def produce():
+        splitter = SentenceSplitter()
+        try:
+            for text in generate_story_stream(prompt):
+                story_parts.append(text)
+                print(text, end="", flush=True)
+                for sentence in splitter.feed(text):
+                    loop.call_soon_threadsafe(sentence_queue.put_nowait, sentence)
+            for sentence in splitter.flush():
+                loop.call_soon_threadsafe(sentence_queue.put_nowait, sentence)
+        finally:
+            loop.call_soon_threadsafe(sentence_queue.put_nowait, None)
+
+    async def sentences():
+        while True:
+            sentence = await sentence_queue.get()
+            if sentence is None:
+                break
+            yield sentence
+
+    producer = loop.run_in_executor(None, produce)
+    written = await stream_text_to_speech(sentences(), output_file)
+    await producer
+    print(f"\n\n共合成{written}句语音")
+    return "".join(story_parts).strip()
+
+def generate_story_with_audio(prompt: str, prefix: str = "story") -> Tuple[str, str]:
+    """流式生成故事，同时按句子合成语音，返回故事文本和音频文件名"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_file = f"{prefix}_{timestamp}.mp3"
+
+    print("\n正在生成故事和语音，语音文件会边生成边写入...\n")
+    story = asyncio.run(_stream_story_to_audio(prompt, output_file))
+    if not story:
+        return STORY_FAILURE_MESSAGE, output_file
+    print(f"语音文件已保存为：{output_file}")
+    return story, output_file
@@ -0,0 +1,193 @@
+"""
+summary_pool.py
+故事概要池：按（年龄段、场景、故事元素）预先生成概要，后台补充
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import time
+import threading
+from typing import Callable, Dict, List, Optional
+
+from story_generator import build_prompt, convert_months_to_prompt_info, generate_story_summaries
+from utils import VALID_SETTINGS
+
+# 是否在交互流程中使用概要池
+SUMMARY_POOL_ENABLED = os.getenv("SUMMARY_POOL", "0") == "1"
+# 概要池记录文件
+SUMMARY_POOL_FILE = os.getenv("SUMMARY_POOL_FILE", "summary_pool.json")
+# 某个家庭未看过的概要少于低水位时触发后台补充，补充到目标数量为止
+POOL_LOW_WATERMARK = int(os.getenv("SUMMARY_POOL_LOW_WATERMARK", "6"))
+POOL_TARGET_SIZE = int(os.getenv("SUMMARY_POOL_TARGET_SIZE", "15"))
+# 每个组合最多保留的概要数量，超出时丢弃最早的
+POOL_MAX_SIZE = 60
+# 交互流程结束时最多等待后台补充多少秒；已生成的概要每批都会保存，未完成的部分下次再补充
+POOL_EXIT_WAIT = float(os.getenv("SUMMARY_POOL_EXIT_WAIT", "2"))
+# 预生成时主角用占位符代替，取用时替换为真实主角
+CHARACTER_PLACEHOLDER = "【主角】"
+# 每个年龄段用于构建提示词的代表月龄
+BUCKET_MONTHS = {2: 24, 4: 48, 6: 72}
+# 预热时使用的常见故事元素
+COMMON_ELEMENTS = ["友谊", "勇气", "音乐"]
+
+def summary_id(summary: str) -> str:
+    """概要的短哈希，用于记录家庭已看过的概要"""
+    return hashlib.sha1(summary.encode("utf-8")).hexdigest()[:12]
+
+def generate_bucket_summaries(months: int, setting: str, elements: str) -> List[str]:
+    """用占位主角生成一组概要，丢弃没有保留占位符的结果；不使用响应缓存，否则每次都得到同样的三个概要"""
+    prompt = build_prompt(months, CHARACTER_PLACEHOLDER, elements, setting)
+    prompt += f"\n请在概要中原样保留主角名字“{CHARACTER_PLACEHOLDER}”，不要替换成其他名字。"
+    return [s for s in generate_story_summaries(prompt, use_cache=False) if CHARACTER_PLACEHOLDER in s]
+
+class SummaryPool:
+    """预生成的概要池，记录每个家庭看过的概要，不足时在后台线程中补充"""
+
+    def __init__(self, path: str = SUMMARY_POOL_FILE, low_watermark: int = POOL_LOW_WATERMARK,
+                 target_size: int = POOL_TARGET_SIZE,
+                 generator: Callable[[int, str, str], List[str]] = generate_bucket_summaries):
+        self.path = path
+        self.low_watermark = low_watermark
+        self.target_size = target_size
+        self.generator = generator
+        self._lock = threading.Lock()
+        self._refilling = set()
+        self._threads: List[threading.Thread] = []
+        self.data = {"buckets": {}, "seen": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+            # 旧文件中可能留有已被丢弃的概要记录
+            self._prune_seen()
+
+    @staticmethod
+    def bucket_key(months: int, setting: str, elements: str) -> str:
+        age_display, _, _ = convert_months_to_prompt_info(months)
+        return f"{age_display}|{setting}|{elements.strip()}"
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _unseen(self, key: str, household: str) -> List[str]:
+        seen = set(self.data["seen"].get(household, []))
+        return [s for s in self.data["buckets"].get(key, []) if summary_id(s) not in seen]
+
+    def _prune_seen(self):
+        """家庭的已看记录只保留仍在池中的概要，记录总量不超过池的大小"""
+        pooled = {summary_id(s) for bucket in self.data["buckets"].values() for s in bucket}
+        for household, seen in list(self.data["seen"].items()):
+            kept = [sid for sid in seen if sid in pooled]
+            if kept:
+                self.data["seen"][household] = kept
+            else:
+                del self.data["seen"][household]
+
+    def add(self, months: int, setting: str, elements: str, summaries: List[str]) -> int:
+        """向概要池加入新的概要，返回实际加入（之前不在池中）的数量"""
+        key = self.bucket_key(months, setting, elements)
+        with self._lock:
+            bucket = self.data["buckets"].setdefault(key, [])
+            new = [s for s in dict.fromkeys(summaries) if s not in bucket]
+            bucket.extend(new)
+            dropped = bucket[:-POOL_MAX_SIZE]
+            del bucket[:-POOL_MAX_SIZE]
+            if dropped:
+                self._prune_seen()
+            self._save()
+        return len(new)
+
+    def take(self, months: int, setting: str, elements: str, character: str,
+             household: str = "default", count: int = 3) -> List[str]:
+        """取出该家庭没看过的概要并替换主角名字；数量不足时返回空列表"""
+        key = self.bucket_key(months, setting, elements)
+        with self._lock:
+            unseen = self._unseen(key, household)
+            served = unseen[:count] if len(unseen) >= count else []
+            if served:
+                seen = self.data["seen"].setdefault(household, [])
+                seen.extend(summary_id(s) for s in served)
+                self._save()
+            remaining = len(unseen) - len(served)
+        if remaining < self.low_watermark:
+            self.refill_async(months, setting, elements, household)
+        return [s.replace(CHARACTER_PLACEHOLDER, character) for s in served]
+
+    def refill(self, months: int, setting: str, elements: str, household: str = "default"):
+        """同步补充概要，直到该家庭未看过的概要达到目标数量"""
+        key = self.bucket_key(months, setting, elements)
+        # 连续生成失败或没有生成新概要时不再继续，避免无限重试
+        failures = 0
+        while failures < 3:
+            with self._lock:
+                if len(self._unseen(key, household)) >= self.target_size:
+                    break
+            summaries = self.generator(months, setting, elements)
+            if summaries and self.add(months, setting, elements, summaries):
+                failures = 0
+            else:
+                failures += 1
+
+    def refill_async(self, months: int, setting: str, elements: str, household: str = "default"):
+        """在后台线程中补充概要，同一组合同时只有一个补充任务"""
+        key = self.bucket_key(months, setting, elements)
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+
+        def run():
+            try:
+                self.refill(months, setting, elements, household)
+            except Exception as e:
+                print(f"后台补充概要失败：{str(e)}")
+            finally:
+                with self._lock:
+                    self._refilling.discard(key)
+
+        thread = threading.Thread(target=run, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def wait(self, timeout: Optional[float] = None):
+        """等待后台补充任务结束，timeout 为总的等待秒数；超时后补充线程随进程退出"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        self._threads = [t for t in self._threads if t.is_alive()]
+
+    def stats(self) -> Dict[str, int]:
+        """每个组合当前的概要数量"""
+        return {key: len(bucket) for key, bucket in self.data["buckets"].items()}
+
+    def warm(self, elements_list: List[str] = COMMON_ELEMENTS):
+        """为所有年龄段和场景预先生成概要"""
+        for months in BUCKET_MONTHS.values():
+            for setting in VALID_SETTINGS:
+                for elements in elements_list:
+                    print(f"\n预生成概要：{self.bucket_key(months, setting, elements)}")
+                    self.refill(months, setting, elements)
+
+_summary_pool = None
+
+def get_summary_pool() -> SummaryPool:
+    """返回全局概要池实例"""
+    global _summary_pool
+    if _summary_pool is None:
+        _summary_pool = SummaryPool()
+    return _summary_pool
+
+def main():
+    parser = argparse.ArgumentParser(description="预生成故事概要池")
+    parser.add_argument("--elements", nargs="*", default=COMMON_ELEMENTS, help="需要预生成的故事元素")
+    args = parser.parse_args()
+    pool = get_summary_pool()
+    pool.warm(args.elements)
+    print(f"\n概要池已更新：{pool.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -94,6 +94,1316 @@ def test_serial_story():
     except Exception as e:
         print(f"✗ 连续剧功能测试失败: {e}")
 
+def test_serial_story_memory():
+    """测试连续剧上下文压缩"""
+    print("\n=== 测试连续剧上下文压缩 ===")
+    
+    from serial_story import build_previous_context, ARC_SIZE
+    
+    chapters = [f"第{i}章的完整内容。" * 50 for i in range(1, 28)]
+    chapter_summaries = [f"第{i}章摘要" for i in range(1, 28)]
+    arc_summaries = [f"第{i + 1}篇章梗概" for i in range(len(chapters) // ARC_SIZE)]
+    
+    full_context = build_previous_context(chapters)
+    early_context = build_previous_context(chapters[:1], chapter_summaries[:1], [])
+    late_context = build_previous_context(chapters, chapter_summaries, arc_summaries)
+    print(f"全文上下文长度: {len(full_context)} 字符")
+    print(f"第2章压缩上下文长度: {len(early_context)} 字符")
+    print(f"第28章压缩上下文长度: {len(late_context)} 字符")
+    
+    assert len(late_context) < len(full_context) // 5
+    assert chapters[-1] in late_context and chapters[0] not in late_context
+    print("✓ 压缩上下文只保留最近章节全文")
+
+def test_prompt_builder():
+    """测试提示词组装：预编译模板、按字数推导回复上限、超出预算时按优先级裁剪"""
+    print("\n=== 测试提示词组装 ===")
+    
+    from prompt_builder import completion_budget, count_tokens, fit_sections, render_sections
+    from serial_story import build_context_sections, ARC_SIZE
+    from story_generator import build_prompt
+    
+    budgets = [completion_budget(build_prompt(months, "小兔子贝贝", "友谊", "森林")) for months in (24, 48, 72)]
+    print(f"各年龄段回复上限: {budgets}")
+    assert budgets[0] < 1024 and budgets == sorted(budgets)
+    assert completion_budget("没有字数要求的提示词") == 1024
+    assert "小兔子{贝贝}" in build_prompt(48, "小兔子{贝贝}", "友谊", "森林")
+    
+    chapters = [f"第{i}章的完整内容。" * 50 for i in range(1, 28)]
+    chapter_summaries = [f"第{i}章摘要" for i in range(1, 28)]
+    arc_summaries = [f"第{i + 1}篇章梗概" for i in range(len(chapters) // ARC_SIZE)]
+    sections = [("基础提示词", 0, "")] + build_context_sections(chapters, chapter_summaries, arc_summaries)
+    full_tokens = count_tokens(render_sections(sections))
+    kept = fit_sections(sections, full_tokens - 100)
+    text = render_sections(kept)
+    print(f"裁剪前 {full_tokens} tokens，裁剪后 {count_tokens(text)} tokens")
+    assert count_tokens(text) <= full_tokens - 100
+    # 先裁掉较早的全文，最近一章、摘要和篇章梗概保留
+    assert chapters[-1] in text and chapters[-2] not in text
+    assert "第1篇章梗概" in text and "第27章：" in text
+    assert render_sections(fit_sections(sections, 0)) == "基础提示词"
+    print("✓ 回复上限随字数要求变化，超出预算时先裁掉较早的章节全文")
+
+def test_sentence_splitter():
+    """测试流式断句"""
+    print("\n=== 测试流式断句 ===")
+    
+    from utils import SentenceSplitter, split_sentences
+    
+    text = "小兔子醒了。它问：“你好吗？”妈妈笑了！晚安"
+    splitter = SentenceSplitter()
+    sentences = []
+    for char in text:
+        sentences.extend(splitter.feed(char))
+    sentences.extend(splitter.flush())
+    print(f"切分结果: {sentences}")
+    
+    assert sentences == ["小兔子醒了。", "它问：“你好吗？”", "妈妈笑了！", "晚安"]
+    assert split_sentences(text) == sentences
+    print("✓ 逐字输入与整段切分结果一致")
+
+def test_length_limiter():
+    """测试流式字数控制：达到上限后在下一个句末截断，并关闭AI流"""
+    print("\n=== 测试流式字数控制 ===")
+    
+    import os
+    from unittest import mock
+    from fake_llm import FAKE_STORY_PARAGRAPH, start_fake_server
+    from llm_client import reset_clients
+    from story_generator import generate_story_stream
+    from utils import LengthLimiter
+    
+    # 逐字输入，句末标点后的引号在下一个片段中
+    limiter = LengthLimiter(8)
+    text = "小兔子说：“晚安啦！”然后睡着了。第二天早上。"
+    output = "".join(limiter.feed(char) for char in text)
+    assert output == "小兔子说：“晚安啦！”" and limiter.done
+    assert limiter.feed("还有更多内容。") == ""
+    
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    try:
+        with mock.patch.dict(os.environ, env), mock.patch("story_generator.get_response_cache", return_value=None), \
+                mock.patch("story_generator.char_ceiling", return_value=50):
+            reset_clients()
+            full = "".join(generate_story_stream("讲一个睡前故事", early_stop=False))
+            short = "".join(generate_story_stream("讲一个睡前故事"))
+    finally:
+        reset_clients()
+        server.shutdown()
+        server.server_close()
+    print(f"完整输出 {len(full)} 字，截断后 {len(short)} 字")
+    assert full.startswith(short) and len(short) < len(full)
+    assert short.endswith("。") and len(short) >= 50
+    assert short.count(FAKE_STORY_PARAGRAPH) == 1
+    print("✓ 达到字数上限后在句末停止接收")
+
+def test_story_audio_pipeline():
+    """测试边生成边合成：语音按句子顺序写入，只保留第一段的 ID3 标签，生成结束前已经写出第一段语音"""
+    print("\n=== 测试边生成边合成语音 ===")
+    
+    import os
+    import time
+    import tempfile
+    from unittest import mock
+    import story_pipeline
+    import tts
+    from fake_llm import start_fake_server
+    from fake_tts import FAKE_ID3_HEADER, FakeTTSBackend
+    from llm_client import reset_clients
+    from story_pipeline import generate_story_with_audio
+    from utils import split_sentences
+    
+    original_stream = story_pipeline.generate_story_stream
+    stream_state = {}
+    
+    def slow_stream(prompt):
+        # 模拟模型逐句输出，生成结束时记录音频文件已写入的字节数
+        for text in original_stream(prompt):
+            time.sleep(0.05)
+            yield text
+        stream_state["finished"] = time.perf_counter()
+        stream_state["written"] = os.path.getsize(stream_state["output_file"])
+    
+    backend = FakeTTSBackend(latency=0.01)
+    original_backend = tts.get_tts_backend()
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+                mock.patch("story_generator.get_response_cache", return_value=None), \
+                mock.patch("story_pipeline.generate_story_stream", side_effect=slow_stream), \
+                mock.patch("story_pipeline.datetime") as fake_datetime:
+            fake_datetime.now.return_value.strftime.return_value = "test"
+            stream_state["output_file"] = os.path.join(tmp_dir, "story_test.mp3")
+            reset_clients()
+            tts.set_tts_backend(backend)
+            story, output_file = generate_story_with_audio("讲一个睡前故事", os.path.join(tmp_dir, "story"))
+            with open(output_file, "rb") as f:
+                data = f.read()
+    finally:
+        tts.set_tts_backend(original_backend)
+        reset_clients()
+        server.shutdown()
+        server.server_close()
+    
+    sentences = split_sentences(story)
+    print(f"共{len(sentences)}句，音频 {len(data)} 字节，生成结束时已写入 {stream_state['written']} 字节")
+    assert output_file == stream_state["output_file"]
+    # 只有文件开头保留一个 ID3 标签，其余内容按句子顺序拼接
+    assert data.startswith(FAKE_ID3_HEADER) and data.count(b"ID3") == 1
+    assert data[len(FAKE_ID3_HEADER):].decode("utf-8") == "".join(sentences)
+    print("✓ 语音按句子顺序写入，只保留第一段的标签")
+    
+    # 第一段语音在模型输出结束之前就已经合成并写入文件
+    assert stream_state["written"] > 0
+    assert min(start for start, _ in backend.calls) < stream_state["finished"]
+    print("✓ 生成结束前已写出第一段语音")
+
+def test_batch_rate_limit():
+    """测试批量生成的令牌桶限流"""
+    print("\n=== 测试批量生成限流 ===")
+    
+    import os
+    import time
+    from unittest import mock
+    from batch import TokenBucket, backoff_delay
+    from fake_llm import start_fake_server
+    from llm_client import call_with_limiter, reset_clients
+    from story_generator import build_prompt, generate_story_summaries
+    
+    # 容量2、每秒20个令牌：取6个令牌至少需要 4/20 秒
+    bucket = TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+    print(f"取得6个令牌耗时: {elapsed:.3f} 秒")
+    
+    assert elapsed >= 0.18
+    assert all(0 <= backoff_delay(attempt, base=1, cap=5) <= 5 for attempt in range(10))
+    print("✓ 令牌桶按速率放行请求")
+    
+    # 每个 HTTP 请求（包括失败后的重试）都取一个令牌，而不是每次函数调用取一个
+    server, url = start_fake_server(failure_rate=0.3, seed=3)
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    bucket = TokenBucket(rate=1e-9, capacity=100)
+    with mock.patch.dict(os.environ, env), mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("llm_client.LLM_MAX_RETRIES", 5):
+        reset_clients()
+        try:
+            call_with_limiter(bucket, generate_story_summaries, build_prompt(48, "小兔子", "友谊", "森林"))
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    used = round(100 - bucket.tokens)
+    print(f"一次概要生成发出 {len(server.recent_prompts)} 个请求，取得 {used} 个令牌")
+    assert used == len(server.recent_prompts) > 1
+    print("✓ 限流按实际发出的请求计数")
+
+def test_batch_end_to_end():
+    """测试批量生成端到端：按任务文件生成，失败的请求按任务重试，结果逐行写入输出文件"""
+    print("\n=== 测试批量生成端到端 ===")
+    
+    import os
+    import json
+    import tempfile
+    from unittest import mock
+    from batch import run_batch
+    from fake_llm import start_fake_server
+    from llm_client import reset_clients
+    
+    jobs = [
+        {"id": f"story{i}", "months": 48, "setting": "森林", "character": f"小兔子{i}", "elements": "友谊"}
+        for i in range(4)
+    ]
+    jobs.append({"id": "chapter", "months": 60, "setting": "海洋", "character": "小海豚", "elements": "勇气",
+                 "story_type": 2})
+    # 缺少月龄的任务不重试
+    jobs.append({"id": "invalid", "setting": "森林", "character": "小熊", "elements": "友谊"})
+    
+    # 单个请求不重试，失败直接交给任务级的重试
+    server, url = start_fake_server(failure_rate=0.3, seed=7)
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("batch.get_response_cache", return_value=None), \
+            mock.patch("llm_client.LLM_MAX_RETRIES", 0), \
+            mock.patch("batch.backoff_delay", return_value=0):
+        jobs_path = os.path.join(tmp_dir, "jobs.jsonl")
+        output_path = os.path.join(tmp_dir, "results.jsonl")
+        with open(jobs_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(json.dumps(job, ensure_ascii=False) for job in jobs) + "\n")
+        reset_clients()
+        try:
+            stats = run_batch(jobs_path, output_path, concurrency=1, rate=1000, burst=100, retries=10)
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+        with open(output_path, "r", encoding="utf-8") as f:
+            results = {result["id"]: result for result in map(json.loads, f)}
+    
+    print(f"统计: {stats}，共尝试 {sum(r['attempts'] for r in results.values())} 次")
+    assert stats == {"ok": 5, "failed": 1}
+    assert set(results) == {job["id"] for job in jobs}
+    assert all("晚安" in results[f"story{i}"]["story"] for i in range(4))
+    assert results["chapter"]["status"] == "ok" and results["chapter"]["chapter_num"] == 1
+    assert results["invalid"]["status"] == "failed" and results["invalid"]["attempts"] == 1
+    assert "任务格式错误" in results["invalid"]["error"]
+    # 注入的失败由任务级重试恢复
+    assert any(result["attempts"] > 1 for result in results.values() if result["status"] == "ok")
+    print("✓ 结果逐行写入，失败的请求重试后成功，格式错误的任务不重试")
+
+def test_response_cache():
+    """测试回复缓存"""
+    print("\n=== 测试回复缓存 ===")
+    
+    import os
+    import time
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    from response_cache import ResponseCache, make_cache_key
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        key = make_cache_key("deployment", "system", "prompt", 0.8, 0.95, 1024)
+        assert key != make_cache_key("deployment", "system", "prompt", 0.8, 0.95, 500)
+        
+        cache = ResponseCache(cache_dir, max_bytes=10 * 1024, max_age=3600, variants=2)
+        assert cache.get(key) is None
+        cache.put(key, "故事一")
+        # 缓存的回复不足2个时仍视为未命中
+        assert cache.get(key) is None
+        cache.put(key, "故事二")
+        assert cache.get(key) in ["故事一", "故事二"]
+        print(f"缓存统计: {cache.stats()}")
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+        
+        # 超过大小上限时淘汰最久未访问的条目
+        for i in range(50):
+            cache.put(make_cache_key("d", "s", str(i), 0.8, 0.95, 1024), "很长的故事内容" * 20)
+        assert cache.total_bytes <= cache.max_bytes
+        total = sum(os.path.getsize(os.path.join(root, name))
+                    for root, _, files in os.walk(cache_dir) for name in files)
+        assert total == cache.total_bytes
+        print("✓ 缓存命中、多版本采样和大小淘汰正常")
+        
+        # 多个线程同时写同一个键：每次写入使用独立的临时文件，结果始终是完整的 JSON
+        shared = ResponseCache(os.path.join(cache_dir, "shared"), max_bytes=1024 * 1024, max_age=3600, variants=3)
+        shared_key = make_cache_key("d", "s", "shared", 0.8, 0.95, 1024)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda i: (shared.put(shared_key, f"故事{i}"), shared.get(shared_key)), range(64)))
+        assert len(shared._load(shared_key)["variants"]) == 3
+        assert shared.stats()["hits"] + shared.stats()["misses"] == 64
+        assert not [name for _, _, files in os.walk(shared.cache_dir) for name in files if name.endswith(".tmp")]
+        
+        # 过期按最近访问时间计算，与淘汰一致
+        old = time.time() - 7200
+        os.utime(shared._path(shared_key), (old, old))
+        assert shared.get(shared_key) is None and shared._load(shared_key) is None
+        
+        # 写入失败不抛出异常，也不留下临时文件
+        with mock.patch("response_cache.os.replace", side_effect=OSError("disk full")):
+            shared.put(shared_key, "故事")
+        assert shared._load(shared_key) is None
+        assert not [name for _, _, files in os.walk(shared.cache_dir) for name in files]
+        print("✓ 并发写入、按访问时间过期和写入失败处理正常")
+
+def test_summary_parsing():
+    """测试概要解析与本地截短"""
+    print("\n=== 测试概要解析 ===")
+    
+    from story_generator import parse_summaries, trim_summary, count_summary_chars
+    
+    content = "好的，以下是三个概要：\n1. 小兔子在森林里\n迷路了。\n2、小松鼠找到了松果。\n\n3）小鹿学会了唱歌。"
+    summaries = parse_summaries(content)
+    print(f"解析结果: {summaries}")
+    assert len(summaries) == 3 and summaries[1] == "小松鼠找到了松果。"
+    
+    long_summary = "小兔子在森林里迷路了，遇到了小松鼠，小松鼠带它找到了回家的路。回到家后妈妈给了它一个大大的拥抱，它们一起吃了香甜的胡萝卜，然后安心地睡着了。"
+    trimmed = trim_summary(long_summary)
+    print(f"截短后字数: {count_summary_chars(trimmed)}")
+    assert 40 <= count_summary_chars(trimmed) <= 60 and trimmed.endswith("。")
+    assert trim_summary("太短了。") is None
+    print("✓ 概要解析和截短正常")
+
+def test_summary_pool():
+    """测试概要池"""
+    print("\n=== 测试概要池 ===")
+    
+    import os
+    import time
+    import tempfile
+    from unittest import mock
+    from summary_pool import SummaryPool, CHARACTER_PLACEHOLDER, summary_id
+    
+    generated = []
+    
+    def fake_generator(months, setting, elements):
+        start = len(generated)
+        batch = [f"{CHARACTER_PLACEHOLDER}在{setting}里的第{start + i}个冒险故事。" for i in range(3)]
+        generated.extend(batch)
+        return batch
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pool = SummaryPool(os.path.join(tmp_dir, "pool.json"), low_watermark=3,
+                           target_size=6, generator=fake_generator)
+        # 池为空时返回空列表，并在后台补充
+        assert pool.take(48, "森林", "友谊", "小兔子贝贝") == []
+        pool.wait()
+        
+        first = pool.take(48, "森林", "友谊", "小兔子贝贝", household="A")
+        second = pool.take(48, "森林", "友谊", "小兔子贝贝", household="A")
+        other = pool.take(48, "森林", "友谊", "小鹿", household="B")
+        pool.wait()
+        print(f"家庭A第一次: {first}")
+        
+        assert len(first) == 3 and "小兔子贝贝" in first[0]
+        assert not set(first) & set(second)
+        assert other[0] == first[0].replace("小兔子贝贝", "小鹿")
+        # 同一年龄段的其他月龄共用概要池
+        assert pool.bucket_key(40, "森林", "友谊") == pool.bucket_key(60, "森林", " 友谊")
+        print("✓ 概要池按家庭去重并在后台补充")
+        
+        # 生成器总是返回同样的概要（如命中缓存）时，补充在几轮之后停止
+        repeated = []
+        def same_generator(months, setting, elements):
+            repeated.append(1)
+            return [f"{CHARACTER_PLACEHOLDER}在海洋里的冒险故事。"]
+        stuck = SummaryPool(os.path.join(tmp_dir, "stuck.json"), target_size=6, generator=same_generator)
+        stuck.refill(48, "海洋", "友谊")
+        assert len(repeated) == 4 and stuck.stats() == {stuck.bucket_key(48, "海洋", "友谊"): 1}
+        print("✓ 没有新概要时停止补充")
+        
+        # 概要被挤出池后，家庭的已看记录随之清理
+        with mock.patch("summary_pool.POOL_MAX_SIZE", 6):
+            small = SummaryPool(os.path.join(tmp_dir, "small.json"), low_watermark=0, generator=fake_generator)
+            small.add(48, "森林", "友谊", [f"{CHARACTER_PLACEHOLDER}的第{i}个故事。" for i in range(6)])
+            served = small.take(48, "森林", "友谊", "小熊", household="A")
+            assert len(small.data["seen"]["A"]) == 3
+            small.add(48, "森林", "友谊", [f"{CHARACTER_PLACEHOLDER}的新故事。"])
+        pooled = {summary_id(s) for s in small.data["buckets"][small.bucket_key(48, "森林", "友谊")]}
+        assert set(small.data["seen"]["A"]) <= pooled and len(small.data["seen"]["A"]) == 2
+        assert served[0] == "小熊的第0个故事。"
+        reloaded = SummaryPool(os.path.join(tmp_dir, "small.json"))
+        assert reloaded.data["seen"] == small.data["seen"]
+        print("✓ 已看记录只保留仍在池中的概要")
+        
+        # 后台补充很慢时，wait 在超时后返回
+        def slow_generator(months, setting, elements):
+            time.sleep(1)
+            return []
+        slow = SummaryPool(os.path.join(tmp_dir, "slow.json"), generator=slow_generator)
+        slow.refill_async(48, "森林", "友谊")
+        start = time.monotonic()
+        slow.wait(0.1)
+        assert time.monotonic() - start < 0.5 and slow._threads
+        print("✓ 退出时等待后台补充有时间上限")
+
+def test_speculative_generation():
+    """测试推测生成"""
+    print("\n=== 测试推测生成 ===")
+    
+    import time
+    from speculative import SpeculativeStoryGenerator
+    
+    completed = []
+    
+    def fake_generate(prompt, cancel_event):
+        # 模拟流式生成，被取消时提前结束
+        for _ in range(20):
+            if cancel_event.is_set():
+                return None
+            time.sleep(0.01)
+        completed.append(prompt.splitlines()[-1])
+        return "故事：" + prompt.splitlines()[-1]
+    
+    speculative = SpeculativeStoryGenerator("基础提示", max_calls=5, generate=fake_generate)
+    speculative.start(["概要一", "概要二", "概要三"])
+    # 重新生成概要时丢弃全部推测，且受次数上限限制
+    speculative.start(["概要四", "概要五", "概要六"])
+    story = speculative.take("概要五")
+    speculative.shutdown()
+    time.sleep(0.3)
+    print(f"选中的故事: {story}，推测次数: {speculative.calls}，完整生成: {completed}")
+    
+    # 第二轮只剩2次额度：概要四被取消，概要六没有推测
+    assert story == "故事：概要五"
+    assert speculative.calls == 5
+    assert completed == ["概要五"]
+    print("✓ 推测生成按选择保留结果并取消其余任务")
+
+def test_prefetch_pending():
+    """测试预生成章节的作废规则"""
+    print("\n=== 测试预生成章节 ===")
+    
+    from prefetch import get_pending_chapter
+    
+    def make_story(chapter_num, age_display):
+        return {
+            "current_chapter": 3,
+            "pending": {"chapter_num": chapter_num, "chapter": "第四章", "age_display": age_display}
+        }
+    
+    assert get_pending_chapter(make_story(4, 4), 48)["chapter"] == "第四章"
+    # 章节号不对或年龄段变化时作废
+    story = make_story(5, 4)
+    assert get_pending_chapter(story, 48) is None and "pending" not in story
+    story = make_story(4, 4)
+    assert get_pending_chapter(story, 61) is None and "pending" not in story
+    print("✓ 预生成章节按进度和年龄段校验")
+
+def test_chunked_tts():
+    """测试分段并发语音合成"""
+    print("\n=== 测试分段语音合成 ===")
+    
+    import asyncio
+    import os
+    import tempfile
+    import tts
+    
+    class StubTTSBackend(tts.TTSBackend):
+        """本地桩后端：每段第一次合成失败，返回带 ID3 头的假数据"""
+        
+        def __init__(self):
+            self.calls = {}
+        
+        async def synthesize(self, text, voice):
+            self.calls[text] = self.calls.get(text, 0) + 1
+            if self.calls[text] == 1:
+                raise ConnectionError("模拟网络错误")
+            await asyncio.sleep(0.01)
+            return b"ID3\x04\x00\x00\x00\x00\x00\x02xx" + text.encode("utf-8")
+    
+    text = "\n\n".join(f"第{i}段。" + "小兔子慢慢地睡着了。" * 20 for i in range(5))
+    chunks = tts.split_text_chunks(text, max_chars=250)
+    print(f"文本长度: {len(text)}，切分为 {len(chunks)} 段")
+    assert all(len(chunk) <= 250 for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+    
+    backend = StubTTSBackend()
+    original_backend = tts.get_tts_backend()
+    tts.set_tts_backend(backend)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, "story.mp3")
+            asyncio.run(tts.text_to_speech(text, output_file))
+            with open(output_file, "rb") as f:
+                data = f.read()
+    finally:
+        tts.set_tts_backend(original_backend)
+    
+    # 只有第一段保留 ID3 头，其余段按顺序拼接
+    assert data.count(b"ID3") == 1
+    assert data.replace(b"ID3\x04\x00\x00\x00\x00\x00\x02xx", b"").decode("utf-8") == "".join(
+        tts.split_text_chunks(text))
+    assert all(count == 2 for count in backend.calls.values())
+    print("✓ 失败的段单独重试，音频按顺序拼接")
+
+def test_audio_cache():
+    """测试语音缓存"""
+    print("\n=== 测试语音缓存 ===")
+    
+    import os
+    import tempfile
+    from audio_cache import AudioCache, make_audio_key
+    
+    key = make_audio_key("小兔子\n\n睡着了。", "zh-CN-XiaoxiaoNeural", "+0%", "+0Hz")
+    # 排版差异不影响缓存键，语速不同则是不同的语音
+    assert key == make_audio_key(" 小兔子 睡着了。", "zh-CN-XiaoxiaoNeural", "+0%", "+0Hz")
+    assert key != make_audio_key("小兔子 睡着了。", "zh-CN-XiaoxiaoNeural", "-10%", "+0Hz")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = AudioCache(os.path.join(tmp_dir, "cache"), max_bytes=2500)
+        assert cache.get(key) is None
+        for i in range(4):
+            source = os.path.join(tmp_dir, f"chapter{i}.mp3")
+            with open(source, "wb") as f:
+                f.write(b"\xff" * 1000)
+            os.utime(source, (1000 + i, 1000 + i))
+            cache.put_file(f"key{i}", source)
+            os.utime(cache.path(f"key{i}"), (1000 + i, 1000 + i))
+        # 容量只够两个文件，最早的被淘汰
+        assert cache.get("key0") is None and cache.get("key3")
+        print(f"缓存统计: {cache.stats()}")
+        print("✓ 语音缓存按内容寻址并按容量淘汰")
+
+def test_story_store():
+    """测试 SQLite 多家庭存储"""
+    print("\n=== 测试多家庭存储 ===")
+    
+    import json
+    import os
+    import tempfile
+    from storage import StoryStore
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = StoryStore(os.path.join(tmp_dir, "stories.db"))
+        story = {
+            "character": "小兔子贝贝", "setting": "森林", "elements": "友谊",
+            "current_chapter": 1, "chapters": ["第一章"], "story_summary": "概要",
+            "chapter_summaries": [], "arc_summaries": []
+        }
+        store.save_serial(story, "家庭A", "老大")
+        story["chapters"].append("第二章")
+        story["chapter_summaries"] = ["第一章摘要", "第二章摘要"]
+        story["current_chapter"] = 2
+        store.save_serial(story, "家庭A", "老大")
+        # 同一家庭另一个孩子的连续剧互不影响
+        store.save_serial(dict(story, serial_id=None, chapters=["别的故事"], chapter_summaries=[]), "家庭A", "老二")
+        
+        loaded = store.find_serial("家庭A", "老大", "森林")
+        print(f"读取连续剧: 第{loaded['current_chapter']}章，章节 {loaded['chapters']}")
+        assert loaded["chapters"] == ["第一章", "第二章"]
+        assert loaded["chapter_summaries"] == ["第一章摘要", "第二章摘要"]
+        assert store.find_serial("家庭A", "老大", "海洋") is None
+        assert store.find_serial("家庭B", "老大", "森林") is None
+        
+        # 从旧的 JSON 文件迁移，重复执行不会重复导入
+        child_file = os.path.join(tmp_dir, "child_info.json")
+        serial_file = os.path.join(tmp_dir, "serial_story.json")
+        with open(child_file, "w", encoding="utf-8") as f:
+            json.dump({"start_date": "2025-05-26", "base_months": 61, "gender": "女"}, f)
+        with open(serial_file, "w", encoding="utf-8") as f:
+            json.dump(dict(story, setting="海洋"), f, ensure_ascii=False)
+        assert store.migrate_from_json(child_file, serial_file, "家庭B", "default") == {"child": True, "serial": True}
+        assert store.migrate_from_json(child_file, serial_file, "家庭B", "default") == {"child": False, "serial": False}
+        assert store.get_child("家庭B", "default")["base_months"] == 61
+        assert len(store.list_serials("家庭B")) == 1
+        store.conn.close()
+        print("✓ 按家庭和场景存取连续剧，追加章节并支持迁移")
+
+def test_chapter_paging():
+    """测试章节延迟加载和分页读取"""
+    print("\n=== 测试章节分页读取 ===")
+    
+    import json
+    import os
+    import tempfile
+    from chapter_store import (
+        write_serial_file, load_serial_meta_file, read_chapters_file, chapter_previews_file
+    )
+    from storage import StoryStore
+    
+    story = {
+        "character": "小兔子贝贝", "setting": "森林", "elements": "友谊",
+        "current_chapter": 5, "chapters": [f"第{i}章“正文”\n" + "字" * 120 for i in range(1, 6)],
+        "story_summary": "概要", "chapter_summaries": []
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # JSON 文件：格式与 json.dump 相同，按偏移索引读取单个章节
+        path = os.path.join(tmp_dir, "serial_story.json")
+        write_serial_file(path, story)
+        with open(path, "r", encoding="utf-8") as f:
+            assert f.read() == json.dumps(story, ensure_ascii=False, indent=2)
+        meta = load_serial_meta_file(path)
+        assert "chapters" not in meta and meta["chapter_count"] == 5
+        assert read_chapters_file(path, 4, 3) == story["chapters"][3:]
+        assert chapter_previews_file(path)[0].endswith("...")
+        print(f"JSON 元数据: {meta['chapter_count']}章，第4-5章按偏移读取")
+        
+        # 文件被其他程序改写后索引作废，退回完整读取
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(story, chapters=["新的第一章"]), f, ensure_ascii=False)
+        assert load_serial_meta_file(path)["chapter_count"] == 1
+        assert read_chapters_file(path, 1, 3) == ["新的第一章"]
+        
+        # SQLite：只读取元数据、预览和指定页的章节
+        store = StoryStore(os.path.join(tmp_dir, "stories.db"))
+        serial_id = store.save_serial(dict(story), "家庭A", "老大")
+        meta = store.find_serial_meta("家庭A", "老大", "森林")
+        assert "chapters" not in meta and meta["chapter_count"] == 5
+        assert store.get_chapters(serial_id, 2, 2) == story["chapters"][1:3]
+        assert len(store.chapter_previews(serial_id)) == 5
+        store.update_serial_meta(serial_id, {"chapter_audio": {"1": "key"}})
+        loaded = store.find_serial("家庭A", "老大")
+        assert loaded["chapter_audio"] == {"1": "key"} and loaded["chapters"] == story["chapters"]
+        store.conn.close()
+        print("✓ 元数据不含正文，章节按页读取")
+
+def test_chapter_journal():
+    """测试章节预写日志：生成后保存前崩溃，重启后恢复该章而不重新生成"""
+    print("\n=== 测试章节预写日志 ===")
+    
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    from unittest import mock
+    from chapter_journal import ChapterJournal
+    from fake_llm import start_fake_server
+    from llm_client import reset_clients
+    from metrics import get_metrics
+    from service import StoryService
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = ChapterJournal(os.path.join(tmp_dir, "serial.journal"))
+        journal.record("serial-a", 3, "第三章", "p1")
+        with open(journal.path, "a", encoding="utf-8") as f:
+            f.write('{"op": "chapter", "key": "serial-a", "chap')  # 崩溃时写了一半的行
+        assert journal.recover("serial-a", 3, "p1") == "第三章"
+        assert journal.recover("serial-a", 3, "p2") is None
+        journal.commit("serial-a", 3)
+        assert journal.pending() == [] and not os.path.exists(journal.path)
+        print("✓ 日志可以重放、容忍半行记录，合并后清空")
+        
+        # 后台预生成进程追加记录的同时，本进程反复合并日志
+        script = ("import sys; from chapter_journal import ChapterJournal; j = ChapterJournal(sys.argv[1])\n"
+                  "for i in range(40): j.record('serial-' + sys.argv[2], i, 'text')")
+        writers = [subprocess.Popen([sys.executable, "-c", script, journal.path, name],
+                                    cwd=os.path.dirname(os.path.abspath(__file__))) for name in ("b", "c")]
+        i = 0
+        while any(writer.poll() is None for writer in writers):
+            journal.record("serial-a", i, "text")
+            journal.commit("serial-a", i)
+            i += 1
+        assert all(writer.returncode == 0 for writer in writers)
+        assert len(journal.pending()) == 80
+        print("✓ 跨进程写入日志时合并不会丢失记录")
+    
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    metrics = get_metrics()
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("serial_story.SERIAL_STORY_FILE", os.path.join(tmp_dir, "serial_story.json")):
+        reset_clients()
+        try:
+            service = StoryService()
+            service.start_serial("森林", "小兔子贝贝", "友谊", "小兔子贝贝在森林里交到新朋友。", 60)
+            metrics.reset()
+            # 第2章生成后、保存完成前进程崩溃
+            with mock.patch("service.save_serial_story", side_effect=OSError("模拟崩溃")):
+                try:
+                    service.next_chapter("森林", 60)
+                    assert False, "应当抛出异常"
+                except OSError:
+                    pass
+            journal_path = os.path.join(tmp_dir, "serial_story.json.journal")
+            assert os.path.exists(journal_path)
+            result = StoryService().next_chapter("森林", 60)
+            chapter_calls = metrics.snapshot()["calls"]["llm.chapter"]["count"]
+            print(f"崩溃后重试，第{result['chapter_num']}章共调用AI生成 {chapter_calls} 次")
+            assert result["chapter_num"] == 2 and chapter_calls == 1
+            assert not os.path.exists(journal_path)
+        finally:
+            metrics.reset()
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    print("✓ 未保存的章节从日志恢复，保存成功后从日志移除")
+
+def test_serial_planner():
+    """测试大纲模式：一次调用生成28章大纲，章节并发生成，最后加上过渡句"""
+    print("\n=== 测试大纲模式 ===")
+    
+    import os
+    import tempfile
+    import time
+    from unittest import mock
+    from fake_llm import FAKE_TRANSITION, start_fake_server
+    from llm_client import reset_clients
+    from types import SimpleNamespace
+    from serial_planner import generate_outline, parse_outline, parse_outline_items
+    from serial_story import load_serial_story
+    from service import StoryService
+    
+    assert parse_outline("2. 第二章\n1. 第一章\n3、第三章") == ["第一章", "第二章", "第三章"]
+    # 空的章节不会让后面的情节错位
+    assert parse_outline("1. 甲\n2.\n3. 丙\n4. 丁") == ["甲", "丙", "丁"]
+    assert parse_outline_items("1. 甲\n2.\n3. 丙\n4. 丁") == {1: "甲", 3: "丙", 4: "丁"}
+    
+    # 大纲缺了一章时从缺少的那一章起重新请求，各章情节与章节号对应
+    replies = iter(["1. 甲\n2.\n3. 丙\n4. 丁", "2. 乙\n3. 丙\n4. 丁"])
+    def fake_completion(*args, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=next(replies)))])
+    with mock.patch("serial_planner.create_chat_completion", side_effect=fake_completion), \
+            mock.patch("serial_planner.get_deployment", return_value="fake-deployment"):
+        assert generate_outline("提示词", "梗概", chapters=4) == ["甲", "乙", "丙", "丁"]
+    print("✓ 大纲编号和情节一起解析，缺少的章节单独补充")
+    
+    latency = 0.1
+    server, url = start_fake_server(latency=latency)
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("serial_story.SERIAL_STORY_FILE", os.path.join(tmp_dir, "serial_story.json")):
+        reset_clients()
+        try:
+            start = time.perf_counter()
+            result = StoryService().plan_serial(
+                "森林", "小兔子贝贝", "友谊", "小兔子贝贝在森林里交到新朋友。", 60, concurrency=14
+            )
+            elapsed = time.perf_counter() - start
+            saved = load_serial_story("森林")
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    print(f"生成{result['chapters']}章用时 {elapsed:.2f}s，AI请求 {len(server.usage_log)} 次")
+    assert result["chapters"] == 28 and len(saved["outline"]) == 28
+    assert saved["current_chapter"] == 28 and len(saved["chapter_summaries"]) == 28
+    assert len(saved["arc_summaries"]) == 4
+    # 1次大纲 + 28章 + 27处过渡
+    assert len(server.usage_log) == 1 + 28 + 27
+    assert not saved["chapters"][0].startswith(FAKE_TRANSITION)
+    assert all(chapter.startswith(FAKE_TRANSITION) for chapter in saved["chapters"][1:])
+    # 顺序生成至少需要28个往返
+    assert elapsed < 28 * latency
+    print("✓ 大纲保存在连续剧记录中，章节并发生成")
+
+def test_hedged_requests():
+    """测试对冲请求和截止时间：慢请求触发重复请求，超过截止时间时改用备用故事"""
+    print("\n=== 测试对冲请求 ===")
+    
+    import os
+    import json
+    import tempfile
+    import time
+    from unittest import mock
+    from fake_llm import start_fake_server
+    from fallback_stories import CHARACTER_PLACEHOLDER, FallbackStories
+    from llm_client import (
+        CHAPTER_DEADLINE_SECONDS, HEDGE_MIN_SAMPLES, LLM_HEDGE_DEFAULT_SECONDS, completion_deadline, get_client,
+        hedge_delay, record_latency, reset_clients
+    )
+    from serial_story import generate_serial_story_chapter
+    from metrics import get_metrics
+    from story_generator import STORY_FAILURE_MESSAGE, build_prompt, generate_story
+    
+    reset_clients()
+    for i in range(HEDGE_MIN_SAMPLES * 5):
+        record_latency("story", (i + 1) / 100)
+    # 100个样本的第95百分位
+    assert hedge_delay("story") == 0.96
+    assert hedge_delay("chapter") > 0.96
+    
+    env = {"AZURE_OPENAI_API_KEY": "test-key", "AZURE_OPENAI_API_VERSION": "2024-06-01",
+           "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"}
+    prompt = build_prompt(48, "小兔子贝贝", "友谊", "森林")
+    # 样本不足时按 max_tokens 估计生成时间，长故事不会过早对冲
+    assert hedge_delay("chapter", 4000) == 100 and hedge_delay("chapter", 100) == LLM_HEDGE_DEFAULT_SECONDS
+    # 章节使用单独的、更长的截止时间
+    with mock.patch("serial_story.hedged_chat_completion", side_effect=RuntimeError("模拟失败")) as chapter_call:
+        generate_serial_story_chapter(prompt, 2, ["第一章。"])
+    assert chapter_call.call_args.kwargs["deadline"] - time.monotonic() > CHAPTER_DEADLINE_SECONDS - 5
+    assert completion_deadline(8000, CHAPTER_DEADLINE_SECONDS) == 400
+    
+    # 第一个请求卡住，0.1秒后发出的对冲请求先返回
+    server, url = start_fake_server(slow_requests=1, slow_latency=1.0)
+    with mock.patch.dict(os.environ, dict(env, AZURE_OPENAI_ENDPOINT=url)), \
+            mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("llm_client.LLM_HEDGE_DEFAULT_SECONDS", 0.1), \
+            mock.patch("llm_client.LLM_HEDGE_TOKENS_PER_SECOND", 1e9):
+        reset_clients()
+        get_metrics().reset()
+        try:
+            # 先创建客户端，首次导入 SDK 的耗时不计入
+            get_client()
+            start = time.perf_counter()
+            story = generate_story(prompt)
+            elapsed = time.perf_counter() - start
+            # 等待慢请求返回
+            for _ in range(100):
+                loser = get_metrics().snapshot()["calls"].get("llm.story_hedge_loser")
+                if loser:
+                    break
+                time.sleep(0.02)
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    assert story and story != STORY_FAILURE_MESSAGE
+    assert elapsed < 0.9
+    print(f"✓ 对冲请求 {elapsed:.2f}s 返回，没有等待慢请求")
+    assert loser["count"] == 1 and loser["completion_tokens"] > 0
+    assert len(server.usage_log) == 2
+    get_metrics().reset()
+    print("✓ 没被采用的请求也记录了 token 用量")
+    
+    # 所有请求都超过截止时间：有备用故事时替换主角后返回，没有时返回失败提示
+    server, url = start_fake_server(slow_requests=10, slow_latency=1.0)
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, dict(env, AZURE_OPENAI_ENDPOINT=url)), \
+            mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("llm_client.LLM_HEDGE_DEFAULT_SECONDS", 0.1), \
+            mock.patch("llm_client.LLM_HEDGE_TOKENS_PER_SECOND", 1e9):
+        fallback = FallbackStories(os.path.join(tmp_dir, "fallback_stories.json"))
+        fallback.remember(build_prompt(50, "小熊", "勇气", "森林"), "小熊在森林里迷了路，小熊最后回到了家。", "张家")
+        fallback.remember(build_prompt(72, "小熊", "勇气", "森林"), "六岁档的故事。", "张家")
+        fallback.remember(build_prompt(50, "小熊", "勇气", "森林"), "没有家庭的故事不保存。")
+        reset_clients()
+        try:
+            with mock.patch("story_generator.get_fallback_stories", return_value=fallback):
+                start = time.perf_counter()
+                story = generate_story(prompt, deadline_seconds=0.3, household="张家")
+                elapsed = time.perf_counter() - start
+                other = generate_story(prompt, deadline_seconds=0.3, household="李家")
+            failed = generate_story(build_prompt(48, "小兔子贝贝", "友谊", "海洋"), deadline_seconds=0.3)
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+        reloaded = FallbackStories(fallback.path)
+        assert reloaded._household("张家")[reloaded.bucket_key(1, "森林")][0]["character"] == "小熊"
+        # 各家庭的故事保存在各自的文件中，共用文件里只有预生成的故事
+        assert os.path.exists(fallback.household_file("张家")) and "households" not in reloaded.data
+        assert not os.path.exists(fallback.path)
+        # 内存中只保留最近使用的几个家庭
+        bounded = FallbackStories(fallback.path, max_households=2)
+        for household in ["甲家", "乙家", "丙家"]:
+            bounded.remember(build_prompt(50, "小熊", "勇气", "森林"), f"{household}的故事。", household)
+        assert list(bounded._households) == ["乙家", "丙家"]
+        assert bounded.pick(build_prompt(50, "小熊", "勇气", "森林"), "甲家") == "甲家的故事。"
+        # 旧版本的共用文件拆分到各家庭的文件
+        legacy_path = os.path.join(tmp_dir, "legacy.json")
+        with open(legacy_path, "w", encoding="utf-8") as f:
+            json.dump({"buckets": {}, "households": {"王家": {"4|森林": [{"character": "小鹿", "story": "小鹿的故事。"}]}}}, f)
+        legacy = FallbackStories(legacy_path)
+        assert legacy.data == {"buckets": {}}
+        assert FallbackStories(legacy_path)._household("王家")["4|森林"][0]["story"] == "小鹿的故事。"
+        # 预生成的故事所有家庭共用
+        fallback.remember(build_prompt(50, CHARACTER_PLACEHOLDER, "友谊", "森林"), f"{CHARACTER_PLACEHOLDER}回家了。")
+        shared = fallback.pick(prompt, "李家")
+    assert story == "小兔子贝贝在森林里迷了路，小兔子贝贝最后回到了家。"
+    assert elapsed < 0.9
+    assert other == failed == STORY_FAILURE_MESSAGE
+    assert shared == "小兔子贝贝回家了。"
+    print(f"✓ 超过截止时间 {elapsed:.2f}s 时改用同一家庭、同一年龄段和场景的备用故事，其他家庭只用预生成的故事")
+
+def test_safety_filter():
+    """测试内容审查：自动机与逐词查找结果一致，只改写命中词表的段落，流式输出按句审查"""
+    print("\n=== 测试内容审查 ===")
+    
+    import os
+    import random
+    from unittest import mock
+    from bench_safety import build_corpus, run_benchmark
+    from fake_llm import FAKE_REWRITE, FAKE_STORY_PARAGRAPH, start_fake_server
+    from llm_client import reset_clients
+    from safety_filter import AhoCorasick, StreamScreen, screen_story
+    from story_generator import generate_story, generate_story_stream
+    
+    words = ["ab", "abc", "bc", "c", "bca", "caab"]
+    automaton = AhoCorasick(words)
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice("abc") for _ in range(12))
+        expected = sorted((i, i + len(w), w) for w in words for i in range(len(text)) if text.startswith(w, i))
+        assert sorted(automaton.search(text)) == expected
+    print("✓ 自动机与逐词查找的结果一致")
+    
+    calls = []
+    def rewrite(text, terms, prefix):
+        calls.append((text, terms, prefix))
+        return "大家一起回家了。"
+    story = "第一段很好。\n小狼想杀死小兔。后来走了。\n第三段。"
+    assert screen_story(story, rewrite) == "第一段很好。\n大家一起回家了。\n第三段。"
+    assert calls == [("小狼想杀死小兔。后来走了。", ["杀死"], "")]
+    assert screen_story(story, lambda text, terms, prefix: "还是要杀死。") is None
+    print("✓ 只改写命中词表的段落，改写后仍不合格时返回 None")
+    
+    calls.clear()
+    screen = StreamScreen(rewrite)
+    out = []
+    for char in "开始了。小狼想杀死小兔。后来走了。\n\n第二段好。":
+        out += screen.feed(char)
+    out += screen.flush()
+    assert "".join(out) == "开始了。大家一起回家了。\n\n第二段好。"
+    # 已经输出的句子作为上下文，只改写本段剩下的部分
+    assert calls == [("小狼想杀死小兔。后来走了。", ["杀死"], "开始了。")]
+    print("✓ 流式输出按句审查，已输出的句子不受影响")
+    
+    # 对模拟服务：把故事中的词语加入词表，每一段都需要改写
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    with mock.patch.dict(os.environ, env), mock.patch("story_generator.get_response_cache", return_value=None), \
+            mock.patch("safety_filter._filter", AhoCorasick(["月亮升起"])):
+        reset_clients()
+        try:
+            story = generate_story("讲一个睡前故事")
+            streamed = "".join(generate_story_stream("讲一个睡前故事"))
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    assert FAKE_STORY_PARAGRAPH not in story and story.count(FAKE_REWRITE) == 8
+    assert streamed.count(FAKE_REWRITE) == 8 and "月亮升起" not in streamed
+    print("✓ 生成的故事在返回前完成审查")
+    
+    result = run_benchmark(build_corpus(200), [30, 300])
+    assert all(item["flagged"] == item["naive_flagged"] > 0 for item in result["results"])
+    print(f"✓ 审查基准：{result['stories']}个故事，每秒{result['results'][-1]['chars_per_second']}字")
+
+def test_prompt_caching():
+    """测试前缀稳定的提示词：相邻章节的提示词共用前缀，命中模拟服务的前缀缓存；批量任务按共同前缀分组"""
+    print("\n=== 测试提示词前缀缓存 ===")
+    
+    import os
+    from unittest import mock
+    from batch import group_by_prefix
+    from fake_llm import start_fake_server
+    from llm_client import reset_clients
+    from metrics import cached_token_ratio, get_metrics
+    from serial_planner import build_beat_prompt
+    from serial_story import generate_serial_story_chapter
+    from story_generator import build_prompt
+    
+    # 每次请求不同的主角和故事元素放在规则之后
+    prompt = build_prompt(48, "小兔子贝贝", "友谊", "森林")
+    assert prompt.index("请严格遵守") < prompt.index("故事发生在") < prompt.index("故事主角名字叫")
+    assert build_prompt(48, "小熊", "勇气", "森林").startswith(prompt[:prompt.index("故事主角名字叫")])
+    outline = [f"第{i}章的情节。" for i in range(1, 29)]
+    beat_prompts = [build_beat_prompt(prompt, "梗概", outline, n) for n in (1, 2)]
+    assert beat_prompts[0].split("这是第1章")[0] == beat_prompts[1].split("这是第2章")[0]
+    
+    chapters = [f"第{i}章的完整内容。" * 40 for i in range(1, 12)]
+    summaries = [f"第{i}章的摘要，主角和朋友们经历了一段长长的冒险，" * 5 for i in range(1, 12)]
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    with mock.patch.dict(os.environ, env):
+        reset_clients()
+        get_metrics().reset()
+        try:
+            for chapter_num in (11, 12):
+                generate_serial_story_chapter(prompt, chapter_num, chapters[:chapter_num - 1], "梗概",
+                                              summaries[:chapter_num - 1], [])
+        finally:
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+    first, second = server.usage_log
+    print(f"第12章提示词 {second['prompt_tokens']} token，命中缓存 {second['prompt_tokens_details']['cached_tokens']}")
+    assert first["prompt_tokens_details"]["cached_tokens"] == 0
+    assert second["prompt_tokens_details"]["cached_tokens"] >= 1024
+    ratio = cached_token_ratio(get_metrics().snapshot())
+    assert 0 < ratio < 1
+    print(f"✓ 相邻章节共用前缀，命中缓存比例 {ratio:.1%}")
+    
+    jobs = [
+        {"id": "1", "months": 48, "setting": "森林", "character": "小熊", "elements": "友谊"},
+        {"id": "2", "months": 72, "setting": "森林", "character": "小熊", "elements": "友谊"},
+        {"id": "3", "months": 50, "setting": "森林", "character": "小兔", "elements": "勇气"},
+        {"id": "4", "setting": "海洋"},
+    ]
+    assert [[job["id"] for job in group] for group in group_by_prefix(jobs)] == [["1", "3"], ["2"], ["4"]]
+    print("✓ 批量任务按年龄段和场景分组")
+
+def test_story_index():
+    """测试相似故事索引：雷同的概要在展示前被剔除，提示词带上最近的情节，记录数有上限且重启后仍在"""
+    print("\n=== 测试相似故事索引 ===")
+    
+    import os
+    import time
+    import tempfile
+    from unittest import mock
+    from fake_llm import FAKE_SUMMARY, start_fake_server
+    from llm_client import reset_clients
+    from story_generator import STORY_FAILURE_MESSAGE, build_prompt, generate_story, generate_story_summaries
+    from story_index import StoryIndex, minhash, similarity
+    
+    a = "小兔子贝贝在森林里发现一颗会发光的种子，和好朋友们一起照顾它，种子开出花朵照亮了回家的小路。"
+    b = "小兔子贝贝在森林里找到一颗会发光的种子，和好朋友们一起照顾它，种子开出花朵照亮了回家的小路！"
+    c = "小熊在海边捡到一个漂流瓶，里面是一封来自远方小岛的信，它和海鸥一起把回信送了回去。"
+    assert similarity(minhash(a), minhash(b)) >= 0.6 > 0.2 > similarity(minhash(c), minhash(a))
+    print(f"✓ 雷同概要的估计相似度 {similarity(minhash(a), minhash(b)):.2f}，不同概要 {similarity(minhash(a), minhash(c)):.2f}")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        index = StoryIndex(directory, max_entries=100)
+        index.remember("张家", "summary", a, "森林")
+        assert index.is_duplicate("张家", "summary", b)
+        assert not index.is_duplicate("张家", "summary", c)
+        assert not index.is_duplicate("李家", "summary", b)
+        assert not index.is_duplicate("张家", "story", b)
+        assert a[:30] in index.avoid_hint("张家", "森林") and not index.avoid_hint("李家", "森林")
+        print("✓ 只与同一家庭的同类记录比较")
+        
+        for i in range(300):
+            index.remember("张家", "story", f"第{i}个故事：" + c.replace("小熊", f"小熊{i * 7919}号") * 3)
+        household = index._household("张家")
+        assert len(household.entries) == 100
+        assert not index.is_duplicate("张家", "summary", b)
+        start = time.perf_counter()
+        for _ in range(200):
+            index.is_duplicate("张家", "story", a)
+        elapsed_us = (time.perf_counter() - start) / 200 * 1e6
+        reloaded = StoryIndex(directory, max_entries=100)
+        assert len(reloaded._household("张家").entries) == 100
+        assert reloaded.is_duplicate("张家", "story", f"第299个故事：" + c.replace("小熊", f"小熊{299 * 7919}号") * 3)
+        print(f"✓ 每个家庭最多保留100条记录，重新加载后仍在，每次查重约{elapsed_us:.0f}微秒")
+        
+        # 模拟服务的三个概要只有主角编号不同，以前讲过其中一个时全部被剔除
+        prompt = build_prompt(48, "小兔子", "友谊", "森林")
+        index.remember("王家", "summary", FAKE_SUMMARY.format(name="小兔子1号", place="森林"), "森林")
+        server, url = start_fake_server()
+        env = {
+            "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+            "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+        }
+        with mock.patch.dict(os.environ, env), mock.patch("story_generator.get_response_cache", return_value=None), \
+                mock.patch("story_generator.get_story_index", return_value=index):
+            reset_clients()
+            try:
+                fresh = generate_story_summaries(prompt, household="李家")
+                told = generate_story_summaries(prompt, household="王家")
+            finally:
+                reset_clients()
+                server.shutdown()
+                server.server_close()
+    assert len(fresh) == 3 and told == []
+    assert any("最近已经讲过下面这些故事" in p and "小兔子1号" in p for p in server.recent_prompts)
+    print("✓ 与以前讲过的故事雷同的概要在展示前被剔除，提示词列出了最近的情节")
+    
+    # 雷同的故事重新生成一次，不使用备用故事；重新生成失败时保留原来的故事
+    with tempfile.TemporaryDirectory() as directory:
+        index = StoryIndex(directory)
+        index.remember("张家", "story", a * 3)
+        calls = []
+        def fake_generate(prompt, deadline_seconds, use_fallback, household):
+            calls.append((prompt, use_fallback))
+            return a * 3 if len(calls) == 1 else STORY_FAILURE_MESSAGE
+        with mock.patch("story_generator.get_story_index", return_value=index), \
+                mock.patch("story_generator._generate_story", side_effect=fake_generate):
+            story = generate_story(prompt, household="张家")
+    assert story == a * 3
+    assert calls[0] == (prompt, True) and calls[1][1] is False and calls[1][0].startswith(prompt)
+    print("✓ 雷同的故事重新生成失败时保留原来的故事")
+
+def test_llm_client():
+    """测试共享客户端：对本地模拟服务生成故事，并复用同一个连接"""
+    print("\n=== 测试共享AI客户端 ===")
+    
+    import os
+    from unittest import mock
+    from fake_llm import start_fake_server
+    from llm_client import get_client, reset_clients
+    from story_generator import generate_story, generate_story_stream
+    
+    server, url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    try:
+        with mock.patch.dict(os.environ, env):
+            reset_clients()
+            assert get_client() is get_client()
+            stories = [generate_story("讲一个睡前故事") for _ in range(3)]
+            assert all("晚安" in story for story in stories)
+            print(f"非流式请求 3 次，建立连接 {server.connection_count} 个")
+            assert server.connection_count == 1
+            
+            streamed = "".join(generate_story_stream("讲一个睡前故事"))
+            assert streamed.strip() == stories[0]
+            print("✓ 同步请求复用连接，流式输出与完整输出一致")
+    finally:
+        reset_clients()
+        server.shutdown()
+        server.server_close()
+
+def test_story_service():
+    """测试无交互的 HTTP 服务：对本地模拟服务并发生成故事和连续剧章节"""
+    print("\n=== 测试故事服务 ===")
+    
+    import json
+    import os
+    import tempfile
+    import urllib.error
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    from fake_llm import start_fake_server
+    from llm_client import reset_clients
+    from serial_story import get_chapter_previews, get_chapters, load_serial_meta, load_serial_story
+    from service import StoryService, start_background_service
+    from storage import household_path
+    
+    def post(url, body):
+        request = urllib.request.Request(
+            url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+    
+    fake_server, fake_url = start_fake_server()
+    env = {
+        "AZURE_OPENAI_ENDPOINT": fake_url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("serial_story.SERIAL_STORY_FILE", os.path.join(tmp_dir, "serial_story.json")), \
+            mock.patch("user_profile.CHILD_INFO_FILE", os.path.join(tmp_dir, "child_info.json")):
+        reset_clients()
+        stop, url = start_background_service()
+        try:
+            story_args = {"months": 60, "setting": "森林", "character": "小兔子贝贝", "elements": "友谊"}
+            status, body = post(url + "/summaries", story_args)
+            assert status == 200 and len(body["summaries"]) == 3
+            
+            # 多个用户同时请求
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                results = list(pool.map(
+                    lambda summary: post(url + "/story", dict(story_args, summary=summary)), body["summaries"]
+                ))
+            assert all(status == 200 and "晚安" in result["story"] for status, result in results)
+            print(f"并发生成 {len(results)} 个故事")
+            
+            status, first = post(url + "/chapter", dict(story_args, new=True, summary=body["summaries"][0]))
+            assert status == 200 and first["chapter_num"] == 1
+            status, second = post(url + "/chapter", {"months": 60, "setting": "森林"})
+            assert status == 200 and second["chapter_num"] == 2
+            
+            status, error = post(url + "/story", dict(story_args, setting="火星", summary="概要"))
+            assert status == 400 and "error" in error
+            print("✓ 概要、故事和连续剧接口可用，参数错误时返回400")
+            
+            # 不使用数据库时，各家庭的孩子信息和连续剧也互不覆盖
+            service = StoryService()
+            service.set_profile(80, household="bob")
+            assert service.get_profile(household="bob")["months"] == 80
+            assert StoryService().get_profile(household="alice") is None
+            status, _ = post(url + "/chapter", {"months": 60, "setting": "森林", "household": "bob"})
+            assert status != 200
+            status, bob_first = post(url + "/chapter", dict(story_args, new=True, summary=body["summaries"][1],
+                                                            household="bob"))
+            assert status == 200 and bob_first["chapter_num"] == 1
+            assert load_serial_story("森林")["story_summary"] == body["summaries"][0]
+            assert load_serial_story("森林", household="bob")["story_summary"] == body["summaries"][1]
+            bob_meta = load_serial_meta("森林", household="bob")
+            assert bob_meta["story_summary"] == body["summaries"][1] and bob_meta["chapter_count"] == 1
+            assert get_chapters(bob_meta, 1, 1, household="bob") == [bob_first["chapter"]]
+            assert len(get_chapter_previews(bob_meta, household="bob")) == 1
+            assert load_serial_meta("森林")["chapter_count"] == 2
+            # 文件名只由家庭和孩子决定，与 STORY_HOUSEHOLD 的设置无关
+            with mock.patch("storage.STORY_HOUSEHOLD", "bob"):
+                assert household_path("serial_story.json", "bob", "default") != "serial_story.json"
+                assert household_path("serial_story.json", "default", "default") == "serial_story.json"
+            print("✓ 各家庭的孩子信息和连续剧分别保存")
+        finally:
+            stop()
+            reset_clients()
+            fake_server.shutdown()
+            fake_server.server_close()
+
+def test_benchmark_harness():
+    """测试端到端基准：模拟服务和语音后端的延迟、失败率可配置，结果可以写成 JSON"""
+    print("\n=== 测试端到端基准 ===")
+    
+    import json
+    from bench import percentiles, run_benchmarks
+    
+    assert percentiles(list(range(1, 101))) == {
+        "count": 100, "mean": 50.5, "p50": 50, "p95": 95, "p99": 99, "max": 100
+    }
+    results = run_benchmarks(
+        runs=3, llm_latency=0.0, llm_failure_rate=0.1, tts_latency=0.0, tts_failure_rate=0.2,
+        chapters=3, concurrency_levels=[1, 2], batch_jobs=2, seed=1
+    )
+    json.dumps(results, ensure_ascii=False)
+    print(f"首个概要 p50: {results['time_to_first_summary_ms']['p50']}ms，"
+          f"首句语音 p50: {results['audio']['time_to_first_audio_ms']['p50']}ms")
+    assert results["time_to_first_summary_ms"]["count"] == 3
+    assert results["audio"]["time_to_first_audio_ms"]["count"] == 3
+    assert [c["chapter"] for c in results["serial"]["chapters"]] == [1, 2, 3]
+    assert all(c["prompt_tokens"] > 0 for c in results["serial"]["chapters"])
+    assert [b["concurrency"] for b in results["batch"]] == [1, 2]
+    print("✓ 输出延迟分位数、每章 token 用量和批量吞吐量")
+
+def test_startup_imports():
+    """测试启动时不导入 openai、edge_tts 等重量级依赖"""
+    print("\n=== 测试启动导入 ===")
+    
+    from bench_startup import measure_import
+    
+    result = measure_import("main")
+    print(f"导入 main 耗时 {result['total_ms']:.1f}ms，重量级依赖: {result['heavy_modules']}")
+    assert result["total_ms"] > 0
+    assert result["heavy_modules"] == []
+    print("✓ 重量级依赖延迟到生成故事或合成语音时才导入")
+
+def test_metrics():
+    """测试埋点：每次AI调用记录耗时、token 用量、重试次数和章节号，可输出 JSONL 和 Prometheus 文本"""
+    print("\n=== 测试调用埋点 ===")
+    
+    import json
+    import os
+    import tempfile
+    from unittest import mock
+    from fake_llm import start_fake_server
+    from llm_client import reset_clients
+    from metrics import get_metrics, set_trace_file
+    from serial_story import generate_serial_story_chapter
+    from story_generator import generate_story
+    
+    # 部分请求返回500，SDK 内部重试
+    server, url = start_fake_server(failure_rate=0.3, seed=3)
+    env = {
+        "AZURE_OPENAI_ENDPOINT": url, "AZURE_OPENAI_API_KEY": "test-key",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01", "AZURE_OPENAI_DEPLOYMENT_NAME": "fake-deployment"
+    }
+    metrics = get_metrics()
+    with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ, env), \
+            mock.patch("llm_client.LLM_MAX_RETRIES", 5), \
+            mock.patch("story_generator.get_response_cache", return_value=None):
+        trace_path = os.path.join(tmp_dir, "trace.jsonl")
+        reset_clients()
+        metrics.reset()
+        set_trace_file(trace_path)
+        try:
+            for _ in range(4):
+                generate_story("讲一个睡前故事")
+            generate_serial_story_chapter("讲一个连续剧", 2, ["第一章的内容。"], "故事梗概")
+        finally:
+            set_trace_file(None)
+            reset_clients()
+            server.shutdown()
+            server.server_close()
+        
+        with open(trace_path, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f]
+    
+    stats = metrics.snapshot()["calls"]
+    story_stats = stats["llm.story"]
+    print(f"故事请求 {story_stats['count']} 次，重试 {story_stats['retries']} 次，"
+          f"输入 token {story_stats['prompt_tokens']}，输出 token {story_stats['completion_tokens']}")
+    assert story_stats["count"] == 4 and story_stats["retries"] > 0
+    assert story_stats["prompt_tokens"] + stats["llm.chapter"]["prompt_tokens"] == \
+        sum(u["prompt_tokens"] for u in server.usage_log)
+    chapter_events = [e for e in events if e["name"] == "chapter"]
+    assert len(chapter_events) == 1 and chapter_events[0]["chapter"] == 2
+    assert all(e["ms"] >= 0 and "retries" in e for e in events if e["kind"] == "llm")
+    text = metrics.render_prometheus()
+    assert 'story_call_duration_ms_count{kind="llm",name="story"} 4' in text
+    assert 'story_tokens_total{kind="llm",name="chapter",type="completion"}' in text
+    metrics.reset()
+    print("✓ 追踪文件和 Prometheus 输出包含耗时、token、重试和章节号")
+
 def main():
     """主测试函数"""
     print("开始测试模块化重构后的代码...\n")
@@ -102,6 +1412,33 @@ def main():
     test_story_generator()
     test_utils()
     test_serial_story()
+    test_serial_story_memory()
+    test_prompt_builder()
+    test_sentence_splitter()
+    test_length_limiter()
+    test_story_audio_pipeline()
+    test_batch_rate_limit()
+    test_batch_end_to_end()
+    test_response_cache()
+    test_summary_parsing()
+    test_summary_pool()
+    test_speculative_generation()
+    test_prefetch_pending()
+    test_chunked_tts()
+    test_audio_cache()
+    test_story_store()
+    test_chapter_paging()
+    test_chapter_journal()
+    test_serial_planner()
+    test_hedged_requests()
+    test_safety_filter()
+    test_prompt_caching()
+    test_story_index()
+    test_llm_client()
+    test_story_service()
+    test_benchmark_harness()
+    test_startup_imports()
+    test_metrics()
     
     print("\n=== 测试完成 ===")
     print("所有模块导入成功，功能正常！")
@@ -3,28 +3,210 @@ tts.py
 语音合成相关逻辑
 """
 
-import edge_tts
+import os
+import re
 import asyncio
-from typing import Optional
+from typing import AsyncIterator, List, Optional
 
-async def text_to_speech(text: str, output_file: str):
-    """将文本转换为语音"""
+from audio_cache import get_audio_cache, make_audio_key
+from metrics import record_cache, span
+from utils import split_sentences
+
+# 默认使用中文女声，语速和音调可通过环境变量调整
+DEFAULT_VOICE = "zh-CN-XiaoxiaoNeural"
+TTS_RATE = os.getenv("TTS_RATE", "+0%")
+TTS_PITCH = os.getenv("TTS_PITCH", "+0Hz")
+# 流式合成的并发数和待合成句子队列长度
+TTS_WORKERS = 3
+TTS_QUEUE_SIZE = 6
+# 分段合成：每段最多字数、同时合成的段数、单段失败后的重试次数
+TTS_CHUNK_CHARS = 300
+TTS_CONCURRENCY = 4
+TTS_CHUNK_RETRIES = 2
+
+class TTSBackend:
+    """语音合成后端接口，synthesize 返回一段完整的MP3数据"""
+    
+    rate = TTS_RATE
+    pitch = TTS_PITCH
+    
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        raise NotImplementedError
+
+class EdgeTTSBackend(TTSBackend):
+    """使用 edge-tts 的语音合成后端"""
+    
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        # edge_tts 及其依赖导入较慢，第一次合成时才导入
+        import edge_tts
+        communicate = edge_tts.Communicate(text, voice, rate=self.rate, pitch=self.pitch)
+        audio = bytearray()
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                audio.extend(chunk["data"])
+        return bytes(audio)
+
+_tts_backend: TTSBackend = EdgeTTSBackend()
+
+def set_tts_backend(backend: TTSBackend):
+    """替换语音合成后端（测试时可换成本地桩实现）"""
+    global _tts_backend
+    _tts_backend = backend
+
+def get_tts_backend() -> TTSBackend:
+    """返回当前的语音合成后端"""
+    return _tts_backend
+
+def split_text_chunks(text: str, max_chars: int = TTS_CHUNK_CHARS) -> List[str]:
+    """按段落切分文本，过长的段落再按句子切分，相邻的短段合并到不超过 max_chars"""
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(split_sentences(paragraph))
+    
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def strip_id3(data: bytes) -> bytes:
+    """去掉MP3数据首尾的 ID3 标签，只保留音频帧，便于直接拼接"""
+    if data[:3] == b"ID3" and len(data) >= 10:
+        # ID3v2 头部的长度字段是 4 个 7 位的同步安全整数
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        data = data[10 + size + footer:]
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+async def synthesize_sentence(text: str, voice: str = DEFAULT_VOICE) -> bytes:
+    """合成单个句子，返回MP3数据"""
+    with span("tts", "sentence", chars=len(text)):
+        return await get_tts_backend().synthesize(text, voice)
+
+async def synthesize_chunks(chunks: List[str], voice: str = DEFAULT_VOICE,
+                            concurrency: int = TTS_CONCURRENCY, retries: int = TTS_CHUNK_RETRIES) -> List[bytes]:
+    """并发合成多个文本段，单段失败时只重试该段，结果按原顺序返回"""
+    semaphore = asyncio.Semaphore(concurrency)
+    backend = get_tts_backend()
+    
+    async def synthesize_one(index: int, chunk: str) -> bytes:
+        with span("tts", "chunk", chars=len(chunk)) as event:
+            for attempt in range(retries + 1):
+                event["retries"] = attempt
+                try:
+                    async with semaphore:
+                        return await backend.synthesize(chunk, voice)
+                except Exception as e:
+                    if attempt == retries:
+                        raise RuntimeError(f"第{index + 1}段语音合成失败：{str(e)}")
+                    print(f"第{index + 1}段语音合成失败，正在重试：{str(e)}")
+                    await asyncio.sleep(0.5 * (2 ** attempt))
+    
+    return await asyncio.gather(*(synthesize_one(i, chunk) for i, chunk in enumerate(chunks)))
+
+async def text_to_speech(text: str, output_file: str, voice: str = DEFAULT_VOICE):
+    """将文本转换为语音：分段并发合成后按顺序拼接MP3帧，不重新编码"""
     try:
-        # 使用中文女声
-        voice = "zh-CN-XiaoxiaoNeural"
-        communicate = edge_tts.Communicate(text, voice)
-        await communicate.save(output_file)
-        print(f"\n语音文件已保存为：{output_file}")
+        chunks = split_text_chunks(text)
+        segments = await synthesize_chunks(chunks, voice)
+        with open(output_file, "wb") as f:
+            for i, segment in enumerate(segments):
+                # 保留第一段的标签，其余段只写音频帧
+                f.write(segment if i == 0 else strip_id3(segment))
+        print(f"\n语音文件已保存为：{output_file}（共{len(chunks)}段）")
     except Exception as e:
         print(f"语音合成失败：{str(e)}")
 
+async def stream_text_to_speech(sentences: AsyncIterator[str], output_file: str,
+                                workers: int = TTS_WORKERS, queue_size: int = TTS_QUEUE_SIZE) -> int:
+    """边接收句子边合成语音，按句子顺序追加写入MP3文件，返回写入的句子数"""
+    # 待合成队列有上限，合成跟不上时会反压句子的生产
+    work_queue = asyncio.Queue(maxsize=queue_size)
+    # 按句子顺序排列的结果，写入协程依次等待
+    order_queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        while True:
+            item = await work_queue.get()
+            if item is None:
+                break
+            text, future = item
+            try:
+                future.set_result(await synthesize_sentence(text))
+            except Exception as e:
+                # 单句失败不影响整个文件，跳过这一句
+                print(f"\n语音合成失败（{text[:10]}...）：{str(e)}")
+                future.set_result(b"")
+
+    async def writer() -> int:
+        written = 0
+        with open(output_file, "wb") as f:
+            while True:
+                future = await order_queue.get()
+                if future is None:
+                    break
+                data = await future
+                if data:
+                    # 保留第一段的标签，其余段只写音频帧
+                    f.write(data if written == 0 else strip_id3(data))
+                    # 及时落盘，播放器可以边写边播
+                    f.flush()
+                    written += 1
+        return written
+
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    writer_task = asyncio.create_task(writer())
+
+    async for sentence in sentences:
+        future = loop.create_future()
+        await order_queue.put(future)
+        await work_queue.put((sentence, future))
+
+    for _ in worker_tasks:
+        await work_queue.put(None)
+    await order_queue.put(None)
+    await asyncio.gather(*worker_tasks)
+    return await writer_task
+
+def audio_cache_key(text: str, voice: str = DEFAULT_VOICE) -> str:
+    """按当前后端的音色、语速和音调计算语音缓存键"""
+    backend = get_tts_backend()
+    return make_audio_key(text, voice, backend.rate, backend.pitch)
+
 def generate_audio_file(text: str, prefix: str = "story") -> str:
-    """生成音频文件并返回文件名"""
+    """生成音频文件并返回文件名；相同文本已合成过时直接返回缓存的文件"""
+    cache = get_audio_cache()
+    key = audio_cache_key(text)
+    cached_file = cache.get(key) if cache else None
+    if cache:
+        record_cache("audio", bool(cached_file))
+    if cached_file:
+        print(f"\n[语音缓存] 已合成过相同内容，语音文件：{cached_file}")
+        return cached_file
+    
     from datetime import datetime
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_file = f"{prefix}_{timestamp}.mp3"
     
     print("\n正在生成语音，请稍候...")
     # 运行语音合成
-    asyncio.run(text_to_speech(text, output_file))
+    with span("tts", "audio_file", chars=len(text)):
+        asyncio.run(text_to_speech(text, output_file))
+    if cache:
+        cache.put_file(key, output_file)
     return output_file 
\ No newline at end of file
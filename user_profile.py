@@ -5,8 +5,11 @@ user_profile.py
 
 import os
 import json
-from typing import Tuple
+from typing import Optional, Tuple
 from datetime import datetime
+from storage import STORY_CHILD, STORY_HOUSEHOLD, get_story_store, household_path
+from chapter_store import CHAPTER_INDEX_SUFFIX
+from chapter_journal import JOURNAL_SUFFIX, LOCK_SUFFIX
 
 # 孩子信息记录文件
 CHILD_INFO_FILE = "child_info.json"
@@ -17,11 +20,37 @@ def get_elapsed_months(start_date: str) -> int:
     now = datetime.now()
     return (now.year - start.year) * 12 + (now.month - start.month)
 
+def read_child_info(household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> Optional[dict]:
+    """读取孩子信息记录，没有记录时返回 None"""
+    store = get_story_store()
+    if store:
+        return store.get_child(household, child)
+    path = household_path(CHILD_INFO_FILE, household, child)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_child_info(data: dict, household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD):
+    """保存孩子信息记录"""
+    store = get_story_store()
+    if store:
+        store.save_child(household, child, data)
+        return
+    with open(household_path(CHILD_INFO_FILE, household, child), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+def get_current_months(household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD) -> Optional[int]:
+    """不做交互地读取孩子当前月龄，没有记录时返回 None"""
+    data = read_child_info(household, child)
+    if data is None:
+        return None
+    return data["base_months"] + get_elapsed_months(data["start_date"])
+
 def load_or_init_child_info() -> tuple:
     """读取或初始化孩子信息（年龄和性别）"""
-    if os.path.exists(CHILD_INFO_FILE):
-        with open(CHILD_INFO_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    data = read_child_info()
+    if data is not None:
         base_months = data["base_months"]
         start_date = data["start_date"]
         gender = data.get("gender", "")
@@ -42,21 +71,30 @@ def load_or_init_child_info() -> tuple:
             total_months = years * 12 + months
             now_str = datetime.now().strftime("%Y-%m-%d")
             gender = input("请输入孩子性别（男/女）：").strip()
-            with open(CHILD_INFO_FILE, "w", encoding="utf-8") as f:
-                json.dump({
-                    "start_date": now_str,
-                    "base_months": total_months,
-                    "gender": gender
-                }, f, ensure_ascii=False, indent=2)
+            write_child_info({
+                "start_date": now_str,
+                "base_months": total_months,
+                "gender": gender
+            })
             print(f"[记录完成] 初始月龄：{total_months}个月，性别：{gender}，记录时间：{now_str}")
             return total_months, gender
         else:
             raise ValueError('输入格式有误，请输入如"3岁6个月"')
 
-def reset_child_info():
+def reset_child_info(household: str = STORY_HOUSEHOLD, child: str = STORY_CHILD):
     """重置孩子信息"""
-    if os.path.exists(CHILD_INFO_FILE):
-        os.remove(CHILD_INFO_FILE)
+    store = get_story_store()
+    if store:
+        # 数据库中同时删除该孩子的连续剧
+        if store.delete_child(household, child):
+            print("已重置孩子信息和连续剧信息。")
+        else:
+            print("没有找到孩子信息记录。")
+        return
+    
+    path = household_path(CHILD_INFO_FILE, household, child)
+    if os.path.exists(path):
+        os.remove(path)
         print("已重置孩子信息。")
     else:
         print("没有找到孩子信息记录。")
@@ -65,6 +103,13 @@ def reset_child_info():
     SERIAL_STORY_FILE = "serial_story.json"
     if os.path.exists(SERIAL_STORY_FILE):
         os.remove(SERIAL_STORY_FILE)
+        if os.path.exists(SERIAL_STORY_FILE + CHAPTER_INDEX_SUFFIX):
+            os.remove(SERIAL_STORY_FILE + CHAPTER_INDEX_SUFFIX)
+        # 未保存章节的预写日志属于被删除的连续剧，一并清除
+        if os.path.exists(SERIAL_STORY_FILE + JOURNAL_SUFFIX):
+            os.remove(SERIAL_STORY_FILE + JOURNAL_SUFFIX)
+        if os.path.exists(SERIAL_STORY_FILE + JOURNAL_SUFFIX + LOCK_SUFFIX):
+            os.remove(SERIAL_STORY_FILE + JOURNAL_SUFFIX + LOCK_SUFFIX)
         print("已重置连续剧信息。")
     else:
         print("没有找到连续剧信息记录。") 
\ No newline at end of file
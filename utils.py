@@ -4,7 +4,7 @@ utils.py
 """
 
 from datetime import datetime
-from typing import Any
+from typing import Any, List
 
 def get_elapsed_months(start_date: str) -> int:
     # 从 main.py 迁移的计算月龄函数
@@ -14,6 +14,77 @@ def convert_months_to_prompt_info(months: int):
     # 从 main.py 迁移的年龄段判断与提示模板函数
     pass 
 
+# 中文句末标点，以及可以跟在句末标点之后的引号和括号
+SENTENCE_ENDINGS = "。！？"
+SENTENCE_CLOSERS = "”’」』）"
+
+class SentenceSplitter:
+    """增量断句器：不断输入文本片段，按中文句末标点切出完整句子"""
+    
+    def __init__(self):
+        self.buffer = ""
+    
+    def feed(self, text: str) -> List[str]:
+        """输入新片段，返回已经完整的句子"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        i = 0
+        while i < len(self.buffer):
+            if self.buffer[i] in SENTENCE_ENDINGS:
+                end = i + 1
+                while end < len(self.buffer) and self.buffer[end] in SENTENCE_ENDINGS + SENTENCE_CLOSERS:
+                    end += 1
+                # 句末标点在缓冲区末尾时，后面可能还有引号，等待下一个片段
+                if end == len(self.buffer):
+                    break
+                sentence = self.buffer[start:end].strip()
+                if sentence:
+                    sentences.append(sentence)
+                start = end
+                i = end
+            else:
+                i += 1
+        self.buffer = self.buffer[start:]
+        return sentences
+    
+    def flush(self) -> List[str]:
+        """返回缓冲区中剩余的内容"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+class LengthLimiter:
+    """流式长度控制：累计非空白字数，达到上限后在下一个句末标点（连同其后的引号）处截断"""
+    
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.count = 0
+        # 已到达上限并遇到句末标点，正在接收可能跟随的引号
+        self.closing = False
+        self.done = False
+    
+    def feed(self, text: str) -> str:
+        """返回片段中应当输出的部分；到达截断点后 done 为 True，之后的输入全部丢弃"""
+        if self.done:
+            return ""
+        for i, char in enumerate(text):
+            if self.closing:
+                if char not in SENTENCE_ENDINGS + SENTENCE_CLOSERS:
+                    self.done = True
+                    return text[:i]
+                continue
+            if char.strip():
+                self.count += 1
+            if self.count >= self.max_chars and char in SENTENCE_ENDINGS:
+                self.closing = True
+        return text
+
+def split_sentences(text: str) -> List[str]:
+    """将整段文本按中文句末标点切分为句子"""
+    splitter = SentenceSplitter()
+    return splitter.feed(text) + splitter.flush()
+
 # 场景选择相关常量
 VALID_SETTINGS = ["森林", "城堡", "海洋", "玩具世界", "牧场", "太空"]
 